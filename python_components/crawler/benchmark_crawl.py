@@ -0,0 +1,343 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pymupdf
+from pytest_httpserver import HTTPServer
+from werkzeug import Response
+
+import crawler
+
+
+class SyntheticSite:
+    """
+    Deterministic website served from an in-process HTTP server. Pages form a
+    tree with the given fan-out, each page also links to cross_links random
+    pages and to some of the PDFs, and every response is delayed by latency
+    seconds. The site has a robots.txt, a sitemap index over sitemaps of
+    sitemap_size pages (gzipped when gzip_sitemaps is set) and PDFs of
+    pdf_pages pages, a table_density share of which hold a ruled table.
+    """
+
+    def __init__(
+        self,
+        pages=200,
+        fanout=5,
+        cross_links=3,
+        pdfs=50,
+        pdf_pages=(1, 10),
+        table_density=0.3,
+        latency=0.0,
+        sitemap_size=1000,
+        gzip_sitemaps=False,
+        crawl_delay=0,
+        seed=0,
+    ):
+        self.pages = pages
+        self.fanout = fanout
+        self.latency = latency
+        self.sitemap_size = sitemap_size
+        self.gzip_sitemaps = gzip_sitemaps
+        self.crawl_delay = crawl_delay
+        rng = random.Random(seed)
+
+        self.links = []
+        for page in range(pages):
+            children = range(fanout * page + 1, min(fanout * (page + 1) + 1, pages))
+            cross = [rng.randrange(pages) for _ in range(cross_links)]
+            self.links.append([f"/page/{child}" for child in [*children, *cross]])
+        for pdf in range(pdfs):
+            # Every PDF is linked from one page, and some from a second one
+            for page in {pdf % pages, rng.randrange(pages)}:
+                self.links[page].append(f"/files/{pdf}.pdf")
+
+        self.pdf_specs = [
+            (rng.randint(*pdf_pages), table_density, rng.randrange(1 << 30))
+            for _ in range(pdfs)
+        ]
+        self.pdf_cache = {}
+        self.pdf_lock = threading.Lock()
+        self.server = HTTPServer(threaded=True)
+
+    @property
+    def depth(self):
+        # Depth of the page tree, counting the home page as 1
+        depth, last = 1, 0
+        while last < self.pages - 1:
+            last = self.fanout * last + self.fanout
+            depth += 1
+        return depth
+
+    def url(self, path):
+        return self.server.url_for(path)
+
+    def make_pdf(self, pdf):
+        page_count, table_density, seed = self.pdf_specs[pdf]
+        rng = random.Random(seed)
+        document = pymupdf.open()
+        document.set_metadata({"title": f"Synthetic document {pdf}"})
+        for page_number in range(page_count):
+            page = document.new_page()
+            page.insert_text((72, 72), f"Document {pdf}, page {page_number + 1}")
+            if rng.random() < table_density:
+                for row in range(6):
+                    page.draw_line((50, 100 + row * 20), (450, 100 + row * 20))
+                for column in range(5):
+                    x = 50 + column * 100
+                    page.draw_line((x, 100), (x, 200))
+        return document.tobytes()
+
+    def pdf_bytes(self, pdf):
+        with self.pdf_lock:
+            if pdf not in self.pdf_cache:
+                self.pdf_cache[pdf] = self.make_pdf(pdf)
+            return self.pdf_cache[pdf]
+
+    def sitemap(self, index):
+        pages = range(
+            index * self.sitemap_size, min((index + 1) * self.sitemap_size, self.pages)
+        )
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            + "".join(
+                f"<url><loc>{self.url(f'/page/{page}')}</loc></url>" for page in pages
+            )
+            + "</urlset>"
+        ).encode()
+        return gzip.compress(body) if self.gzip_sitemaps else body
+
+    def handle(self, request):
+        time.sleep(self.latency)
+        path = request.path
+        if path == "/robots.txt":
+            body = f"User-agent: *\nSitemap: {self.url('/sitemap.xml')}\n"
+            if self.crawl_delay:
+                body += f"Crawl-delay: {self.crawl_delay}\n"
+            return Response(body, content_type="text/plain")
+        if path == "/sitemap.xml":
+            extension = "xml.gz" if self.gzip_sitemaps else "xml"
+            sitemaps = range(-(-self.pages // self.sitemap_size))
+            body = "<sitemapindex>" + "".join(
+                f"<sitemap><loc>{self.url(f'/sitemap-{n}.{extension}')}</loc></sitemap>"
+                for n in sitemaps
+            )
+            return Response(body + "</sitemapindex>", content_type="application/xml")
+        match = re.fullmatch(r"/sitemap-(\d+)\.xml(\.gz)?", path)
+        if match:
+            return Response(self.sitemap(int(match[1])), content_type="application/xml")
+        match = re.fullmatch(r"/page/(\d+)", path)
+        if match and int(match[1]) < self.pages:
+            links = self.links[int(match[1])]
+            body = "".join(f'<p><a href="{link}">{link}</a></p>' for link in links)
+            return Response(
+                f"<html><body>{body}</body></html>", content_type="text/html"
+            )
+        match = re.fullmatch(r"/files/(\d+)\.pdf", path)
+        if match and int(match[1]) < len(self.pdf_specs):
+            body = self.pdf_bytes(int(match[1]))
+            return Response(body, content_type="application/pdf")
+        return Response("Not found", status=404)
+
+    def __enter__(self):
+        self.server.expect_request(re.compile(".*")).respond_with_handler(self.handle)
+        self.server.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.clear()
+        self.server.stop()
+
+
+def children_peak_rss_mb():
+    # Largest RSS of the child processes waited for so far, such as analysis
+    # workers. ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def measure(name, run, count_pages, count_pdfs, trace_memory=True):
+    # Runs a crawl stage and returns its throughput and memory use, along with
+    # the stage's own result. peak_heap_mb is the peak of Python allocations
+    # traced over this stage only (the local site's server included), which
+    # slows the stage down. The process' own peak RSS would include every
+    # earlier stage. children_peak_rss_mb is the largest child process of
+    # this stage, or 0 when none went past the children of earlier stages.
+    crawler.get_metrics.cache_clear()
+    children_before = children_peak_rss_mb()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - started
+        peak_heap = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        tracemalloc.stop()
+    children = children_peak_rss_mb()
+    pages, pdfs = count_pages(result), count_pdfs(result)
+    return result, {
+        "stage": name,
+        "seconds": round(seconds, 3),
+        "pages": pages,
+        "pdfs": pdfs,
+        "pages_per_second": round(pages / seconds, 1),
+        "pdfs_per_second": round(pdfs / seconds, 1),
+        "peak_heap_mb": round(peak_heap / 1024 / 1024, 1),
+        "children_peak_rss_mb": round(children if children > children_before else 0, 1),
+    }
+
+
+def benchmark(
+    site,
+    stages=("bfs", "sitemap", "metadata"),
+    concurrency=1,
+    download_workers=1,
+    analysis_workers=1,
+    trace_memory=True,
+):
+    # Drives the crawler against a running SyntheticSite and returns one result
+    # per stage. The metadata stage reads the PDFs found by the BFS stage.
+    results = []
+    home = site.url("/page/0")
+    # Every page matches /page/N, so only the repeated segment check applies
+    scope = crawler.ScopeMatcher.from_config(
+        {"allow_list": [home], "traps": {"max_urls_per_pattern": None}}
+    )
+    pdfs = None
+
+    if "bfs" in stages or "metadata" in stages:
+        (pdfs, _), result = measure(
+            f"bfs (concurrency {concurrency})",
+            lambda: crawler.bfs_search_pdfs(
+                home,
+                scope.allowable_domains,
+                max_depth=site.depth + 1,
+                concurrency=concurrency,
+                scope=scope,
+            ),
+            lambda result: len(result[1]),
+            lambda result: len(result[0]),
+            trace_memory=trace_memory,
+        )
+        if "bfs" in stages:
+            results.append(result)
+
+    if "sitemap" in stages:
+        sitemap, delay = crawler.parse_robots_txt(site.url("/"), 0)
+        _, result = measure(
+            "sitemap",
+            lambda: crawler.get_all_pages(
+                crawler.iter_sitemap([sitemap], delay=delay), delay=delay
+            ),
+            lambda result: len(result[1]),
+            lambda result: len(result[0]),
+            trace_memory=trace_memory,
+        )
+        results.append(result)
+
+    if "metadata" in stages:
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = os.path.join(output_dir, "metadata.csv")
+            _, result = measure(
+                f"metadata ({download_workers} downloads, "
+                f"{analysis_workers} analyses)",
+                lambda: crawler.get_pdf_metadata(
+                    pdfs,
+                    output_path,
+                    download_workers=download_workers,
+                    analysis_workers=analysis_workers,
+                ),
+                lambda result: 0,
+                lambda result: crawler.get_metrics().counters["pdfs"],
+                trace_memory=trace_memory,
+            )
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the crawler against a generated local site"
+    )
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--fanout", type=int, default=5)
+    parser.add_argument("--cross-links", type=int, default=3)
+    parser.add_argument("--pdfs", type=int, default=100)
+    parser.add_argument(
+        "--pdf-pages", type=int, nargs=2, default=(1, 20), metavar=("MIN", "MAX")
+    )
+    parser.add_argument(
+        "--table-density",
+        type=float,
+        default=0.3,
+        help="Share of PDF pages holding a table",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="Seconds added to responses"
+    )
+    parser.add_argument("--sitemap-size", type=int, default=1000)
+    parser.add_argument("--gzip-sitemaps", action="store_true")
+    parser.add_argument("--crawl-delay", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=["bfs", "sitemap", "metadata"],
+        default=["bfs", "sitemap", "metadata"],
+    )
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--download-workers", type=int, default=1)
+    parser.add_argument("--analysis-workers", type=int, default=1)
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="Skip tracing Python allocations, which slows stages down",
+    )
+    parser.add_argument("--json", help="Also save the results to this JSON file")
+    args = parser.parse_args()
+
+    site = SyntheticSite(
+        pages=args.pages,
+        fanout=args.fanout,
+        cross_links=args.cross_links,
+        pdfs=args.pdfs,
+        pdf_pages=tuple(args.pdf_pages),
+        table_density=args.table_density,
+        latency=args.latency,
+        sitemap_size=args.sitemap_size,
+        gzip_sitemaps=args.gzip_sitemaps,
+        crawl_delay=args.crawl_delay,
+        seed=args.seed,
+    )
+    with site:
+        results = benchmark(
+            site,
+            stages=args.stages,
+            concurrency=args.concurrency,
+            download_workers=args.download_workers,
+            analysis_workers=args.analysis_workers,
+            trace_memory=not args.no_trace_memory,
+        )
+
+    columns = [
+        "seconds",
+        "pages_per_second",
+        "pdfs_per_second",
+        "peak_heap_mb",
+        "children_peak_rss_mb",
+    ]
+    print(f"{'stage':<40}" + "".join(f"{column:>22}" for column in columns))
+    for result in results:
+        row = "".join(f"{result[column]:>22}" for column in columns)
+        print(f"{result['stage']:<40}{row}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
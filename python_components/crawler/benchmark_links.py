@@ -0,0 +1,50 @@
+import argparse
+import glob
+import os
+import timeit
+
+from crawler import LINK_PARSERS, get_links_from_anchors, parse_anchors
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def benchmark(paths, parsers, repeat=5, number=20):
+    # Returns the best time in milliseconds to extract the links of each page
+    # with each parser
+    results = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            content = f.read()
+        url = "https://example.gov/" + os.path.basename(path)
+        for parser in parsers:
+            timer = timeit.Timer(
+                lambda: get_links_from_anchors(url, parse_anchors(content, parser))
+            )
+            best = min(timer.repeat(repeat=repeat, number=number)) / number
+            results[(path, parser)] = best * 1000
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times link extraction from saved HTML pages"
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        default=sorted(glob.glob(os.path.join(FIXTURES, "*.html"))),
+        help="Saved HTML pages, defaults to the pages in fixtures/",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    parsers = sorted(LINK_PARSERS)
+    results = benchmark(args.paths, parsers, repeat=args.repeat, number=args.number)
+    print(f"{'page':<32}" + "".join(f"{parser:>14}" for parser in parsers))
+    for path in args.paths:
+        row = "".join(f"{results[(path, parser)]:>12.2f}ms" for parser in parsers)
+        print(f"{os.path.basename(path):<32}{row}")
+    for parser in parsers:
+        total = sum(results[(path, parser)] for path in args.paths)
+        print(f"{parser}: {total:.2f}ms for {len(args.paths)} pages")
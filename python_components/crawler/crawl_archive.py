@@ -0,0 +1,242 @@
+import fcntl
+import gzip
+import http.client
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import requests
+import tldextract
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3 import HTTPHeaderDict, HTTPResponse
+
+# Response bodies being recorded are kept in memory up to this many bytes,
+# then in a temporary file
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class ArchiveMiss(requests.ConnectionError):
+    pass
+
+
+class CrawlArchive:
+    """
+    Directory of WARC-style archives, one <registered domain>.warc.gz per
+    site. Each HTTP response is appended as its own gzip member holding a
+    WARC/1.1 response record, with the body stored decoded, and located by a
+    line of <registered domain>.idx keyed by method, URL and Range header.
+    When a request was recorded more than once, the last response wins.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.indexes = {}
+
+    def paths(self, url):
+        # Returns the archive and index paths for the site of url
+        domain = tldextract.extract(url).registered_domain
+        name = domain or urllib.parse.urlsplit(url).hostname or "unknown"
+        path = os.path.join(self.directory, name)
+        return f"{path}.warc.gz", f"{path}.idx"
+
+    def _index(self, index_path):
+        # Call with the lock held
+        if index_path not in self.indexes:
+            index = {}
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        key = (entry["method"], entry["url"], entry["range"])
+                        index[key] = (entry["offset"], entry["length"])
+            self.indexes[index_path] = index
+        return self.indexes[index_path]
+
+    def tee(self, request, response):
+        # Copies the body to a spool file as the caller reads it, and archives
+        # the response once the body is read or the response is closed. A
+        # response closed before its end, like a PDF download abandoned over
+        # its size or time limit, is archived with what was read and marked
+        # truncated.
+        spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+        iter_content, close = response.iter_content, response.close
+        recorded = False
+
+        def finish(truncated):
+            nonlocal recorded
+            if not recorded:
+                recorded = True
+                with spool:
+                    self.record(request, response, spool, truncated)
+
+        def tee_content(chunk_size=1, decode_unicode=False):
+            complete = False
+            try:
+                for chunk in iter_content(chunk_size, decode_unicode):
+                    if isinstance(chunk, bytes):
+                        spool.write(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                finish(truncated=not complete)
+
+        def tee_close():
+            # Responses closed without being read are only complete when
+            # they have no body
+            finish(truncated=not has_empty_body(request, response))
+            close()
+
+        response.iter_content, response.close = tee_content, tee_close
+
+    def record(self, request, response, body, truncated=False):
+        # Appends response with the body read so far from the body file
+        size = body.tell()
+        body.seek(0)
+        headers = [
+            (name, value)
+            for name, value in response.headers.items()
+            if name.lower()
+            not in ("content-encoding", "content-length", "transfer-encoding")
+        ]
+        length = response.headers.get("Content-Length")
+        if not truncated:
+            headers.append(("Content-Length", str(size)))
+        elif length is not None and "content-encoding" not in response.headers:
+            # Kept so a replay skips a PDF on its announced size again
+            headers.append(("Content-Length", length))
+        http_head = f"HTTP/1.1 {response.status_code} {response.reason or ''}\r\n"
+        http_head += "".join(f"{name}: {value}\r\n" for name, value in headers)
+        http_head = (http_head + "\r\n").encode("latin-1", errors="replace")
+        warc_head = (
+            "WARC/1.1\r\n"
+            "WARC-Type: response\r\n"
+            f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>\r\n"
+            f"WARC-Date: {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}\r\n"
+            f"WARC-Target-URI: {request.url}\r\n"
+            + ("WARC-Truncated: length\r\n" if truncated else "")
+            + "Content-Type: application/http; msgtype=response\r\n"
+            f"Content-Length: {len(http_head) + size}\r\n\r\n"
+        )
+
+        # Compressed outside the lock, then copied to the end of the archive
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as member:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=member) as f:
+                f.write(warc_head.encode() + http_head)
+                shutil.copyfileobj(body, f)
+                f.write(b"\r\n\r\n")
+            member_length = member.tell()
+            member.seek(0)
+
+            key = (request.method, request.url, request.headers.get("Range"))
+            archive_path, index_path = self.paths(request.url)
+            with self.lock, open(archive_path, "ab") as f:
+                # Also locked between processes, --crawl-workers all append
+                # to the same archives
+                fcntl.flock(f, fcntl.LOCK_EX)
+                offset = f.seek(0, os.SEEK_END)
+                shutil.copyfileobj(member, f)
+                f.flush()
+                with open(index_path, "a") as index_file:
+                    entry = dict(zip(("method", "url", "range"), key))
+                    entry.update(offset=offset, length=member_length)
+                    index_file.write(json.dumps(entry) + "\n")
+                self._index(index_path)[key] = (offset, member_length)
+
+    def lookup(self, method, url, byte_range=None):
+        # Returns the recorded (status, reason, headers, body, truncated), or
+        # None
+        archive_path, index_path = self.paths(url)
+        with self.lock:
+            location = self._index(index_path).get((method, url, byte_range))
+        if location is None:
+            return None
+        offset, length = location
+        with open(archive_path, "rb") as f:
+            f.seek(offset)
+            record = gzip.decompress(f.read(length))
+
+        warc_head, _, rest = record.partition(b"\r\n\r\n")
+        block_length = int(re.search(rb"Content-Length: (\d+)", warc_head)[1])
+        truncated = b"WARC-Truncated:" in warc_head
+        http_head, _, body = rest[:block_length].partition(b"\r\n\r\n")
+        status_line, *header_lines = http_head.decode("latin-1").split("\r\n")
+        _, status, reason = (status_line.split(" ", 2) + [""])[:3]
+        headers = [tuple(line.split(": ", 1)) for line in header_lines]
+        return int(status), reason, headers, body, truncated
+
+
+def has_empty_body(request, response):
+    return (
+        request.method == "HEAD"
+        or response.status_code in (204, 304)
+        or response.headers.get("Content-Length") == "0"
+    )
+
+
+class TruncatedBody(io.BytesIO):
+    # Body of a response that was closed before its end while recording.
+    # Reading past it fails as if the connection dropped.
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data and size != 0:
+            raise http.client.IncompleteRead(b"")
+        return data
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Transport adapter that archives every response the adapter it wraps
+    receives, including each redirect, as its body is read.
+    """
+
+    def __init__(self, archive, adapter):
+        super().__init__()
+        self.archive = archive
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        self.archive.tee(request, response)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Transport adapter answering requests from a CrawlArchive without touching
+    the network. Requests that weren't recorded raise ArchiveMiss, which
+    callers handle like a connection error.
+    """
+
+    def __init__(self, archive, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        recorded = self.archive.lookup(
+            request.method, request.url, request.headers.get("Range")
+        )
+        if recorded is None:
+            raise ArchiveMiss(
+                f"Not in the archive: {request.method} {request.url}", request=request
+            )
+        status, reason, headers, body, truncated = recorded
+        raw = HTTPResponse(
+            body=TruncatedBody(body) if truncated else io.BytesIO(body),
+            headers=HTTPHeaderDict(headers),
+            status=status,
+            reason=reason,
+            preload_content=False,
+        )
+        return self.build_response(request, raw)
@@ -0,0 +1,224 @@
+import csv
+import fnmatch
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from tqdm import tqdm
+
+# Columns of the metadata CSV and of the pdfs table
+PDF_METADATA_FIELDS = [
+    "file_name",
+    "url",
+    "file_size",
+    "file_size_kilobytes",
+    "last_modified_date",
+    "author",
+    "subject",
+    "keywords",
+    "creation_date",
+    "producer",
+    "number_of_pages",
+    "number_of_tables",
+    "number_of_images",
+    "version",
+    "source",
+    "text_around_link",
+    "duplicate_of",
+    "counts_estimated",
+    "download_status",
+]
+
+
+class CrawlDatabase:
+    """
+    SQLite store of the PDFs found by every crawl run, one row per run and
+    PDF URL with the metadata CSV columns and the content hash, indexed by
+    URL, site, content hash and run. Compares runs of a site (new, removed
+    and changed PDFs) and exports rows as CSVs that classifier.py reads.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(PDF_METADATA_FIELDS)
+        with self.connection:
+            self.connection.executescript(
+                f"""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    site TEXT NOT NULL,
+                    started TEXT NOT NULL,
+                    finished TEXT,
+                    pages INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS runs_site ON runs (site, id);
+                CREATE TABLE IF NOT EXISTS pdfs (
+                    run_id INTEGER NOT NULL REFERENCES runs (id),
+                    site TEXT NOT NULL,
+                    content_hash TEXT,
+                    {columns},
+                    PRIMARY KEY (run_id, url)
+                );
+                CREATE INDEX IF NOT EXISTS pdfs_url ON pdfs (url, run_id);
+                CREATE INDEX IF NOT EXISTS pdfs_site ON pdfs (site, run_id);
+                CREATE INDEX IF NOT EXISTS pdfs_content_hash ON pdfs (content_hash);
+                """
+            )
+
+    def start_run(self, site):
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (site, started) VALUES (?, ?)",
+                (site, datetime.now().isoformat(timespec="seconds")),
+            )
+        return cursor.lastrowid
+
+    def finish_run(self, run_id, pages=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE runs SET finished = ?, pages = ? WHERE id = ?",
+                (datetime.now().isoformat(timespec="seconds"), pages, run_id),
+            )
+
+    def previous_run(self, run_id):
+        # The last finished run of the same site before run_id, or None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id FROM runs WHERE finished IS NOT NULL AND id < ? "
+                "AND site = (SELECT site FROM runs WHERE id = ?) "
+                "ORDER BY id DESC LIMIT 1",
+                (run_id, run_id),
+            ).fetchone()
+        return row["id"] if row else None
+
+    def latest_run(self, site):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT id FROM runs WHERE site = ? AND finished IS NOT NULL "
+                "ORDER BY id DESC LIMIT 1",
+                (site,),
+            ).fetchone()
+        return row["id"] if row else None
+
+    def add_pdf(self, run_id, row, content_hash=None):
+        # row is a metadata CSV row. Lists are stored as JSON, and values
+        # sqlite can't hold as is (dates, booleans) as they appear in the CSV
+        values = []
+        for column in PDF_METADATA_FIELDS:
+            value = row.get(column)
+            if isinstance(value, list):
+                value = json.dumps(value)
+            elif value is not None and type(value) not in (int, float, str):
+                value = str(value)
+            values.append(value)
+        columns = ", ".join(PDF_METADATA_FIELDS)
+        placeholders = ", ".join("?" for _ in PDF_METADATA_FIELDS)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO pdfs (run_id, site, content_hash, {columns}) "
+                f"SELECT ?, site, ?, {placeholders} FROM runs WHERE id = ?",
+                (run_id, content_hash, *values, run_id),
+            )
+
+    def _rows(self, query, parameters):
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        pdfs = []
+        for row in rows:
+            pdf = {column: row[column] for column in PDF_METADATA_FIELDS}
+            for column in ("source", "text_around_link"):
+                pdf[column] = json.loads(pdf[column]) if pdf[column] else []
+            pdfs.append(pdf)
+        return pdfs
+
+    def pdfs(self, run_id):
+        return self._rows("SELECT * FROM pdfs WHERE run_id = ?", (run_id,))
+
+    def new_pdfs(self, old_run, new_run):
+        return self._rows(
+            "SELECT * FROM pdfs WHERE run_id = ? "
+            "AND url NOT IN (SELECT url FROM pdfs WHERE run_id = ?)",
+            (new_run, old_run),
+        )
+
+    def removed_pdfs(self, old_run, new_run):
+        return self.new_pdfs(new_run, old_run)
+
+    def changed_pdfs(self, old_run, new_run):
+        # PDFs of both runs whose content hash differs or, when a run has no
+        # hash for it, whose size, modification date or page count differs
+        return self._rows(
+            """
+            SELECT new.* FROM pdfs AS new
+            JOIN pdfs AS old ON old.run_id = ? AND old.url = new.url
+            WHERE new.run_id = ? AND CASE
+                WHEN old.content_hash IS NOT NULL AND new.content_hash IS NOT NULL
+                THEN old.content_hash != new.content_hash
+                ELSE old.file_size_kilobytes IS NOT new.file_size_kilobytes
+                    OR old.last_modified_date IS NOT new.last_modified_date
+                    OR old.number_of_pages IS NOT new.number_of_pages
+            END
+            """,
+            (old_run, new_run),
+        )
+
+    def changes(self, run_id):
+        # (new, changed, removed) PDFs of run_id against the previous run of
+        # its site, or None for the site's first run
+        previous = self.previous_run(run_id)
+        if previous is None:
+            return None
+        return (
+            self.new_pdfs(previous, run_id),
+            self.changed_pdfs(previous, run_id),
+            self.removed_pdfs(previous, run_id),
+        )
+
+    def sites(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT DISTINCT site FROM runs")
+            return [row["site"] for row in rows]
+
+    def export_csv(self, pdfs, output_path):
+        # Writes rows in the metadata CSV format. PDFs that weren't downloaded
+        # are left out since classifier.py needs their page counts.
+        with open(output_path, "w", newline="") as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=PDF_METADATA_FIELDS)
+            csv_writer.writeheader()
+            written = 0
+            for pdf in pdfs:
+                if pdf["number_of_pages"] is not None:
+                    csv_writer.writerow(pdf)
+                    written += 1
+        return written
+
+    def close(self):
+        self.connection.close()
+
+
+def export_pdfs(database, output_path, sites=None, changes_only=True):
+    # Writes the PDFs of the latest run of each site in the database, or of
+    # those matching the `sites` glob patterns, to one CSV for classifier.py.
+    # changes_only keeps the new and changed PDFs since each site's previous
+    # run, all PDFs of a site's first run are kept.
+    pdfs = []
+    for site in database.sites():
+        if sites and not any(fnmatch.fnmatch(site, pattern) for pattern in sites):
+            continue
+        run_id = database.latest_run(site)
+        if run_id is None:
+            continue
+        changes = database.changes(run_id) if changes_only else None
+        if changes is None:
+            pdfs.extend(database.pdfs(run_id))
+        else:
+            pdfs.extend(changes[0] + changes[1])
+    written = database.export_csv(pdfs, output_path)
+    tqdm.write(f"Exported {written} PDFs to {output_path}")
+    return pdfs
@@ -1,18 +1,50 @@
 import argparse
+import asyncio
+import atexit
+import bisect
+import contextlib
 import csv
+import email.utils
+import fnmatch
+import functools
+import hashlib
+import heapq
 import io
+import itertools
 import json
+import math
+import os
+import queue
+import random
 import re
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
 import urllib.parse
 import urllib.robotparser
+import zlib
+from array import array
 from collections import defaultdict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from datetime import datetime
+from xml.etree import ElementTree
 
+import pandas as pd
 import pymupdf
+import pypdf
 import requests
 import tldextract
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
+from bs4.dammit import EncodingDetector
+from lxml import etree
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
@@ -21,61 +53,893 @@ from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 from tqdm import tqdm
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    NameResolutionError,
+    NewConnectionError,
+)
+from urllib3.util import Retry, make_headers
+from urllib3.util.connection import allowed_gai_family
 
+from crawl_archive import ArchiveMiss, CrawlArchive, RecordingAdapter, ReplayAdapter
+from crawl_database import PDF_METADATA_FIELDS, CrawlDatabase, export_pdfs
+from shared_frontier import SharedFrontier
 
-def get_url(url, timeout=90, use_webdriver=False):
-    if use_webdriver:
-        options = Options()
-        options.add_argument("--headless")
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-dev-shm-usage")
-
-        service = Service("/usr/local/bin/geckodriver")
-        driver = webdriver.Firefox(service=service, options=options)
-        driver.get(url)
-
-        wait = WebDriverWait(driver, timeout)
-        next_button_xpath = (By.XPATH, "//*[text()='Next']")
-        atags = []
+REQUEST_TIMEOUT = 90
+# Number of hosts with cached connection pools, and keep-alive connections per host
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 16
+# Longest Retry-After, in seconds, that a retried request waits out
+MAX_RETRY_AFTER = 30
+
+
+class BoundedRetry(Retry):
+    # Caps the wait a Retry-After header asks for at MAX_RETRY_AFTER seconds
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, MAX_RETRY_AFTER)
+
+
+HTTP_RETRIES = BoundedRetry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    raise_on_status=False,
+)
+# With adaptive rate control, 429 and 503 responses are retried by
+# http_request instead, so the RateController sees every one of them.
+# urllib3 would still retry them when they carry a Retry-After header.
+THROTTLED_STATUSES = (429, 503)
+ADAPTIVE_HTTP_RETRIES = HTTP_RETRIES.new(
+    status_forcelist=tuple(
+        status
+        for status in HTTP_RETRIES.status_forcelist
+        if status not in THROTTLED_STATUSES
+    ),
+    respect_retry_after_header=False,
+)
+DNS_CACHE_TTL = 300
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+# With adaptive rate control, the interval between requests to a host starts at the
+# crawl delay and shrinks by RATE_STEP seconds after every normal response. A
+# 429 or 503, a failed request or a response slower than RATE_SLOW_FACTOR
+# times the host's average latency (and than RATE_SLOW_LATENCY) multiplies it
+# by RATE_BACKOFF instead. It never drops below the robots.txt crawl-delay.
+RATE_STEP = 0.1
+RATE_BACKOFF = 2
+RATE_MIN_BACKOFF_INTERVAL = 1
+RATE_MAX_INTERVAL = 60
+RATE_SLOW_FACTOR = 3
+RATE_SLOW_LATENCY = 1
+RATE_LATENCY_WEIGHT = 0.2
+# Long-lived browsers shared by webdriver crawls, each restarted after serving
+# WEBDRIVER_MAX_PAGES pages
+WEBDRIVER_POOL_SIZE = 2
+WEBDRIVER_MAX_PAGES = 100
+# Defaults of CrawlSettings: the LINK_PARSERS and URL_SEEN_SETS backends, and
+# the size in bytes and time in seconds after which PDF downloads are
+# abandoned
+LINK_PARSER = "lxml"
+URL_SEEN_SET = "fingerprint"
+MAX_PDF_SIZE = 1024 * 1024 * 1024
+MAX_PDF_SECONDS = 600
+# Child sitemaps fetched at once, and parsed entries buffered ahead of the crawl
+SITEMAP_WORKERS = 4
+SITEMAP_QUEUE_SIZE = 10000
+SITEMAP_CHUNK_SIZE = 64 * 1024
+# Weights of URL path and link text words when crawling best-first, words
+# common around document libraries raise a link's priority and words of
+# calendars, news and search pages lower it
+PRIORITY_KEYWORDS = {
+    **dict.fromkeys(
+        [
+            "agenda",
+            "agendas",
+            "budget",
+            "document",
+            "documents",
+            "download",
+            "downloads",
+            "file",
+            "files",
+            "form",
+            "forms",
+            "guide",
+            "guides",
+            "library",
+            "manual",
+            "minutes",
+            "notices",
+            "ordinances",
+            "pdf",
+            "plans",
+            "policies",
+            "publications",
+            "reports",
+            "resources",
+        ],
+        1.0,
+    ),
+    **dict.fromkeys(
+        [
+            "blog",
+            "calendar",
+            "event",
+            "events",
+            "gallery",
+            "login",
+            "news",
+            "photos",
+            "press",
+            "search",
+            "share",
+            "tag",
+            "tags",
+            "videos",
+        ],
+        -1.0,
+    ),
+}
+# Links whose URL doesn't end in .pdf are checked with concurrent HEAD requests
+# before the metadata pass, these content types leave them undecided
+RESOLVE_WORKERS = 8
+UNRESOLVED_CONTENT_TYPES = (
+    "",
+    "application/octet-stream",
+    "binary/octet-stream",
+    "application/download",
+    "application/force-download",
+    "application/x-download",
+)
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    key = (host, port, family, type, proto, flags)
+    now = time.monotonic()
+    with _dns_cache_lock:
+        cached = _dns_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    addresses = socket.getaddrinfo(host, port, family, type, proto, flags)
+    with _dns_cache_lock:
+        _dns_cache[key] = (now + DNS_CACHE_TTL, addresses)
+    return addresses
+
+
+class CachedDNSConnectionMixin:
+    # Resolves the host with _cached_getaddrinfo and connects to its addresses
+    # in turn. Certificates and SNI still use the host name.
+    def _new_conn(self):
+        host = self._dns_host
         try:
-            buttons = wait.until(EC.presence_of_all_elements_located(next_button_xpath))
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-            atags.extend(soup.find_all("a"))
+            addresses = _cached_getaddrinfo(
+                host.strip("[]"), self.port, allowed_gai_family(), socket.SOCK_STREAM
+            )
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        error = NewConnectionError(self, "getaddrinfo returned no addresses")
+        for *_, address in addresses:
+            self._dns_host = address[0]
+            try:
+                return super()._new_conn()
+            except ConnectTimeoutError as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
 
-            page_count = 0
-            while len(buttons) > 0:
-                tqdm.write(f"Paging through links on {url}: {page_count}")
-                buttons[0].click()
 
-                soup = BeautifulSoup(driver.page_source, "html.parser")
-                atags.extend(soup.find_all("a"))
-                page_count += 1
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """
+    Transport adapter whose connections cache DNS lookups for DNS_CACHE_TTL
+    seconds, leaving name resolution elsewhere in the process alone.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CachedDNSHTTPConnectionPool,
+            "https": CachedDNSHTTPSConnectionPool,
+        }
+
+
+class CrawlSettings:
+    """
+    Options set from the command line that change how pages and PDFs are
+    fetched, passed down to every function that needs them. archive_mode is
+    "record" to archive responses to archive_dir, or "replay" to read them
+    from it instead of the network.
+    """
+
+    def __init__(
+        self,
+        link_parser=LINK_PARSER,
+        seen_filter=URL_SEEN_SET,
+        adaptive_rate=False,
+        archive_dir=None,
+        archive_mode=None,
+        webdriver_pool_size=WEBDRIVER_POOL_SIZE,
+        max_pdf_size=MAX_PDF_SIZE,
+        max_pdf_seconds=MAX_PDF_SECONDS,
+    ):
+        self.link_parser = link_parser
+        self.seen_filter = seen_filter
+        self.adaptive_rate = adaptive_rate
+        self.archive_dir = archive_dir
+        self.archive_mode = archive_mode
+        self.webdriver_pool_size = webdriver_pool_size
+        self.max_pdf_size = max_pdf_size
+        self.max_pdf_seconds = max_pdf_seconds
+
+    def session(self):
+        return get_session(
+            self.archive_dir, self.archive_mode, retry_throttled=not self.adaptive_rate
+        )
+
+    def webdriver_pool(self):
+        return get_webdriver_pool(self.webdriver_pool_size)
+
+
+DEFAULT_SETTINGS = CrawlSettings()
+
+
+@functools.lru_cache(maxsize=None)
+def get_archive(directory):
+    return CrawlArchive(directory)
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(archive_dir=None, archive_mode=None, retry_throttled=True):
+    """
+    Returns the process-wide session every crawler request goes through. It
+    keeps connections alive per host, retries transient failures, negotiates
+    compressed responses and caches DNS lookups for DNS_CACHE_TTL seconds.
+    Responses are also archived to archive_dir, or only read from it,
+    following archive_mode. Without retry_throttled, 429 and 503 responses
+    are returned rather than retried.
+    """
+    adapter_args = {
+        "pool_connections": HTTP_POOL_CONNECTIONS,
+        "pool_maxsize": HTTP_POOL_MAXSIZE,
+        "max_retries": HTTP_RETRIES if retry_throttled else ADAPTIVE_HTTP_RETRIES,
+    }
+    if archive_mode == "replay":
+        adapter = ReplayAdapter(get_archive(archive_dir), **adapter_args)
+    else:
+        adapter = CachedDNSAdapter(**adapter_args)
+    if archive_mode == "record":
+        adapter = RecordingAdapter(get_archive(archive_dir), adapter)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Advertises brotli as well when the brotli package is installed
+    session.headers.update(make_headers(accept_encoding=True))
+    return session
+
+
+class CrawlMetrics:
+    """
+    Thread-safe telemetry of a crawl: request counts, status codes, latency
+    histograms and bytes transferred per host, time spent in each stage
+    (HTML parsing, politeness delays, webdriver fetches) and page and PDF
+    throughput.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.hosts = {}
+        self.stages = defaultdict(lambda: {"count": 0, "seconds": 0.0})
+        self.counters = defaultdict(int)
+
+    def _host(self, host):
+        # Call with the lock held
+        if host not in self.hosts:
+            self.hosts[host] = {
+                "requests": 0,
+                "statuses": defaultdict(int),
+                "bytes": 0,
+                "latency_seconds": 0.0,
+                "latency_buckets": [0] * len(LATENCY_BUCKETS),
+            }
+        return self.hosts[host]
+
+    def observe_request(self, url, status, seconds, size=0):
+        host = urllib.parse.urlsplit(url).netloc
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            stats = self._host(host)
+            stats["requests"] += 1
+            stats["statuses"][str(status)] += 1
+            stats["bytes"] += size
+            stats["latency_seconds"] += seconds
+            stats["latency_buckets"][bucket] += 1
+
+    def observe_bytes(self, url, size):
+        # Body bytes of a streamed response, counted as they are read
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            self._host(host)["bytes"] += size
+
+    def observe_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage]["count"] += 1
+            self.stages[stage]["seconds"] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.monotonic() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def counts(self):
+        # Plain copy of the raw counts, which another process can merge
+        with self.lock:
+            hosts = {
+                host: dict(
+                    stats,
+                    statuses=dict(stats["statuses"]),
+                    latency_buckets=list(stats["latency_buckets"]),
+                )
+                for host, stats in self.hosts.items()
+            }
+            return {
+                "hosts": hosts,
+                "stages": {stage: dict(stats) for stage, stats in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def merge(self, counts):
+        # Adds the counts() of another CrawlMetrics, e.g. a crawl worker's
+        with self.lock:
+            for host, other in counts["hosts"].items():
+                stats = self._host(host)
+                for key in ("requests", "bytes", "latency_seconds"):
+                    stats[key] += other[key]
+                for status, count in other["statuses"].items():
+                    stats["statuses"][status] += count
+                for bucket, count in enumerate(other["latency_buckets"]):
+                    stats["latency_buckets"][bucket] += count
+            for stage, other in counts["stages"].items():
+                self.stages[stage]["count"] += other["count"]
+                self.stages[stage]["seconds"] += other["seconds"]
+            for name, count in counts["counters"].items():
+                self.counters[name] += count
+
+    def snapshot(self):
+        # Histogram buckets are cumulative, keyed by their upper bound
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            hosts = {}
+            for host, stats in sorted(self.hosts.items()):
+                cumulative, buckets = 0, {}
+                for bound, count in zip(LATENCY_BUCKETS, stats["latency_buckets"]):
+                    cumulative += count
+                    buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+                hosts[host] = {
+                    "requests": stats["requests"],
+                    "statuses": dict(sorted(stats["statuses"].items())),
+                    "bytes": stats["bytes"],
+                    "latency_seconds": stats["latency_seconds"],
+                    "latency_buckets": buckets,
+                }
+            return {
+                "elapsed_seconds": elapsed,
+                "pages": self.counters["pages"],
+                "pdfs": self.counters["pdfs"],
+                "pages_per_second": self.counters["pages"] / elapsed,
+                "pdfs_per_second": self.counters["pdfs"] / elapsed,
+                "stages": {stage: dict(stats) for stage, stats in self.stages.items()},
+                "hosts": hosts,
+            }
+
+    def to_prometheus(self):
+        # Text exposition format, e.g. for the node_exporter textfile collector
+        snapshot = self.snapshot()
+        lines = [
+            "# TYPE crawler_elapsed_seconds gauge",
+            f"crawler_elapsed_seconds {snapshot['elapsed_seconds']}",
+            "# TYPE crawler_pages_total counter",
+            f"crawler_pages_total {snapshot['pages']}",
+            "# TYPE crawler_pdfs_total counter",
+            f"crawler_pdfs_total {snapshot['pdfs']}",
+            "# TYPE crawler_stage_seconds_total counter",
+        ]
+        for stage, stats in snapshot["stages"].items():
+            lines.append(
+                f'crawler_stage_seconds_total{{stage="{stage}"}} {stats["seconds"]}'
+            )
+        lines.append("# TYPE crawler_requests_total counter")
+        for host, stats in snapshot["hosts"].items():
+            for status, count in stats["statuses"].items():
+                labels = f'host="{host}",status="{status}"'
+                lines.append(f"crawler_requests_total{{{labels}}} {count}")
+        lines.append("# TYPE crawler_response_bytes_total counter")
+        for host, stats in snapshot["hosts"].items():
+            lines.append(
+                f'crawler_response_bytes_total{{host="{host}"}} {stats["bytes"]}'
+            )
+        lines.append("# TYPE crawler_request_duration_seconds histogram")
+        for host, stats in snapshot["hosts"].items():
+            for bound, count in stats["latency_buckets"].items():
+                labels = f'host="{host}",le="{bound}"'
+                lines.append(
+                    f"crawler_request_duration_seconds_bucket{{{labels}}} {count}"
+                )
+            lines.append(
+                f'crawler_request_duration_seconds_sum{{host="{host}"}} '
+                f'{stats["latency_seconds"]}'
+            )
+            lines.append(
+                f'crawler_request_duration_seconds_count{{host="{host}"}} '
+                f'{stats["requests"]}'
+            )
+        return "\n".join(lines) + "\n"
+
+
+@functools.lru_cache(maxsize=None)
+def get_metrics():
+    return CrawlMetrics()
+
+
+def parse_retry_after(value):
+    # Seconds to wait from a Retry-After header, given in seconds or as an
+    # HTTP date, or None when missing or unreadable
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateController:
+    """
+    Thread-safe adaptive politeness: keeps a request interval per host that
+    shrinks additively while the host answers quickly and grows
+    multiplicatively when it answers 429 or 503, fails, or slows down, and
+    hands out request slots spaced by that interval. A Retry-After header
+    holds off the host's next slot for as long as it asks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _host(self, url, delay=0):
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = {
+                "interval": delay,
+                "floor": 0,
+                "next_request": 0.0,
+                "latency": None,
+            }
+        return self.hosts[host]
+
+    def set_floor(self, url, seconds):
+        # The host's interval never goes below this, e.g. its crawl-delay
+        with self.lock:
+            state = self._host(url, seconds)
+            state["floor"] = seconds
+            state["interval"] = max(state["interval"], seconds)
+
+    def reserve(self, url, delay=0):
+        # Returns the seconds to wait before requesting url, delay is the
+        # starting interval of a host seen for the first time
+        with self.lock:
+            state = self._host(url, delay)
+            now = time.monotonic()
+            start = max(now, state["next_request"])
+            state["next_request"] = start + state["interval"]
+        return start - now
+
+    def observe(self, url, status, seconds, retry_after=None):
+        # status is the HTTP status, or "error" for a failed request
+        with self.lock:
+            state = self._host(url)
+            average = state["latency"]
+            slow = (
+                average is not None
+                and seconds > RATE_SLOW_LATENCY
+                and seconds > RATE_SLOW_FACTOR * average
+            )
+            if status in (429, 503, "error") or slow:
+                state["interval"] = min(
+                    RATE_MAX_INTERVAL,
+                    max(state["interval"] * RATE_BACKOFF, RATE_MIN_BACKOFF_INTERVAL),
+                )
+                get_metrics().count("rate_backoffs")
+            else:
+                state["interval"] = max(state["floor"], state["interval"] - RATE_STEP)
+            if status != "error":
+                if average is None:
+                    state["latency"] = seconds
+                else:
+                    state["latency"] = (
+                        1 - RATE_LATENCY_WEIGHT
+                    ) * average + RATE_LATENCY_WEIGHT * seconds
+            if retry_after is not None:
+                state["next_request"] = max(
+                    state["next_request"], time.monotonic() + retry_after
+                )
+
+    def intervals(self):
+        with self.lock:
+            return {host: state["interval"] for host, state in self.hosts.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def get_rate_controller():
+    return RateController()
+
+
+class HostPacer:
+    """
+    Thread-safe fixed politeness: hands out request slots per host spaced by
+    the delay, so every thread fetching from a host, sitemap readers
+    included, shares one schedule.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_request = defaultdict(float)
+
+    def reserve(self, url, delay):
+        # Returns the seconds to wait before requesting url
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request[host])
+            self.next_request[host] = start + delay
+        return start - now
+
+
+@functools.lru_cache(maxsize=None)
+def get_host_pacer():
+    return HostPacer()
+
+
+class MetricsReporter:
+    """
+    Writes snapshots of a CrawlMetrics as JSON, and optionally in the
+    Prometheus text format, every `interval` seconds from a background thread
+    and once more when stopped.
+    """
+
+    def __init__(self, metrics, path=None, interval=60, prometheus_path=None):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.prometheus_path = prometheus_path
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        # Replaces the files atomically so readers never see a partial dump
+        outputs = []
+        if self.path:
+            outputs.append((self.path, json.dumps(self.metrics.snapshot(), indent=4)))
+        if self.prometheus_path:
+            outputs.append((self.prometheus_path, self.metrics.to_prometheus()))
+        for path, text in outputs:
+            with open(f"{path}.tmp", "w") as f:
+                f.write(text)
+            os.replace(f"{path}.tmp", path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.write()
+
+
+def http_request(
+    method, url, timeout=REQUEST_TIMEOUT, settings=DEFAULT_SETTINGS, **kwargs
+):
+    # With adaptive rate control, 429 and 503 responses back the host off and
+    # are retried once the RateController hands out the host's next slot
+    for attempt in range(HTTP_RETRIES.total + 1):
+        response = _http_request_once(method, url, timeout, settings, **kwargs)
+        if (
+            not settings.adaptive_rate
+            or response.status_code not in THROTTLED_STATUSES
+            or attempt == HTTP_RETRIES.total
+        ):
+            return response
+        response.close()
+        wait_for_host(url, settings=settings)
+
+
+def _http_request_once(method, url, timeout, settings, **kwargs):
+    start = time.monotonic()
+    try:
+        response = settings.session().request(method, url, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        get_metrics().observe_request(url, "error", time.monotonic() - start)
+        if settings.adaptive_rate:
+            get_rate_controller().observe(url, "error", time.monotonic() - start)
+        raise
+    # Bytes read off the wire, before any content decoding. Streamed bodies
+    # haven't been read yet and are counted by iter_counted_content.
+    size = 0
+    if not kwargs.get("stream") and hasattr(response.raw, "tell"):
+        size = response.raw.tell()
+    get_metrics().observe_request(
+        url, response.status_code, time.monotonic() - start, size
+    )
+    if settings.adaptive_rate:
+        # Time to the response headers, streamed bodies are read later
+        get_rate_controller().observe(
+            url,
+            response.status_code,
+            time.monotonic() - start,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+    return response
+
+
+def iter_counted_content(response, chunk_size):
+    # iter_content counting each chunk in the host's bytes as it arrives, so
+    # downloads abandoned halfway only count what was transferred
+    for chunk in response.iter_content(chunk_size):
+        get_metrics().observe_bytes(response.url, len(chunk))
+        yield chunk
+
+
+def http_get(url, timeout=REQUEST_TIMEOUT, **kwargs):
+    return http_request("GET", url, timeout=timeout, **kwargs)
+
+
+def http_head(url, timeout=REQUEST_TIMEOUT, **kwargs):
+    # Unlike requests.head, redirects are followed
+    return http_request("HEAD", url, timeout=timeout, **kwargs)
+
+
+def wait_for_delay(delay):
+    if delay > 0:
+        with get_metrics().timed("delay"):
+            time.sleep(delay)
+
+
+def wait_for_host(url, delay=0, settings=DEFAULT_SETTINGS):
+    # Politeness wait before requesting url: the host's next slot, spaced by
+    # the fixed delay, or with adaptive rate control by the RateController's
+    # interval starting from delay
+    if settings.adaptive_rate:
+        delay = get_rate_controller().reserve(url, delay)
+    elif delay > 0:
+        delay = get_host_pacer().reserve(url, delay)
+    wait_for_delay(delay)
+
+
+def new_firefox_driver():
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+
+    service = Service("/usr/local/bin/geckodriver")
+    return webdriver.Firefox(service=service, options=options)
+
+
+class WebDriverPool:
+    """
+    Fixed-size pool of headless browsers handed out one fetch at a time.
+    Browsers are replaced after max_pages fetches or when a fetch raises an
+    error, and close() quits every browser still running.
+    """
+
+    def __init__(self, size=2, max_pages=100, factory=new_firefox_driver):
+        self.max_pages = max_pages
+        self.factory = factory
+        # Each slot is either an idle browser, a browser in use or a browser
+        # that hasn't been started yet
+        self.slots = threading.Semaphore(size)
+        self.idle = queue.LifoQueue()
+        self.pages_served = {}
+        self.closed = False
+
+    def _quit(self, driver):
+        self.pages_served.pop(driver, None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def driver(self):
+        self.slots.acquire()
+        try:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                driver = self.factory()
+                self.pages_served[driver] = 0
+
+            try:
+                yield driver
+            except Exception:
+                # Also urllib3 errors once geckodriver has died, the browser
+                # can't be trusted after any of them
+                self._quit(driver)
+                raise
+            except BaseException:
+                # KeyboardInterrupt and the like leave the browser usable
+                self.idle.put(driver)
+                raise
+
+            self.pages_served[driver] += 1
+            if self.closed or self.pages_served[driver] >= self.max_pages:
+                self._quit(driver)
+            else:
+                self.idle.put(driver)
+        finally:
+            self.slots.release()
 
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                self._quit(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+@functools.lru_cache(maxsize=None)
+def get_webdriver_pool(size=WEBDRIVER_POOL_SIZE):
+    pool = WebDriverPool(size=size, max_pages=WEBDRIVER_MAX_PAGES)
+    atexit.register(pool.close)
+    return pool
+
+
+def anchors_from_tags(atags):
+    return [(atag.get("href"), atag.get_text()) for atag in atags]
+
+
+def parse_anchors_html_parser(content):
+    soup = BeautifulSoup(content, "html.parser")
+    return anchors_from_tags(soup.find_all("a"))
+
+
+def detect_html_encoding(content):
+    # Same precedence as BeautifulSoup for the common cases: a declared
+    # charset, then UTF-8, then its full detection for anything else
+    declared = EncodingDetector.find_declared_encoding(content, is_html=True)
+    for encoding in (declared, "utf-8"):
+        if encoding:
+            try:
+                content.decode(encoding)
+                return encoding
+            except (UnicodeDecodeError, LookupError):
+                pass
+    return UnicodeDammit(content, is_html=True).original_encoding
+
+
+def parse_anchors_lxml(content):
+    # libxml2 builds the tree in C and only the <a> elements are visited, which
+    # is several times faster than BeautifulSoup's html.parser tree
+    try:
+        parser = etree.HTMLParser(encoding=detect_html_encoding(content))
+        root = etree.fromstring(content, parser)
+    except (etree.LxmlError, LookupError, TypeError, ValueError):
+        return parse_anchors_html_parser(content)
+    if root is None:
+        return []
+    return [(atag.get("href"), "".join(atag.itertext())) for atag in root.iter("a")]
+
+
+# Backends turning an HTML document into (href, text) pairs for its <a> tags
+LINK_PARSERS = {
+    "lxml": parse_anchors_lxml,
+    "html.parser": parse_anchors_html_parser,
+}
+
+
+def parse_anchors(content, parser=LINK_PARSER):
+    with get_metrics().timed("parse"):
+        return LINK_PARSERS[parser](content)
+
+
+def get_url(
+    url, timeout=REQUEST_TIMEOUT, use_webdriver=False, settings=DEFAULT_SETTINGS
+):
+    # Returns the (href, text) pairs of the page's <a> tags
+    if use_webdriver:
+        if settings.archive_mode == "replay":
+            # Browser fetches aren't archived, and would reach the live site
+            raise ArchiveMiss(f"Webdriver fetches aren't archived: {url}")
+        pool = settings.webdriver_pool()
+        with pool.driver() as driver, get_metrics().timed("webdriver"):
+            driver.get(url)
+
+            wait = WebDriverWait(driver, timeout)
+            next_button_xpath = (By.XPATH, "//*[text()='Next']")
+            atags = []
+            try:
                 buttons = wait.until(
                     EC.presence_of_all_elements_located(next_button_xpath)
                 )
-        except TimeoutException:
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-            atags.extend(soup.find_all("a"))
+                soup = BeautifulSoup(driver.page_source, "html.parser")
+                atags.extend(soup.find_all("a"))
 
-            driver.close()
-            driver.quit()
-            return atags
+                page_count = 0
+                while len(buttons) > 0:
+                    tqdm.write(f"Paging through links on {url}: {page_count}")
+                    buttons[0].click()
+
+                    soup = BeautifulSoup(driver.page_source, "html.parser")
+                    atags.extend(soup.find_all("a"))
+                    page_count += 1
+
+                    buttons = wait.until(
+                        EC.presence_of_all_elements_located(next_button_xpath)
+                    )
+            except TimeoutException:
+                soup = BeautifulSoup(driver.page_source, "html.parser")
+                atags.extend(soup.find_all("a"))
 
-        return atags
+            return anchors_from_tags(atags)
     else:
-        response = requests.get(url, timeout=timeout)
+        response = http_get(url, timeout=timeout, settings=settings)
         if response.status_code >= 400:
             return None
 
-        soup = BeautifulSoup(response.content, "html.parser")
-        atags = soup.find_all("a")
-        return atags
+        return parse_anchors(response.content, settings.link_parser)
 
 
-def get_config(url):
+def load_config():
     with open("config.json", "r") as f:
-        config = json.load(f)
+        return json.load(f)
+
+
+def get_config(url):
+    config = load_config()
 
     try:
         return config[url]
@@ -83,11 +947,18 @@ def get_config(url):
         raise Exception("URL provided not in config.json")
 
 
-def parse_robots_txt(url, manual_crawl_delay):
+def parse_robots_txt(url, manual_crawl_delay, settings=DEFAULT_SETTINGS):
     # Parse the site's robots.txt file
     rp = urllib.robotparser.RobotFileParser()
     rp.set_url(urllib.parse.urljoin(url, "robots.txt"))
-    rp.read()
+    # Mirrors RobotFileParser.read, but through the shared session
+    response = http_get(rp.url, settings=settings)
+    if response.status_code in (401, 403):
+        rp.disallow_all = True
+    elif 400 <= response.status_code < 500:
+        rp.allow_all = True
+    else:
+        rp.parse(response.text.splitlines())
 
     # TODO: For the sites above, there is only one. Make more flexible
     sitemap = urllib.parse.urljoin(url, "sitemap.xml")  # Default
@@ -96,24 +967,102 @@ def parse_robots_txt(url, manual_crawl_delay):
 
     if rp.crawl_delay("*"):
         manual_crawl_delay += int(rp.crawl_delay("*"))
+        # Adaptive rate control may speed up past the manual delay only
+        get_rate_controller().set_floor(url, int(rp.crawl_delay("*")))
     return sitemap, manual_crawl_delay
 
 
-def parse_sitemap(sitemap):
-    r = requests.get(sitemap)
-    soup = BeautifulSoup(r.text, "xml")
-    more_site_maps = [site.text for site in soup.find_all("loc")]
+def iter_sitemap_entries(sitemap, settings=DEFAULT_SETTINGS):
+    # Streams a sitemap or sitemap index, yielding ("sitemap", url) for child
+    # sitemaps and ("page", url) for pages without holding the whole document
+    # in memory
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    root = None
+
+    def entries():
+        nonlocal root
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            if event != "end":
+                continue
+            tag = element.tag.rpartition("}")[2]
+            if tag in ("url", "sitemap"):
+                loc = (element.findtext("{*}loc") or "").strip()
+                if loc:
+                    yield ("page" if tag == "url" else "sitemap"), loc
+                # Drop finished entries so memory stays flat on 50k URL files
+                root.clear()
+
+    with http_get(sitemap, stream=True, settings=settings) as r:
+        if r.status_code != 200:
+            tqdm.write(f"Could not fetch sitemap {sitemap}: {r.status_code}")
+            return
+        decompressor = None
+        for chunk in iter_counted_content(r, SITEMAP_CHUNK_SIZE):
+            if decompressor is None:
+                # requests only decodes a gzip Content-Encoding, .xml.gz files
+                # are usually served as plain gzip data
+                decompressor = chunk.startswith(b"\x1f\x8b") and zlib.decompressobj(
+                    16 + zlib.MAX_WBITS
+                )
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            parser.feed(chunk)
+            yield from entries()
+    parser.close()
+    yield from entries()
+
+
+def iter_sitemap(sitemaps, delay=0, workers=SITEMAP_WORKERS, settings=DEFAULT_SETTINGS):
+    # Yields every page listed in the sitemaps once, recursing through sitemap
+    # indexes. Child sitemaps are fetched concurrently, and pages are yielded
+    # as soon as they are parsed. Each fetch waits for its host like page
+    # fetches do, so sitemap and page requests share the host's delay.
+    entries = queue.Queue(maxsize=SITEMAP_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def read(sitemap):
+        try:
+            wait_for_host(sitemap, delay, settings)
+            for entry in iter_sitemap_entries(sitemap, settings):
+                if cancelled.is_set():
+                    break
+                entries.put(entry)
+        except (requests.RequestException, ElementTree.ParseError, zlib.error) as e:
+            tqdm.write(f"Could not read sitemap {sitemap}: {e}")
+        finally:
+            entries.put(None)
 
-    all_pages = set()
-    for site in more_site_maps:
-        if manual_crawl_delay:
-            time.sleep(manual_crawl_delay)
+    seen_sitemaps, seen_pages = set(), URLSeenSet()
+    pending = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
 
-        r = requests.get(site)
-        soup = BeautifulSoup(r.text, "xml")
-        all_pages.update([x.find("loc").text for x in soup.find_all("url")])
+        def submit(sitemap):
+            nonlocal pending
+            if sitemap not in seen_sitemaps:
+                seen_sitemaps.add(sitemap)
+                executor.submit(read, sitemap)
+                pending += 1
 
-    return all_pages
+        try:
+            for sitemap in sitemaps:
+                submit(sitemap)
+            while pending:
+                entry = entries.get()
+                if entry is None:
+                    pending -= 1
+                elif entry[0] == "sitemap":
+                    submit(entry[1])
+                elif entry[1] not in seen_pages:
+                    seen_pages.add(entry[1])
+                    yield entry[1]
+        finally:
+            # Unblock readers if the consumer stopped early
+            cancelled.set()
+            while pending:
+                if entries.get() is None:
+                    pending -= 1
 
 
 def remove_trailing_slash(url_string):
@@ -127,24 +1076,62 @@ def remove_trailing_slash(url_string):
     return urllib.parse.urlunparse(updated_url)
 
 
-def get_links(url, timeout=90, use_webdriver=False):
+def get_links_from_anchors(url, anchors):
+    links, link_texts = [], []
+    for href, text in anchors:
+        if href:
+            link_texts.append(text.strip())
+            if href.startswith("http"):
+                links.append(remove_trailing_slash(href))
+            else:
+                new_href = urllib.parse.urljoin(url, href)
+                links.append(remove_trailing_slash(new_href))
+    return links, link_texts
+
+
+def get_links_with_cache(
+    url, cache, timeout=REQUEST_TIMEOUT, settings=DEFAULT_SETTINGS
+):
+    # Conditional fetch: reuses the links extracted last time when the server
+    # answers 304 or sends back identical content
+    entry, headers = cache.revalidate(url, "links")
+    response = http_get(url, timeout=timeout, headers=headers, settings=settings)
+    if response.status_code == 304 and entry is not None:
+        return entry["links"]
+    if response.status_code >= 400:
+        return [], []
+
+    entry = cache.update(url, response, content=response.content)
+    if entry["links"] is not None:
+        return entry["links"]
+
+    anchors = parse_anchors(response.content, settings.link_parser)
+    links, link_texts = get_links_from_anchors(url, anchors)
+    cache.store_result(url, links=(links, link_texts))
+    return links, link_texts
+
+
+def get_links(
+    url,
+    timeout=REQUEST_TIMEOUT,
+    use_webdriver=False,
+    cache=None,
+    settings=DEFAULT_SETTINGS,
+):
     # Fetch the HTML content from a website
+    get_metrics().count("pages")
     try:
+        if cache is not None and not use_webdriver:
+            return get_links_with_cache(url, cache, timeout=timeout, settings=settings)
+
         # Parse HTML and retrieve all links
-        atags = get_url(url, timeout=timeout, use_webdriver=use_webdriver)
-        if not atags:
+        anchors = get_url(
+            url, timeout=timeout, use_webdriver=use_webdriver, settings=settings
+        )
+        if not anchors:
             return [], []
 
-        links, link_texts = [], []
-        for atag in atags:
-            if atag.get("href"):
-                href = atag.get("href")
-                link_texts.append(atag.get_text().strip())
-                if href.startswith("http"):
-                    links.append(remove_trailing_slash(href))
-                else:
-                    new_href = urllib.parse.urljoin(url, href)
-                    links.append(remove_trailing_slash(new_href))
+        links, link_texts = get_links_from_anchors(url, anchors)
     except:  # noqa:
         tqdm.write(f"Failed to get content: {url}")
         # TODO: Be explicit on errors
@@ -153,233 +1140,2391 @@ def get_links(url, timeout=90, use_webdriver=False):
     return links, link_texts
 
 
-def get_all_pages(all_pages, delay=0):
-    pdfs = defaultdict(list)
-    for page in tqdm(all_pages, ncols=100):
-        time.sleep(delay)
-        links, link_texts = get_links(page)
-        for link, text in zip(links, link_texts):
-            if link.endswith(".pdf") or re.search(r"\.cfm\?id=", link):
-                # Save the source and PDF location
-                pdfs[link].append({"source": page, "text": text})
-    return pdfs
+# Links treated as PDFs unless a site sets "pdf_patterns" in config.json
+DEFAULT_PDF_LINK_PATTERNS = [r"\.pdf$", r"\.cfm\?id=", r"/download$", r"/download/"]
+# Sitemap crawls only ever collected these
+SITEMAP_PDF_LINK_PATTERNS = [r"\.pdf$", r"\.cfm\?id="]
 
 
-def bfs_search_pdfs(
-    url,
-    allowable_domains,
-    allowable_subdomains=None,
-    delay=0,
-    max_depth=7,
-    timeout=90,
-    use_webdriver=False,
-):
-    # Restricts search to links sharing the same domain, capture all PDFs
-    # along the way
-    visited = set()  # Set to keep track of visited nodes
-    queue = deque([(url, max_depth)])  # Queue to store nodes to visit
-    pdfs = defaultdict(list)
+# Query parameters dropped from links unless a site sets its own
+# "strip_params"; a trailing * matches any parameter with that prefix
+DEFAULT_STRIP_PARAMS = [
+    "utm_*",
+    "fbclid",
+    "gclid",
+    "msclkid",
+    "mc_cid",
+    "mc_eid",
+    "sessionid",
+    "phpsessid",
+    "jsessionid",
+    "aspsessionid*",
+    "cfid",
+    "cftoken",
+]
+SESSION_PATH_PARAMS = re.compile(r";(?:jsessionid|phpsessid)=[^/?#]*", re.IGNORECASE)
+# Trap limits unless a site sets its own "traps" in config.json
+MAX_URLS_PER_PATTERN = 2000
+MAX_REPEATED_SEGMENTS = 2
 
-    pbar = tqdm(unit=" pages")
-    while queue:
-        node, depth = queue.popleft()  # Get the next node from the queue
-        pbar.update(1)
-        if node not in visited:
-            time.sleep(delay)
-            visited.add(node)  # Mark the node as visited
-            links, link_texts = get_links(
-                node, timeout=timeout, use_webdriver=use_webdriver
-            )
 
-            # Add the node's neighbors to the queue, if they share the same
-            # domain
-            for link, text in zip(links, link_texts):
-                new_domain = tldextract.extract(link).registered_domain
-                allowable = any(
-                    [(new_domain == domain) for domain in allowable_domains]
-                )
-                if allowable_subdomains:
-                    new_subdomain = tldextract.extract(link).subdomain
-                    matching_subdomains = any(
-                        [
-                            (new_subdomain == subdomain)
-                            for subdomain in allowable_subdomains
-                        ]
-                    )
-                    allowable = allowable and matching_subdomains
+class URLCanonicalizer:
+    """
+    Rewrites links so that variants of the same page share one URL: tracking
+    and session parameters are removed, the remaining query parameters are
+    sorted, the fragment is dropped and the scheme and host are lowercased.
+    Parameters are compared and sorted as written, without re-encoding them.
+    """
 
-                new_depth = depth - 1
-                if (
-                    link.endswith(".pdf")
-                    or re.search(r"\.cfm\?id=", link)
-                    or link.endswith("/download")
-                    or ("/download/" in link)
-                ):
-                    # Save pdfs
-                    pdfs[link].append({"source": node, "text": text})
-                elif (link not in visited) and allowable and (new_depth > 0):
-                    queue.append((link, new_depth))
+    def __init__(
+        self, strip_params=DEFAULT_STRIP_PARAMS, sort_query=True, drop_fragment=True
+    ):
+        self.strip_names = {p.lower() for p in strip_params if not p.endswith("*")}
+        self.strip_prefixes = tuple(
+            p.rstrip("*").lower() for p in strip_params if p.endswith("*")
+        )
+        self.sort_query = sort_query
+        self.drop_fragment = drop_fragment
 
-    pbar.close()
-    return pdfs, visited
+    def is_stripped(self, param):
+        name = urllib.parse.unquote_plus(param.split("=", 1)[0]).lower()
+        return name in self.strip_names or name.startswith(self.strip_prefixes)
 
+    def canonicalize(self, url):
+        parts = urllib.parse.urlsplit(url)
+        params = [p for p in parts.query.split("&") if p and not self.is_stripped(p)]
+        if self.sort_query:
+            params.sort()
+        return urllib.parse.urlunsplit(
+            (
+                parts.scheme.lower(),
+                parts.netloc.lower(),
+                SESSION_PATH_PARAMS.sub("", parts.path),
+                "&".join(params),
+                "" if self.drop_fragment else parts.fragment,
+            )
+        )
 
-# https://stackoverflow.com/questions/1094841/get-a-human-readable-version-of-a-file-size$0
-def convert_bytes(file_size):
-    for unit in ("", "KB", "MB", "GB", "TB", "PB", "EB", "ZB"):
-        if abs(file_size) < 1024.0:
-            return f"{file_size:3.1f}{unit}"
-        file_size /= 1024.0
-    return f"{file_size:.1f}YB"
 
+class TrapDetector:
+    """
+    Flags links that look like crawler traps: paths repeating a segment more
+    than max_repeated_segments times (/a/b/a/b/a/b), and every link past the
+    first max_urls_per_pattern sharing a pattern. A link's pattern is its host
+    and path with digit runs replaced, plus its sorted query parameter names,
+    so calendar pages like /events?month=2024-05 all share one. Either limit
+    can be set to None to turn it off.
+    """
 
-def get_images_and_tables(pages, min_width=100, min_height=100):
-    number_of_images, number_of_tables = 0, 0
-    for page in pages:
-        number_of_tables += len(page.find_tables().tables)
-        for image_info in page.get_image_info():
-            width, height = image_info["width"], image_info["height"]
-            if (width > min_width) and (height > min_height):
-                number_of_images += 1
-    return (number_of_images, number_of_tables)
+    def __init__(
+        self,
+        max_urls_per_pattern=MAX_URLS_PER_PATTERN,
+        max_repeated_segments=MAX_REPEATED_SEGMENTS,
+    ):
+        self.max_urls_per_pattern = max_urls_per_pattern
+        self.max_repeated_segments = max_repeated_segments
+        self.counts = defaultdict(int)
 
+    @staticmethod
+    def pattern(url):
+        parts = urllib.parse.urlsplit(url)
+        names = sorted({p.split("=", 1)[0] for p in parts.query.split("&") if p})
+        return parts.netloc, re.sub(r"\d+", "N", parts.path), tuple(names)
 
-def parse_pdf_date(date_string):
-    # Removes the timeszone information from the date string
-    if len(date_string) == 0:
-        return None
-    if date_string.startswith("D:"):
-        return datetime.strptime(date_string[2:16], "%Y%m%d%H%M%S")
-    return datetime.strptime(date_string[:16], "%Y%m%d%H%M%S")
+    def has_repeated_segments(self, url):
+        if self.max_repeated_segments is None:
+            return False
+        segments = defaultdict(int)
+        for segment in urllib.parse.urlsplit(url).path.split("/"):
+            if segment:
+                segments[segment] += 1
+        return max(segments.values(), default=0) > self.max_repeated_segments
 
+    def is_trap(self, url):
+        # Call once per distinct URL, every call counts towards its pattern
+        if self.has_repeated_segments(url):
+            get_metrics().count("traps")
+            return True
+        if self.max_urls_per_pattern is None:
+            return False
+        pattern = self.pattern(url)
+        self.counts[pattern] += 1
+        if self.counts[pattern] <= self.max_urls_per_pattern:
+            return False
+        if self.counts[pattern] == self.max_urls_per_pattern + 1:
+            tqdm.write(
+                f"Skipping links like {url}: over {self.max_urls_per_pattern} "
+                "links share this pattern"
+            )
+        get_metrics().count("traps")
+        return True
 
-def get_pdf_metadata(pdfs, output_path):
-    with open(output_path, "w", newline="") as csv_file:
-        csv_writer = csv.DictWriter(
-            csv_file,
-            fieldnames=[
-                "file_name",
-                "url",
-                "file_size",
-                "file_size_kilobytes",
-                "last_modified_date",
-                "author",
-                "subject",
-                "keywords",
-                "creation_date",
-                "producer",
-                "number_of_pages",
-                "number_of_tables",
-                "number_of_images",
-                "version",
-                "source",
-                "text_around_link",
-            ],
-        )
-        csv_writer.writeheader()
-        for pdf_url in tqdm(pdfs.keys(), ncols=100):
-            source = list(set([dat["source"] for dat in pdfs[pdf_url]]))
-            texts = list(set([dat["text"] for dat in pdfs[pdf_url]]))
 
-            url_parsed = urllib.parse.urlparse(pdf_url)
-            default_file_name = url_parsed.path.split("/")[-1]
-            if len(default_file_name) == 0:
-                default_file_name = url_parsed.netloc.split("\\")[-1]
+class ScopeMatcher:
+    """
+    Classifies links for a site as a PDF candidate, an in-scope page or out of
+    scope. Built once per crawl: the PDF patterns are compiled into a single
+    regular expression and host lookups in the public suffix list are memoized.
+    Links are classified as found, then rewritten by the optional
+    URLCanonicalizer, and the optional TrapDetector filters new pages.
+    """
 
-            try:
-                headers = {
-                    "Content-Type": "application/pdf",
-                    "Content-Disposition": "inline",
-                }
-                response = requests.get(
-                    url=pdf_url, timeout=90, headers=headers, allow_redirects=True
-                )
-                if response.status_code < 400:
-                    with io.BytesIO(response.content) as mem_obj:
-                        try:
-                            pdf_file = pymupdf.Document(stream=mem_obj)
-                            # tqdm.write(f"Reading: {pdf_url}")
-                            file_name = default_file_name
-                            pdf_title = pdf_file.metadata.get("title")
-                            if pdf_title and (len(pdf_title.strip()) > 0):
-                                file_name = pdf_title
-                            file_bytes = mem_obj.getbuffer().nbytes
-                            n_images, n_tables = get_images_and_tables(pdf_file.pages())
-                            modified = parse_pdf_date(pdf_file.metadata.get("modDate"))
-                            created = parse_pdf_date(
-                                pdf_file.metadata.get("creationDate")
-                            )
+    PDF = "pdf"
+    PAGE = "page"
+    OUT_OF_SCOPE = "out_of_scope"
 
-                            row = {
-                                "file_name": file_name,
-                                "url": pdf_url,
-                                "file_size": convert_bytes(file_bytes),
-                                "file_size_kilobytes": file_bytes / 1024,
-                                "last_modified_date": modified,
-                                "author": pdf_file.metadata.get("author"),
-                                "subject": pdf_file.metadata.get("subject"),
-                                "keywords": pdf_file.metadata.get("keywords"),
-                                "creation_date": created,
-                                "producer": pdf_file.metadata.get("producer"),
-                                "number_of_pages": pdf_file.page_count,
-                                "number_of_tables": n_tables,
-                                "number_of_images": n_images,
-                                # TODO: This is consistent with current behavior, but
-                                # pdf_file.version_count might be more appropriate
-                                "version": pdf_file.metadata.get("format"),
-                                "source": source,
-                                "text_around_link": texts,
-                            }
-                            csv_writer.writerow(row)
-                        except pymupdf.FileDataError:  # noqa:
-                            tqdm.write(f"Document isn't a PDF: {pdf_url}")
-                            continue
-            except:  # noqa
-                tqdm.write(f"Error reading: {pdf_url}")
-                continue
+    def __init__(
+        self,
+        allowable_domains,
+        allowable_subdomains=None,
+        pdf_patterns=DEFAULT_PDF_LINK_PATTERNS,
+        canonicalizer=None,
+        traps=None,
+    ):
+        self.allowable_domains = frozenset(allowable_domains)
+        self.allowable_subdomains = (
+            frozenset(allowable_subdomains) if allowable_subdomains else None
+        )
+        self.pdf_link = re.compile("|".join(f"(?:{p})" for p in pdf_patterns))
+        self._hosts = {}
+        self.canonicalizer = canonicalizer
+        self.traps = traps
 
-    return None
+    @classmethod
+    def from_config(cls, config, pdf_patterns=DEFAULT_PDF_LINK_PATTERNS):
+        # "canonicalize" and "traps" hold URLCanonicalizer and TrapDetector
+        # arguments, or false to turn them off for the site
+        allowable_domains = [
+            tldextract.extract(link).registered_domain for link in config["allow_list"]
+        ]
+        canonicalize = config.get("canonicalize", {})
+        traps = config.get("traps", {})
+        return cls(
+            allowable_domains,
+            allowable_subdomains=config.get("allow_subdomains"),
+            pdf_patterns=config.get("pdf_patterns", pdf_patterns),
+            canonicalizer=(
+                URLCanonicalizer(**canonicalize) if canonicalize is not False else None
+            ),
+            traps=TrapDetector(**traps) if traps is not False else None,
+        )
 
+    def split_host(self, link):
+        # Returns the (registered domain, subdomain) of the link's host
+        host = urllib.parse.urlsplit(link).netloc
+        if host not in self._hosts:
+            extracted = tldextract.extract(host)
+            self._hosts[host] = (extracted.registered_domain, extracted.subdomain)
+        return self._hosts[host]
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Starts crawl from provided URL")
-    parser.add_argument("url", help="Starting URL")
-    parser.add_argument("--delay", type=float, default=0, help="Delay between requests")
-    parser.add_argument(
-        "output_path", help="Path where a CSV with PDF information will be saved"
+    def is_pdf_link(self, link):
+        return self.pdf_link.search(link) is not None
+
+    def is_in_scope(self, link):
+        domain, subdomain = self.split_host(link)
+        if domain not in self.allowable_domains:
+            return False
+        return (
+            self.allowable_subdomains is None or subdomain in self.allowable_subdomains
+        )
+
+    def canonicalize(self, link):
+        if self.canonicalizer is None:
+            return link
+        return self.canonicalizer.canonicalize(link)
+
+    def classify(self, link):
+        if self.is_pdf_link(link):
+            return self.PDF
+        if self.is_in_scope(link):
+            return self.PAGE
+        return self.OUT_OF_SCOPE
+
+    def split_links(self, links, link_texts, visited, new_depth):
+        # Returns the (link, new_depth) children worth queueing, the
+        # (link, text) PDF links found on a page and the (link, text) anchors
+        # of the children, all with links canonicalized
+        children, pdf_links, child_texts = [], [], []
+        for link, text in zip(links, link_texts):
+            # Classify before canonicalizing, sorting the query could hide a
+            # PDF pattern like .cfm?id=
+            kind = self.classify(link)
+            if kind == self.OUT_OF_SCOPE:
+                continue
+            link = self.canonicalize(link)
+            if kind == self.PDF:
+                pdf_links.append((link, text))
+            elif (link not in visited) and (new_depth > 0):
+                children.append((link, new_depth))
+                child_texts.append((link, text))
+        return children, pdf_links, child_texts
+
+
+class URLSeenSet:
+    """
+    Set of URLs kept as 64-bit fingerprints in an open addressing table,
+    about 16 bytes per URL instead of a full string in a Python set. Two URLs
+    only collide with a probability of about n^2 / 2^65.
+    """
+
+    def __init__(self, urls=(), capacity=1024):
+        # capacity must be a power of two, empty slots hold 0
+        self.table = array("Q", bytes(8 * capacity))
+        self.size = 0
+        self.update(urls)
+
+    @staticmethod
+    def fingerprint(url):
+        digest = hashlib.blake2b(url.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little") or 1
+
+    def _slot(self, fingerprint):
+        mask = len(self.table) - 1
+        slot = fingerprint & mask
+        while self.table[slot] not in (0, fingerprint):
+            slot = (slot + 1) & mask
+        return slot
+
+    def _fingerprints(self):
+        return (fingerprint for fingerprint in self.table if fingerprint)
+
+    def __contains__(self, url):
+        return self.table[self._slot(self.fingerprint(url))] != 0
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, URLSeenSet):
+            return set(self._fingerprints()) == set(other._fingerprints())
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(url in self for url in other)
+        return NotImplemented
+
+    def add(self, url):
+        fingerprint = self.fingerprint(url)
+        slot = self._slot(fingerprint)
+        if self.table[slot] == 0:
+            self.table[slot] = fingerprint
+            self.size += 1
+            # Keep the table at most 2/3 full so probe sequences stay short
+            if 3 * self.size > 2 * len(self.table):
+                fingerprints = self.table
+                self.table = array("Q", bytes(16 * len(fingerprints)))
+                for fingerprint in fingerprints:
+                    if fingerprint:
+                        self.table[self._slot(fingerprint)] = fingerprint
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+
+class BloomFilter:
+    """
+    Approximate set of URLs taking about 1.8 bytes per URL at a 0.1% false
+    positive rate. A false positive makes the crawl skip a URL it has not
+    seen, so it is only an opt-in alternative to URLSeenSet for the queued
+    URLs of very large crawls. Filters of doubling capacity and halving
+    error rate are chained as it fills, keeping the overall error rate below
+    twice error_rate.
+    """
+
+    def __init__(self, urls=(), capacity=1 << 20, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Each filter is a [bits, number of bits, number of hashes, free slots]
+        self.filters = []
+        self.size = 0
+        self.update(urls)
+
+    def _add_filter(self):
+        capacity = self.capacity << len(self.filters)
+        error_rate = self.error_rate / 2 ** (len(self.filters) + 1)
+        bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = math.ceil(-math.log2(error_rate))
+        bits = bytearray((bit_count + 7) // 8)
+        self.filters.append([bits, bit_count, hash_count, capacity])
+
+    @staticmethod
+    def _positions(url, bit_count, hash_count):
+        # Double hashing of a single 128-bit digest
+        digest = hashlib.blake2b(url.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little")
+        return [(first + i * second) % bit_count for i in range(hash_count)]
+
+    def __contains__(self, url):
+        for bits, bit_count, hash_count, _ in self.filters:
+            for position in self._positions(url, bit_count, hash_count):
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self.size
+
+    def add(self, url):
+        if url in self:
+            return
+        if not self.filters or self.filters[-1][3] == 0:
+            self._add_filter()
+        bloom_filter = self.filters[-1]
+        bits, bit_count, hash_count, _ = bloom_filter
+        for position in self._positions(url, bit_count, hash_count):
+            bits[position >> 3] |= 1 << (position & 7)
+        bloom_filter[3] -= 1
+        self.size += 1
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+
+# Structures remembering the URLs already queued by a recursive crawl
+URL_SEEN_SETS = {"fingerprint": URLSeenSet, "bloom": BloomFilter}
+
+
+def new_seen_set(urls=(), kind=URL_SEEN_SET):
+    return URL_SEEN_SETS[kind](urls)
+
+
+class CrawlState:
+    """
+    SQLite checkpoint of a crawl: the frontier with remaining depths, the
+    visited pages and every PDF link found so far. Each visited page is
+    committed in a single transaction, so an interrupted crawl can resume
+    from the last page it finished.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS frontier (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    depth INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS frontier_url ON frontier (url);
+                CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS pdfs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    text TEXT NOT NULL
+                );
+                """
+            )
+
+    def is_empty(self):
+        query = (
+            "SELECT EXISTS (SELECT 1 FROM frontier) OR EXISTS (SELECT 1 FROM visited)"
+        )
+        return not self.connection.execute(query).fetchone()[0]
+
+    def reset(self, seeds=()):
+        with self.connection:
+            self.connection.execute("DELETE FROM frontier")
+            self.connection.execute("DELETE FROM visited")
+            self.connection.execute("DELETE FROM pdfs")
+            self.connection.executemany(
+                "INSERT INTO frontier (url, depth) VALUES (?, ?)", seeds
+            )
+
+    def load(self):
+        frontier = self.connection.execute(
+            "SELECT url, depth FROM frontier ORDER BY id"
+        ).fetchall()
+        visited = URLSeenSet(
+            row[0] for row in self.connection.execute("SELECT url FROM visited")
+        )
+        pdfs = defaultdict(list)
+        for pdf_url, source, text in self.connection.execute(
+            "SELECT url, source, text FROM pdfs ORDER BY id"
+        ):
+            pdfs[pdf_url].append({"source": source, "text": text})
+        return frontier, visited, pdfs
+
+    def mark_visited(self, url, children=(), pdf_links=()):
+        # children are (url, depth) pairs, pdf_links are (url, text) pairs
+        with self.connection:
+            self.connection.execute("DELETE FROM frontier WHERE url = ?", (url,))
+            self.connection.execute(
+                "INSERT OR IGNORE INTO visited (url) VALUES (?)", (url,)
+            )
+            self.connection.executemany(
+                "INSERT INTO frontier (url, depth) VALUES (?, ?)", children
+            )
+            self.connection.executemany(
+                "INSERT INTO pdfs (url, source, text) VALUES (?, ?, ?)",
+                [(pdf_url, url, text) for pdf_url, text in pdf_links],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+# Seconds an idle distributed worker waits before polling the shared queue
+# again
+POLL_INTERVAL = 1
+
+
+class ValidatorCache:
+    """
+    Persistent HTTP validator cache shared across crawls. Stores the ETag,
+    Last-Modified and content hash of each URL along with the links extracted
+    from the page or the metadata read from the PDF, so a re-crawl can send
+    conditional requests and reuse those results when nothing changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS http_cache (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    links TEXT,
+                    analysis TEXT
+                )
+                """
+            )
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, content_hash, links, analysis "
+                "FROM http_cache WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, links, analysis = row
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_hash": content_hash,
+            "links": tuple(json.loads(links)) if links else None,
+            "analysis": json.loads(analysis) if analysis else None,
+        }
+
+    def revalidate(self, url, result):
+        # Returns the cached entry and conditional request headers, only when
+        # the entry holds a reusable result ("links" or "analysis")
+        entry = self.lookup(url)
+        if entry is None or entry[result] is None:
+            return None, {}
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return entry, {}
+        return entry, headers
+
+    def update(self, url, response, content=None, content_hash=None):
+        # Records the validators of a fresh response. Cached results are kept
+        # only when the content hash shows the body didn't change. Streamed
+        # bodies pass the hash they computed instead of the content.
+        if content_hash is None and content:
+            content_hash = hashlib.sha256(content).hexdigest()
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO http_cache (url, etag, last_modified, content_hash)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    links = CASE WHEN content_hash IS excluded.content_hash
+                        AND excluded.content_hash IS NOT NULL THEN links END,
+                    analysis = CASE WHEN content_hash IS excluded.content_hash
+                        AND excluded.content_hash IS NOT NULL THEN analysis END,
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    content_hash = excluded.content_hash
+                """,
+                (
+                    url,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    content_hash,
+                ),
+            )
+        return self.lookup(url)
+
+    def store_result(self, url, links=None, analysis=None):
+        with self.lock, self.connection:
+            if links is not None:
+                self.connection.execute(
+                    "UPDATE http_cache SET links = ? WHERE url = ?",
+                    (json.dumps(links), url),
+                )
+            if analysis is not None:
+                self.connection.execute(
+                    "UPDATE http_cache SET analysis = ? WHERE url = ?",
+                    (json.dumps(analysis, default=str), url),
+                )
+
+    def close(self):
+        self.connection.close()
+
+
+class PDFLinkLog:
+    """
+    JSON Lines file with one {"url", "source", "text"} record per PDF link,
+    appended and flushed as each page is crawled so the links can be consumed
+    before the crawl finishes. Pages are logged before they are checkpointed,
+    so a resumed crawl may repeat the records of the page it was on.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, "a" if append else "w")
+
+    def write(self, source, pdf_links):
+        for pdf_url, text in pdf_links:
+            record = {"url": pdf_url, "source": source, "text": text}
+            self.file.write(json.dumps(record) + "\n")
+        if pdf_links:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_crawl_state(state, seeds, resume=False):
+    # Returns the frontier, visited set and pdfs to start a crawl from
+    if state is None:
+        return list(seeds), URLSeenSet(), defaultdict(list)
+    if resume and not state.is_empty():
+        frontier, visited, pdfs = state.load()
+        tqdm.write(
+            f"Resuming crawl: {len(visited)} pages visited, "
+            f"{len(frontier)} queued, {len(pdfs)} PDFs found"
+        )
+        return frontier, visited, pdfs
+    state.reset(seeds)
+    return list(seeds), URLSeenSet(), defaultdict(list)
+
+
+def get_all_pages(
+    all_pages,
+    delay=0,
+    state=None,
+    resume=False,
+    cache=None,
+    pdf_patterns=None,
+    links_log=None,
+    budget=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # all_pages may be a lazy iterator such as iter_sitemap. Sitemap pages are
+    # not queued in the checkpoint, resuming re-reads the sitemap and skips
+    # the pages already visited.
+    pdf_link = re.compile(
+        "|".join(f"(?:{p})" for p in pdf_patterns or SITEMAP_PDF_LINK_PATTERNS)
     )
-    args = parser.parse_args()
+    _, visited, pdfs = load_crawl_state(state, [], resume=resume)
+    for page in tqdm(all_pages, ncols=100):
+        if page in visited:
+            continue
+        if budget_exhausted(budget):
+            break
+        wait_for_host(page, delay, settings)
+        visited.add(page)
+        if budget is not None:
+            budget.spend()
+        links, link_texts = get_links(page, cache=cache, settings=settings)
+        pdf_links = []
+        for link, text in zip(links, link_texts):
+            if pdf_link.search(link):
+                # Save the source and PDF location
+                pdfs[link].append({"source": page, "text": text})
+                pdf_links.append((link, text))
+        if links_log is not None:
+            links_log.write(page, pdf_links)
+        if state is not None:
+            state.mark_visited(page, pdf_links=pdf_links)
+    return pdfs, visited
+
+
+def link_words(url, text=""):
+    # Same tokens the classifier derives from URL paths and link text
+    words = re.split("[^a-zA-Z]", urllib.parse.urlparse(url).path)
+    words += re.split("[^a-zA-Z]", text)
+    return {word.lower() for word in words if word}
+
+
+class PriorityFrontier:
+    """
+    Best-first replacement for the BFS queue. Links are popped by a score
+    summing PRIORITY_KEYWORDS weights over their URL path and anchor text
+    words, plus log(1 + number of PDFs linked from the page they were found
+    on). Ties go to the link with the most depth remaining, then to the
+    oldest, so a site without any signal is still crawled breadth first.
+    """
+
+    def __init__(self, frontier=()):
+        self.heap = []
+        self.counter = itertools.count()
+        for node, depth in frontier:
+            self.push(node, depth)
+
+    def push(self, node, depth, text="", pdf_yield=0):
+        score = sum(PRIORITY_KEYWORDS.get(word, 0) for word in link_words(node, text))
+        score += math.log1p(pdf_yield)
+        heapq.heappush(self.heap, (-score, -depth, next(self.counter), node))
+
+    def extend(self, children, anchor_texts=None, pdf_yield=0):
+        anchor_texts = anchor_texts or {}
+        for node, depth in children:
+            self.push(node, depth, anchor_texts.get(node, ""), pdf_yield)
+
+    def popleft(self):
+        _, depth, _, node = heapq.heappop(self.heap)
+        return node, -depth
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class CrawlBudget:
+    """
+    Optional per-site limits on the number of pages fetched and on the time
+    spent crawling, counted from when the budget is created.
+    """
+
+    def __init__(self, max_pages=None, max_seconds=None):
+        self.max_pages = max_pages
+        self.max_seconds = max_seconds
+        self.started = time.monotonic()
+        self.pages = 0
+
+    def spend(self, pages=1):
+        self.pages += pages
+
+    def remaining_pages(self):
+        if self.max_pages is None:
+            return None
+        return max(0, self.max_pages - self.pages)
+
+    def exhausted(self):
+        if self.max_pages is not None and self.pages >= self.max_pages:
+            return True
+        return (
+            self.max_seconds is not None
+            and time.monotonic() - self.started >= self.max_seconds
+        )
+
+
+def budget_exhausted(budget):
+    if budget is not None and budget.exhausted():
+        tqdm.write(f"Crawl budget exhausted after {budget.pages} pages")
+        return True
+    return False
+
+
+def dedup_children(children, queued, traps=None):
+    # Drops the (url, depth) children already queued and records the others,
+    # new children flagged by the TrapDetector are recorded but not returned
+    new_children = []
+    for child in children:
+        if child[0] not in queued:
+            queued.add(child[0])
+            if traps is None or not traps.is_trap(child[0]):
+                new_children.append(child)
+    return new_children
+
+
+def bfs_search_pdfs(
+    url,
+    allowable_domains,
+    allowable_subdomains=None,
+    delay=0,
+    max_depth=7,
+    timeout=REQUEST_TIMEOUT,
+    use_webdriver=False,
+    concurrency=1,
+    per_host_concurrency=2,
+    state=None,
+    resume=False,
+    cache=None,
+    scope=None,
+    links_log=None,
+    priority=False,
+    budget=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Restricts search to links sharing the same domain, capture all PDFs
+    # along the way. When a CrawlState is given, progress is checkpointed
+    # after every page and resume=True continues from the last checkpoint.
+    # A ScopeMatcher may be passed instead of the allowable domains, and PDF
+    # links are also appended to links_log as they are found. priority=True
+    # crawls best-first with a PriorityFrontier, serially, and a CrawlBudget
+    # stops the crawl once it runs out.
+    if scope is None:
+        scope = ScopeMatcher(allowable_domains, allowable_subdomains)
+    if concurrency > 1 and not priority:
+        return asyncio.run(
+            bfs_search_pdfs_async(
+                url,
+                allowable_domains,
+                allowable_subdomains=allowable_subdomains,
+                delay=delay,
+                max_depth=max_depth,
+                timeout=timeout,
+                use_webdriver=use_webdriver,
+                concurrency=concurrency,
+                per_host_concurrency=per_host_concurrency,
+                state=state,
+                resume=resume,
+                cache=cache,
+                scope=scope,
+                links_log=links_log,
+                budget=budget,
+                settings=settings,
+            )
+        )
+
+    frontier, visited, pdfs = load_crawl_state(state, [(url, max_depth)], resume=resume)
+    # Queue to store nodes to visit
+    queue = PriorityFrontier(frontier) if priority else deque(frontier)
+    # Pages are queued once, so the queue grows with unique URLs rather than
+    # with every link pointing at them
+    queued = new_seen_set((node for node, _ in frontier), settings.seen_filter)
+
+    pbar = tqdm(unit=" pages")
+    while queue and not budget_exhausted(budget):
+        node, depth = queue.popleft()  # Get the next node from the queue
+        pbar.update(1)
+        if node not in visited:
+            wait_for_host(node, delay, settings)
+            visited.add(node)  # Mark the node as visited
+            if budget is not None:
+                budget.spend()
+            links, link_texts = get_links(
+                node,
+                timeout=timeout,
+                use_webdriver=use_webdriver,
+                cache=cache,
+                settings=settings,
+            )
+
+            # Add the node's neighbors to the queue, if they share the same
+            # domain, and save pdfs
+            children, pdf_links, child_texts = scope.split_links(
+                links, link_texts, visited, depth - 1
+            )
+            children = dedup_children(children, queued, scope.traps)
+            for link, text in pdf_links:
+                pdfs[link].append({"source": node, "text": text})
+            if priority:
+                queue.extend(children, dict(child_texts), pdf_yield=len(pdf_links))
+            else:
+                queue.extend(children)
+            if links_log is not None:
+                links_log.write(node, pdf_links)
+            if state is not None:
+                state.mark_visited(node, children=children, pdf_links=pdf_links)
+
+    pbar.close()
+    return pdfs, visited
+
+
+class HostLimiter:
+    """
+    Caps the number of in-flight requests per host and spaces the start of
+    consecutive requests to the same host by at least `delay` seconds, or by
+    the RateController's interval with adaptive_rate.
+    """
+
+    def __init__(self, per_host_concurrency=2, delay=0, adaptive_rate=False):
+        self.per_host_concurrency = per_host_concurrency
+        self.delay = delay
+        self.adaptive_rate = adaptive_rate
+        self._semaphores = {}
+        self._locks = {}
+        self._next_request = defaultdict(float)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, url, global_limit=None):
+        # The delay is only reserved once global_limit is also held, so
+        # requests queued behind other hosts can't start back to back
+        host = urllib.parse.urlparse(url).netloc
+        semaphore = self._semaphores.setdefault(
+            host, asyncio.Semaphore(self.per_host_concurrency)
+        )
+        async with semaphore, global_limit or contextlib.nullcontext():
+            if self.adaptive_rate:
+                wait = get_rate_controller().reserve(url, self.delay)
+                if wait > 0:
+                    get_metrics().observe_stage("delay", wait)
+                    await asyncio.sleep(wait)
+            elif self.delay:
+                async with self._locks.setdefault(host, asyncio.Lock()):
+                    loop = asyncio.get_running_loop()
+                    wait = self._next_request[host] - loop.time()
+                    if wait > 0:
+                        get_metrics().observe_stage("delay", wait)
+                        await asyncio.sleep(wait)
+                    self._next_request[host] = loop.time() + self.delay
+            yield
+
+
+async def bfs_search_pdfs_async(
+    url,
+    allowable_domains,
+    allowable_subdomains=None,
+    delay=0,
+    max_depth=7,
+    timeout=REQUEST_TIMEOUT,
+    use_webdriver=False,
+    concurrency=8,
+    per_host_concurrency=2,
+    state=None,
+    resume=False,
+    cache=None,
+    scope=None,
+    links_log=None,
+    budget=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Same search as bfs_search_pdfs, but every page of a BFS level is fetched
+    # concurrently. Levels are still processed in order so each page is
+    # visited with the largest remaining depth, exactly as the serial BFS does.
+    # Pages left over when a CrawlBudget runs out stay in the checkpoint.
+    if scope is None:
+        scope = ScopeMatcher(allowable_domains, allowable_subdomains)
+    frontier, visited, pdfs = load_crawl_state(state, [(url, max_depth)], resume=resume)
+    queued = new_seen_set((node for node, _ in frontier), settings.seen_filter)
+
+    global_limit = asyncio.Semaphore(concurrency)
+    host_limiter = HostLimiter(
+        per_host_concurrency=per_host_concurrency,
+        delay=delay,
+        adaptive_rate=settings.adaptive_rate,
+    )
+    loop = asyncio.get_running_loop()
+
+    pbar = tqdm(unit=" pages")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def fetch(node, depth):
+            async with host_limiter.limit(node, global_limit):
+                if budget is not None:
+                    if budget.exhausted():
+                        return node, depth, None
+                    budget.spend()
+                visited.add(node)
+                result = await loop.run_in_executor(
+                    executor,
+                    functools.partial(
+                        get_links,
+                        node,
+                        timeout=timeout,
+                        use_webdriver=use_webdriver,
+                        cache=cache,
+                        settings=settings,
+                    ),
+                )
+            pbar.update(1)
+            return node, depth, result
+
+        while frontier and not budget_exhausted(budget):
+            # A resumed frontier may span two depths, keep the first occurrence
+            # of each page since it has the most depth remaining
+            level = {}
+            for node, depth in frontier:
+                if node not in visited:
+                    level.setdefault(node, depth)
+
+            frontier, results = [], {}
+            for fetched in asyncio.as_completed(
+                [fetch(node, depth) for node, depth in level.items()]
+            ):
+                node, depth, result = await fetched
+                if result is None:
+                    continue
+                links, link_texts = result
+                children, pdf_links, _ = scope.split_links(
+                    links, link_texts, visited, depth - 1
+                )
+                results[node] = (children, pdf_links)
+                if links_log is not None:
+                    links_log.write(node, pdf_links)
+
+            # Merge in level order so results match the serial crawl. Pages
+            # are checkpointed here, once their children are deduped and
+            # trap-filtered, so an interrupted level is fetched again.
+            for node in level:
+                if node not in results:
+                    continue
+                children, pdf_links = results.pop(node)
+                for link, text in pdf_links:
+                    pdfs[link].append({"source": node, "text": text})
+                children = dedup_children(children, queued, scope.traps)
+                if state is not None:
+                    state.mark_visited(node, children=children, pdf_links=pdf_links)
+                frontier.extend(children)
+
+    pbar.close()
+    return pdfs, visited
+
+
+def crawl_worker(
+    queue_path,
+    config=None,
+    worker=None,
+    timeout=REQUEST_TIMEOUT,
+    cache_path=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Crawls pages from a SharedFrontier until none are queued or in flight on
+    # any worker, and returns the number of pages this worker visited. The
+    # site's config is looked up from the URL the queue was seeded with unless
+    # given.
+    # Forked workers must not reuse the parent's pooled connections or browsers
+    get_session.cache_clear()
+    get_webdriver_pool.cache_clear()
+    frontier = SharedFrontier(queue_path)
+    site = frontier.settings()
+    if config is None:
+        config = get_config(site["url"])
+    scope = ScopeMatcher.from_config(config)
+    use_webdriver = config.get("use_webdriver", False)
+    cache = ValidatorCache(cache_path) if cache_path else None
+    if worker is None:
+        worker = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    # Skips writing links this worker already sent to the queue
+    queued = new_seen_set(kind=settings.seen_filter)
+
+    pages = 0
+    try:
+        while True:
+            claimed = frontier.claim(
+                worker,
+                per_host_concurrency=site["per_host_concurrency"],
+                delay=site["delay"],
+            )
+            if claimed is None:
+                if not frontier.pending():
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            (node, depth), wait = claimed
+            wait_for_delay(wait)
+            links, link_texts = get_links(
+                node,
+                timeout=timeout,
+                use_webdriver=use_webdriver,
+                cache=cache,
+                settings=settings,
+            )
+            children, pdf_links, _ = scope.split_links(links, link_texts, (), depth - 1)
+            children = dedup_children(children, queued, scope.traps)
+            frontier.complete(node, worker, children=children, pdf_links=pdf_links)
+            pages += 1
+    finally:
+        frontier.close()
+        if cache is not None:
+            cache.close()
+        # atexit handlers don't run in pool worker processes
+        settings.webdriver_pool().close()
+    return pages
+
+
+def _crawl_worker_process(
+    queue_path, config=None, cache_path=None, settings=DEFAULT_SETTINGS
+):
+    # Returns the pages visited and the metrics counts of this process only,
+    # rather than the copy of the parent's metrics it was forked with
+    get_metrics.cache_clear()
+    pages = crawl_worker(queue_path, config, cache_path=cache_path, settings=settings)
+    return pages, get_metrics().counts()
+
+
+def run_crawl_workers(
+    queue_path, workers, config=None, cache_path=None, settings=DEFAULT_SETTINGS
+):
+    # Runs crawl_worker in this many processes and returns the pages visited.
+    # Each worker's metrics are merged into this process's when it exits.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _crawl_worker_process, queue_path, config, cache_path, settings
+            )
+            for _ in range(workers)
+        ]
+        pages = 0
+        for future in futures:
+            worker_pages, counts = future.result()
+            get_metrics().merge(counts)
+            pages += worker_pages
+        return pages
+
+
+def crawl_distributed(
+    url,
+    queue_path,
+    workers=4,
+    config=None,
+    delay=0,
+    max_depth=7,
+    per_host_concurrency=2,
+    resume=False,
+    cache_path=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Seeds a SharedFrontier with the site, unless resuming a queue that
+    # already holds it, crawls it with worker processes on this machine and
+    # returns the merged (pdfs, visited). More worker processes on the same
+    # machine can join with `crawl-worker <queue_path>` while it runs.
+    frontier = SharedFrontier(queue_path)
+    if not resume or frontier.is_empty():
+        site = {
+            "url": url,
+            "delay": delay,
+            "per_host_concurrency": per_host_concurrency,
+        }
+        frontier.reset([(url, max_depth)], settings=site)
+    # Workers open their own connections, don't fork with one open
+    frontier.close()
+
+    pages = run_crawl_workers(
+        queue_path, workers, config=config, cache_path=cache_path, settings=settings
+    )
+    tqdm.write(f"Local workers visited {pages} pages")
+    frontier = SharedFrontier(queue_path)
+    try:
+        return frontier.load(visited=URLSeenSet())
+    finally:
+        frontier.close()
+
+
+# https://stackoverflow.com/questions/1094841/get-a-human-readable-version-of-a-file-size$0
+def convert_bytes(file_size):
+    for unit in ("", "KB", "MB", "GB", "TB", "PB", "EB", "ZB"):
+        if abs(file_size) < 1024.0:
+            return f"{file_size:3.1f}{unit}"
+        file_size /= 1024.0
+    return f"{file_size:.1f}YB"
+
+
+def get_images_and_tables(pages, min_width=100, min_height=100):
+    number_of_images, number_of_tables = 0, 0
+    for page in pages:
+        number_of_tables += len(page.find_tables().tables)
+        for image_info in page.get_image_info():
+            width, height = image_info["width"], image_info["height"]
+            if (width > min_width) and (height > min_height):
+                number_of_images += 1
+    return (number_of_images, number_of_tables)
+
+
+def has_ruling_lines(page):
+    # The default find_tables strategy builds tables from vector lines and
+    # rectangles, so pages without any can't contain a detectable table
+    return any(
+        item[0] in ("l", "re", "qu")
+        for path in page.get_cdrawings()
+        for item in path["items"]
+    )
+
+
+def census_images_and_tables(
+    pdf_file, max_pages=None, time_budget=None, min_width=100, min_height=100
+):
+    """
+    Fast alternative to get_images_and_tables for long documents. Images are
+    counted once per page they appear on, like get_images_and_tables, but
+    from the page resources, which avoids parsing page contents. Table detection is skipped on pages without ruling lines;
+    for documents longer than max_pages it only runs on a sample of pages, and
+    it stops once time_budget seconds have passed. In both cases the table
+    count is extrapolated to the whole document.
+
+    Returns (number_of_images, number_of_tables, estimated).
+    """
+    started = time.monotonic()
+    number_of_images = 0
+    for page in pdf_file.pages():
+        for image in page.get_images():
+            width, height = image[2], image[3]
+            if (width > min_width) and (height > min_height):
+                number_of_images += 1
+
+    page_numbers = list(range(pdf_file.page_count))
+    # Shuffle deterministically so a sample or a time cut-off spreads across
+    # the whole document rather than favoring its first pages
+    random.Random(pdf_file.page_count).shuffle(page_numbers)
+    if max_pages is not None:
+        page_numbers = page_numbers[:max_pages]
+
+    number_of_tables, pages_read = 0, 0
+    for page_number in page_numbers:
+        if time_budget is not None and time.monotonic() - started > time_budget:
+            break
+        page = pdf_file[page_number]
+        if has_ruling_lines(page):
+            number_of_tables += len(page.find_tables().tables)
+        pages_read += 1
+
+    if pages_read == pdf_file.page_count:
+        return number_of_images, number_of_tables, False
+    scale = pdf_file.page_count / max(pages_read, 1)
+    return number_of_images, round(number_of_tables * scale), True
+
+
+def parse_pdf_date(date_string):
+    # Removes the timeszone information from the date string
+    if len(date_string) == 0:
+        return None
+    if date_string.startswith("D:"):
+        return datetime.strptime(date_string[2:16], "%Y%m%d%H%M%S")
+    return datetime.strptime(date_string[:16], "%Y%m%d%H%M%S")
+
+
+# PDFs larger than PDF_SPOOL_SIZE bytes are downloaded to a temporary file
+# rather than memory. Downloads over the max_pdf_size bytes or
+# max_pdf_seconds of the CrawlSettings are abandoned and recorded with a
+# download_status in a separate .skipped.csv, since classifier.py needs
+# every row's page count. The time limit is checked between chunks, and a
+# read that stalls is cut off by the read timeout from pdf_timeout.
+PDF_SPOOL_SIZE = 32 * 1024 * 1024
+PDF_CHUNK_SIZE = 64 * 1024
+
+
+def pdf_timeout(settings):
+    # (connect, read) timeout of PDF downloads, a single read can't wait
+    # longer than the download is allowed to take
+    if not settings.max_pdf_seconds:
+        return REQUEST_TIMEOUT
+    return REQUEST_TIMEOUT, min(REQUEST_TIMEOUT, settings.max_pdf_seconds)
+
+
+def has_image_and_table_counts(analysis):
+    return analysis is not None and analysis["number_of_tables"] is not None
+
+
+class PDFContent:
+    """
+    Downloaded PDF body with its SHA-256 digest and size. Bodies up to
+    PDF_SPOOL_SIZE bytes are kept in memory, larger ones in a named temporary
+    file that analyze_pdf opens directly, so analysis processes are sent a
+    path rather than the bytes. Closing it removes the file.
+    """
+
+    def __init__(self, data=None, path=None, digest=None, size=0):
+        self.data = data
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data=data, digest=hashlib.sha256(data).hexdigest(), size=len(data))
+
+    def open_document(self):
+        if self.path is not None:
+            return pymupdf.open(self.path, filetype="pdf")
+        return pymupdf.Document(stream=self.data)
+
+    def close(self):
+        if self.path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def skipped_pdf_analysis(download_status, size):
+    # Row columns of a PDF that wasn't analyzed, size is the announced size or
+    # the bytes read before the download was abandoned
+    analysis = dict.fromkeys(PDF_METADATA_FIELDS)
+    for column in ("file_name", "url", "source", "text_around_link", "duplicate_of"):
+        del analysis[column]
+    analysis.update(
+        title=None,
+        file_size=convert_bytes(size),
+        file_size_kilobytes=size / 1024,
+        download_status=download_status,
+    )
+    return analysis
+
+
+def spool_pdf(response, max_size=None, max_seconds=None):
+    # Streams a PDF response into a PDFContent, returning (content, None) or,
+    # past max_size bytes or max_seconds, (None, analysis) recording why the
+    # download was skipped or cut short. Limits default to MAX_PDF_SIZE and
+    # MAX_PDF_SECONDS, 0 disables them.
+    max_size = MAX_PDF_SIZE if max_size is None else max_size
+    max_seconds = MAX_PDF_SECONDS if max_seconds is None else max_seconds
+    length = response.headers.get("Content-Length", "")
+    if max_size and length.isdigit() and int(length) > max_size:
+        return None, skipped_pdf_analysis("skipped_too_large", int(length))
+
+    started = time.monotonic()
+    digest, size = hashlib.sha256(), 0
+    chunks, spool = [], None
+    try:
+        for chunk in iter_counted_content(response, PDF_CHUNK_SIZE):
+            size += len(chunk)
+            if max_size and size > max_size:
+                return None, skipped_pdf_analysis("truncated_too_large", size)
+            if max_seconds and time.monotonic() - started > max_seconds:
+                return None, skipped_pdf_analysis("truncated_timeout", size)
+            digest.update(chunk)
+            if spool is None and size > PDF_SPOOL_SIZE:
+                spool = tempfile.NamedTemporaryFile(prefix="crawler-", delete=False)
+                spool.writelines(chunks)
+                chunks = None
+            if spool is None:
+                chunks.append(chunk)
+            else:
+                spool.write(chunk)
+        if spool is None:
+            data = b"".join(chunks)
+            return PDFContent(data=data, digest=digest.hexdigest(), size=size), None
+        spool.close()
+        content = PDFContent(path=spool.name, digest=digest.hexdigest(), size=size)
+        spool = None
+        return content, None
+    except requests.ConnectionError:
+        # A stalled read cut off by the read timeout from pdf_timeout
+        if max_seconds and time.monotonic() - started >= max_seconds:
+            return None, skipped_pdf_analysis("truncated_timeout", size)
+        raise
+    finally:
+        # Set unless the body was spooled completely
+        if spool is not None:
+            spool.close()
+            os.remove(spool.name)
+
+
+def download_pdf(pdf_url, cache=None, settings=DEFAULT_SETTINGS):
+    # Returns (content, analysis): the PDFContent of a PDF that still needs
+    # analyzing, the cached analysis of a PDF that hasn't changed, or the
+    # analysis recording a download over the size or time limit. Both are
+    # None if the server refused the request.
+    headers = {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": "inline",
+    }
+    entry = None
+    if cache is not None:
+        entry, conditional_headers = cache.revalidate(pdf_url, "analysis")
+        if has_image_and_table_counts(entry and entry["analysis"]):
+            headers.update(conditional_headers)
+        else:
+            entry = None
+
+    with http_get(
+        pdf_url,
+        headers=headers,
+        allow_redirects=True,
+        stream=True,
+        timeout=pdf_timeout(settings),
+        settings=settings,
+    ) as response:
+        if response.status_code == 304 and entry is not None:
+            return None, entry["analysis"]
+        if response.status_code >= 400:
+            return None, None
+        content, skipped = spool_pdf(
+            response, settings.max_pdf_size, settings.max_pdf_seconds
+        )
+    if content is None:
+        return None, skipped
 
-    config = get_config(args.url)
-    allow_list = config["allow_list"]
-    allowable_subdomains = config.get("allow_subdomains")
+    if cache is not None:
+        entry = cache.update(pdf_url, response, content_hash=content.digest)
+        if has_image_and_table_counts(entry["analysis"]):
+            content.close()
+            return None, entry["analysis"]
+    return content, None
+
+
+def fetch_pdf(pdf_url, metadata_only=False, cache=None, settings=DEFAULT_SETTINGS):
+    # Download stage of the metadata pass, returns (content, analysis) like
+    # download_pdf
+    wait_for_host(pdf_url, settings=settings)
+    if metadata_only:
+        return None, inspect_pdf(pdf_url, cache=cache, settings=settings)
+    return download_pdf(pdf_url, cache=cache, settings=settings)
+
+
+def analyze_pdf(content, count_images_and_tables=True, census=None):
+    # Reads the CSV columns stored in the PDF itself. Kept free of crawler state
+    # so it can run in a worker process. census holds the max_pages and
+    # time_budget arguments of census_images_and_tables; without it every page
+    # is scanned with get_images_and_tables. content is a PDFContent.
+    with content.open_document() as pdf_file:
+        file_bytes = content.size
+        n_images, n_tables, estimated = None, None, None
+        if count_images_and_tables and census is not None:
+            n_images, n_tables, estimated = census_images_and_tables(pdf_file, **census)
+        elif count_images_and_tables:
+            n_images, n_tables = get_images_and_tables(pdf_file.pages())
+            estimated = False
+        return {
+            "title": pdf_file.metadata.get("title"),
+            "file_size": convert_bytes(file_bytes),
+            "file_size_kilobytes": file_bytes / 1024,
+            "last_modified_date": parse_pdf_date(pdf_file.metadata.get("modDate")),
+            "author": pdf_file.metadata.get("author"),
+            "subject": pdf_file.metadata.get("subject"),
+            "keywords": pdf_file.metadata.get("keywords"),
+            "creation_date": parse_pdf_date(pdf_file.metadata.get("creationDate")),
+            "producer": pdf_file.metadata.get("producer"),
+            "number_of_pages": pdf_file.page_count,
+            "number_of_tables": n_tables,
+            "number_of_images": n_images,
+            # TODO: This is consistent with current behavior, but
+            # pdf_file.version_count might be more appropriate
+            "version": pdf_file.metadata.get("format"),
+            "counts_estimated": estimated,
+        }
+
+
+class RangeRequestsUnsupported(Exception):
+    pass
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read-only file over a remote document that downloads the blocks being read
+    with HTTP Range requests. Raises RangeRequestsUnsupported when the server
+    stops honoring ranges or more than max_requests would be needed.
+    """
+
+    def __init__(
+        self,
+        url,
+        size,
+        head=b"",
+        block_size=64 * 1024,
+        max_requests=8,
+        settings=DEFAULT_SETTINGS,
+    ):
+        self.url = url
+        self.settings = settings
+        self.size = size
+        self.block_size = block_size
+        self.max_requests = max_requests
+        self.requests = 0
+        self.position = 0
+        self.blocks = {}
+        # Only whole blocks of the head can be reused
+        head = io.BytesIO(head)
+        for block in range(len(head.getbuffer()) // block_size):
+            self.blocks[block] = head.read(block_size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+
+        first, last = self.position // self.block_size, (end - 1) // self.block_size
+        missing = [
+            block for block in range(first, last + 1) if block not in self.blocks
+        ]
+        if missing:
+            self._fetch(missing[0], missing[-1])
+
+        data = b"".join(self.blocks[block] for block in range(first, last + 1))
+        count = end - self.position
+        start = self.position - first * self.block_size
+        buffer[:count] = data[start:][:count]
+        self.position = end
+        return count
+
+    def _fetch(self, first, last):
+        self.requests += 1
+        if self.requests > self.max_requests:
+            raise RangeRequestsUnsupported(f"Too many range requests: {self.url}")
+
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
+        response = http_get(
+            self.url,
+            headers={"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"},
+            settings=self.settings,
+        )
+        if response.status_code != 206 or len(response.content) != end - start + 1:
+            raise RangeRequestsUnsupported(f"Range request refused: {self.url}")
+        content = io.BytesIO(response.content)
+        for block in range(first, last + 1):
+            self.blocks[block] = content.read(self.block_size)
+
+
+def inspect_pdf(pdf_url, block_size=64 * 1024, cache=None, settings=DEFAULT_SETTINGS):
+    # Metadata-only analysis: reads the trailer, Info dictionary and page tree
+    # through Range requests, and falls back to a full download when the server
+    # doesn't support ranges or the document can't be read lazily. Image and
+    # table counts are left empty unless they come from the cache.
+    headers = {"Range": f"bytes=0-{block_size - 1}", "Accept-Encoding": "identity"}
+    entry = None
+    if cache is not None:
+        entry, conditional_headers = cache.revalidate(pdf_url, "analysis")
+        headers.update(conditional_headers)
+
+    with http_get(
+        pdf_url,
+        headers=headers,
+        stream=True,
+        timeout=pdf_timeout(settings),
+        settings=settings,
+    ) as response:
+        if response.status_code == 304 and entry is not None:
+            return entry["analysis"]
+        if response.status_code >= 400:
+            return None
+
+        content, analysis = None, None
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and re.match(
+            r"bytes \d+-\d+/\d+$", content_range
+        ):
+            size = int(content_range.split("/")[-1])
+            get_metrics().observe_bytes(response.url, len(response.content))
+            pdf_file = HTTPRangeFile(
+                pdf_url,
+                size,
+                head=response.content,
+                block_size=block_size,
+                settings=settings,
+            )
+            try:
+                analysis = analyze_pdf_lazily(pdf_file)
+                if cache is not None:
+                    cache.update(pdf_url, response)
+            except Exception:
+                pass
+            if analysis is None:
+                content, analysis = download_pdf(
+                    pdf_url, cache=cache, settings=settings
+                )
+        elif response.status_code == 206:
+            content, analysis = download_pdf(pdf_url, cache=cache, settings=settings)
+        else:
+            # The server ignored the range and is sending the whole document
+            content, analysis = spool_pdf(
+                response, settings.max_pdf_size, settings.max_pdf_seconds
+            )
+            if cache is not None and content is not None:
+                entry = cache.update(pdf_url, response, content_hash=content.digest)
+                analysis = entry["analysis"]
+
+    if content is not None:
+        with content:
+            if analysis is None:
+                analysis = analyze_pdf(content, count_images_and_tables=False)
+    if (
+        cache is not None
+        and analysis is not None
+        and not analysis.get("download_status")
+    ):
+        cache.store_result(pdf_url, analysis=analysis)
+    return analysis
+
+
+def analyze_pdf_lazily(pdf_file):
+    # Produces the same columns as analyze_pdf(count_images_and_tables=False)
+    # with pypdf, which only reads the parts of the file it needs. Lenient mode
+    # validates every object offset, touching the whole file, so malformed
+    # documents raise here and inspect_pdf falls back to a full download.
+    reader = pypdf.PdfReader(pdf_file, strict=True)
+    metadata = reader.metadata or pypdf.DocumentInformation()
+    return {
+        "title": metadata.title or "",
+        "file_size": convert_bytes(pdf_file.size),
+        "file_size_kilobytes": pdf_file.size / 1024,
+        "last_modified_date": parse_pdf_date(metadata.modification_date_raw or ""),
+        "author": metadata.author or "",
+        "subject": metadata.subject or "",
+        "keywords": metadata.keywords or "",
+        "creation_date": parse_pdf_date(metadata.creation_date_raw or ""),
+        "producer": metadata.producer or "",
+        # len(reader.pages) would load every page object
+        "number_of_pages": int(reader.root_object["/Pages"]["/Count"]),
+        "number_of_tables": None,
+        "number_of_images": None,
+        "version": reader.pdf_header.replace("%PDF-", "PDF "),
+        "counts_estimated": None,
+    }
+
+
+def build_pdf_row(pdf_url, links, analysis, duplicate_of=None):
+    source = list(set([dat["source"] for dat in links]))
+    texts = list(set([dat["text"] for dat in links]))
+
+    url_parsed = urllib.parse.urlparse(pdf_url)
+    file_name = url_parsed.path.split("/")[-1]
+    if len(file_name) == 0:
+        file_name = url_parsed.netloc.split("\\")[-1]
+    analysis = dict(analysis)
+    pdf_title = analysis.pop("title")
+    if pdf_title and (len(pdf_title.strip()) > 0):
+        file_name = pdf_title
+
+    return {
+        "file_name": file_name,
+        "url": pdf_url,
+        **analysis,
+        "source": source,
+        "text_around_link": texts,
+        "duplicate_of": duplicate_of,
+    }
+
+
+def has_pdf_path(url):
+    return urllib.parse.urlsplit(url).path.lower().endswith(".pdf")
+
+
+def is_pdf_response(response):
+    # True for a PDF, False for anything else and None when the headers don't
+    # tell, e.g. a generic binary type
+    content_type = response.headers.get("Content-Type", "").split(";")[0]
+    content_type = content_type.strip().lower()
+    disposition = response.headers.get("Content-Disposition", "")
+    if (
+        content_type == "application/pdf"
+        or re.search(r"filename\*?=[^;]*\.pdf\b", disposition, re.IGNORECASE)
+        or has_pdf_path(response.url)
+    ):
+        return True
+    if content_type in UNRESOLVED_CONTENT_TYPES:
+        return None
+    return False
+
+
+@functools.lru_cache(maxsize=100_000)
+def resolve_pdf_link(pdf_url, delay=0, settings=DEFAULT_SETTINGS):
+    # Classifies a link with a HEAD request, or with a one byte Range GET on
+    # servers that refuse HEAD. Links that can't be checked resolve to None.
+    # Each request first waits for the host like the crawl's own requests.
+    try:
+        wait_for_host(pdf_url, delay, settings)
+        response = http_head(pdf_url, settings=settings)
+        if response.status_code < 400:
+            return is_pdf_response(response)
+        headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+        wait_for_host(pdf_url, delay, settings)
+        with http_get(
+            pdf_url, headers=headers, stream=True, settings=settings
+        ) as response:
+            if response.status_code >= 400:
+                # The download would fail the same way
+                return False
+            return is_pdf_response(response)
+    except requests.RequestException:
+        return None
+
+
+def resolve_pdf_links(
+    pdfs,
+    workers=RESOLVE_WORKERS,
+    delay=0,
+    per_host_concurrency=2,
+    settings=DEFAULT_SETTINGS,
+):
+    # Drops the PDF links whose URL doesn't end in .pdf, such as /download or
+    # .cfm?id= links, once concurrent HEAD requests show they aren't PDFs. At
+    # most per_host_concurrency checks are in flight per host, each waiting
+    # for the site's delay.
+    ambiguous = [pdf_url for pdf_url in pdfs if not has_pdf_path(pdf_url)]
+    if workers <= 0 or not ambiguous:
+        return pdfs
+    host_limits = {
+        urllib.parse.urlsplit(pdf_url).netloc: threading.Semaphore(per_host_concurrency)
+        for pdf_url in ambiguous
+    }
+
+    def resolve(pdf_url):
+        with host_limits[urllib.parse.urlsplit(pdf_url).netloc]:
+            return resolve_pdf_link(pdf_url, delay, settings)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        resolved = dict(
+            zip(
+                ambiguous,
+                tqdm(executor.map(resolve, ambiguous), total=len(ambiguous)),
+            )
+        )
+    not_pdfs = {pdf_url for pdf_url, is_pdf in resolved.items() if is_pdf is False}
+    tqdm.write(f"Links that aren't PDFs: {len(not_pdfs)} of {len(ambiguous)} checked")
+    return {
+        pdf_url: links for pdf_url, links in pdfs.items() if pdf_url not in not_pdfs
+    }
+
+
+def sibling_path(output_path, suffix):
+    # Path of a file written next to the CSV output, e.g. pdfs.csv becomes
+    # pdfs.skipped.csv. Output paths without .csv get the suffix appended.
+    return os.path.splitext(str(output_path))[0] + suffix
+
+
+@contextlib.contextmanager
+def report_pdf_errors(pdf_url):
+    try:
+        yield
+    except pymupdf.FileDataError:
+        tqdm.write(f"Document isn't a PDF: {pdf_url}")
+    except Exception:
+        tqdm.write(f"Error reading: {pdf_url}")
+
+
+def get_pdf_metadata(
+    pdfs,
+    output_path,
+    download_workers=1,
+    analysis_workers=1,
+    metadata_only=False,
+    cache=None,
+    census=None,
+    database=None,
+    run_id=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # With more than one worker, downloads run in a thread pool while PyMuPDF
+    # analysis runs in a process pool, and rows are written as they complete.
+    # metadata_only inspects PDFs with Range requests and skips image and
+    # table counts. A ValidatorCache reuses the analysis of unchanged PDFs, and
+    # census switches image and table counts to census_images_and_tables.
+    # Rows are also added to run_id of a CrawlDatabase when one is given.
+    # PDFs that weren't downloaded are written to the .skipped.csv sibling
+    # of output_path.
+    skipped_path = sibling_path(output_path, ".skipped.csv")
+    with open(output_path, "w", newline="") as csv_file, open(
+        skipped_path, "w", newline=""
+    ) as skipped_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=PDF_METADATA_FIELDS)
+        csv_writer.writeheader()
+        skipped_writer = csv.DictWriter(skipped_file, fieldnames=PDF_METADATA_FIELDS)
+        skipped_writer.writeheader()
+
+        def write_row(row, content_hash=None):
+            # Flushed right away so the CSV can be read while the pass runs
+            if row.get("download_status"):
+                skipped_writer.writerow(row)
+                skipped_file.flush()
+            else:
+                csv_writer.writerow(row)
+                csv_file.flush()
+            get_metrics().count("pdfs")
+            if database is not None:
+                if content_hash is None and cache is not None:
+                    # PDFs that didn't need downloading
+                    entry = cache.lookup(row["url"])
+                    content_hash = entry and entry["content_hash"]
+                database.add_pdf(run_id, row, content_hash=content_hash)
+
+        if download_workers <= 1 and analysis_workers <= 1:
+            # Content hash -> (first URL with that content, its analysis)
+            analyzed = {}
+            for pdf_url in tqdm(pdfs.keys(), ncols=100):
+                with report_pdf_errors(pdf_url):
+                    content, analysis = fetch_pdf(
+                        pdf_url,
+                        metadata_only=metadata_only,
+                        cache=cache,
+                        settings=settings,
+                    )
+                    duplicate_of, digest = None, None
+                    if content is not None:
+                        digest = content.digest
+                        with content:
+                            if digest not in analyzed:
+                                analysis = analyze_pdf(content, census=census)
+                                analyzed[digest] = (pdf_url, analysis)
+                            else:
+                                duplicate_of = analyzed[digest][0]
+                        analysis = analyzed[digest][1]
+                        if cache is not None:
+                            cache.store_result(pdf_url, analysis=analysis)
+                    if analysis is not None:
+                        row = build_pdf_row(
+                            pdf_url, pdfs[pdf_url], analysis, duplicate_of=duplicate_of
+                        )
+                        write_row(row, content_hash=digest)
+        else:
+            get_pdf_metadata_parallel(
+                pdfs,
+                write_row,
+                download_workers,
+                analysis_workers,
+                metadata_only=metadata_only,
+                cache=cache,
+                census=census,
+                settings=settings,
+            )
+
+    return None
+
+
+def get_pdf_metadata_parallel(
+    pdfs,
+    write_row,
+    download_workers,
+    analysis_workers,
+    metadata_only=False,
+    cache=None,
+    census=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Bounds the number of PDFs held between download and analysis, in memory
+    # or spooled to disk
+    max_in_flight = download_workers + 2 * analysis_workers
+    download = functools.partial(
+        fetch_pdf, metadata_only=metadata_only, cache=cache, settings=settings
+    )
+    pdf_urls = iter(pdfs.keys())
+    pbar = tqdm(total=len(pdfs), ncols=100)
+    # Content hash -> (first URL with that content, its analysis), and the
+    # duplicate URLs waiting on an analysis that is still running
+    analyzed, waiting = {}, {}
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+        with ProcessPoolExecutor(max_workers=analysis_workers) as analyses:
+            in_flight = {}
+
+            def submit_download():
+                pdf_url = next(pdf_urls, None)
+                if pdf_url is not None:
+                    future = downloads.submit(download, pdf_url)
+                    in_flight[future] = ("download", pdf_url, None)
+
+            def finish(pdf_url, analysis, duplicate_of=None, store=True, digest=None):
+                if analysis is not None:
+                    if store and cache is not None:
+                        cache.store_result(pdf_url, analysis=analysis)
+                    row = build_pdf_row(
+                        pdf_url, pdfs[pdf_url], analysis, duplicate_of=duplicate_of
+                    )
+                    write_row(row, content_hash=digest)
+                pbar.update(1)
+                submit_download()
+
+            for _ in range(max_in_flight):
+                submit_download()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, pdf_url, content = in_flight.pop(future)
+                    if stage == "analysis":
+                        digest, analysis = content.digest, None
+                        content.close()
+                        with report_pdf_errors(pdf_url):
+                            analysis = future.result()
+                            analyzed[digest] = (pdf_url, analysis)
+                        finish(pdf_url, analysis, digest=digest)
+                        for duplicate_url in waiting.pop(digest):
+                            finish(
+                                duplicate_url,
+                                analysis,
+                                duplicate_of=pdf_url,
+                                digest=digest,
+                            )
+                        continue
+
+                    content, analysis = None, None
+                    with report_pdf_errors(pdf_url):
+                        content, analysis = future.result()
+                    if content is None:
+                        finish(pdf_url, analysis, store=False)
+                        continue
+
+                    digest = content.digest
+                    if digest in analyzed:
+                        content.close()
+                        canonical_url, analysis = analyzed[digest]
+                        finish(
+                            pdf_url,
+                            analysis,
+                            duplicate_of=canonical_url,
+                            digest=digest,
+                        )
+                    elif digest in waiting:
+                        content.close()
+                        waiting[digest].append(pdf_url)
+                    else:
+                        waiting[digest] = []
+                        future = analyses.submit(analyze_pdf, content, census=census)
+                        in_flight[future] = ("analysis", pdf_url, content)
+    pbar.close()
+
+
+def write_parquet(csv_path, parquet_path):
+    # pandas needs pyarrow or fastparquet for Parquet, neither is a crawler
+    # requirement
+    try:
+        pd.read_csv(csv_path).to_parquet(parquet_path, index=False)
+    except ImportError as e:
+        tqdm.write(f"Skipping Parquet output: {e}")
+
+
+def crawl_site(
+    url,
+    output_path,
+    config=None,
+    delay=0,
+    concurrency=1,
+    per_host_concurrency=2,
+    download_workers=1,
+    analysis_workers=1,
+    metadata_only=False,
+    census=None,
+    cache=None,
+    resume=False,
+    parquet=False,
+    resolve_workers=RESOLVE_WORKERS,
+    priority=False,
+    max_pages=None,
+    max_time=None,
+    crawl_workers=0,
+    queue_path=None,
+    database=None,
+    settings=DEFAULT_SETTINGS,
+):
+    # Crawls one site from config.json and returns a summary of the run. PDF
+    # links are streamed to a .pdfs.jsonl file during the crawl, then written
+    # to the JSON output, and metadata rows are appended to the CSV as they
+    # are ready. Links that HEAD requests show aren't PDFs are left out of
+    # both. parquet=True also converts the CSV to Parquet at the end.
+    # max_pages and max_time (in seconds) cap the crawl unless the site sets
+    # its own in config.json.
+    # crawl_workers > 0 runs a recursive crawl with that many processes
+    # sharing a host-sharded queue at queue_path (by default next to the
+    # output), and the merged PDF links are logged once the crawl is over.
+    # With a CrawlDatabase the PDFs are also saved as a new run of the site,
+    # and the new and changed ones since its previous run are written to a
+    # .changes.csv file.
+    started = time.monotonic()
+    if config is None:
+        config = get_config(url)
+    run_id = database.start_run(url) if database is not None else None
     use_sitemap = config["use_sitemap"]
     depth = config["depth"]
     use_webdriver = config.get("use_webdriver", False)
+    scope = ScopeMatcher.from_config(config)
+    budget = None
+    max_pages = config.get("max_pages", max_pages)
+    max_time = config.get("max_time", max_time)
+    if max_pages is not None or max_time is not None:
+        budget = CrawlBudget(max_pages=max_pages, max_seconds=max_time)
 
-    allowable_domains = [
-        tldextract.extract(link).registered_domain for link in allow_list
-    ]
-    sitemap, manual_crawl_delay = parse_robots_txt(args.url, args.delay)
+    sitemap, manual_crawl_delay = parse_robots_txt(url, delay, settings)
+    if settings.archive_mode == "replay":
+        # Nothing to be polite to
+        manual_crawl_delay = 0
+    state = CrawlState(sibling_path(output_path, ".state.sqlite"))
+    links_log = PDFLinkLog(
+        sibling_path(output_path, ".pdfs.jsonl"),
+        append=resume and not state.is_empty(),
+    )
 
     if use_sitemap:
-        all_pages = parse_sitemap(sitemap)
-        tqdm.write(f"Pages found from sitemap: {len(all_pages)}")
-
-        pdfs = get_all_pages(all_pages, delay=manual_crawl_delay)
-        tqdm.write("Visited all pages on the sitemap.")
+        pdfs, visited = get_all_pages(
+            iter_sitemap([sitemap], delay=manual_crawl_delay, settings=settings),
+            delay=manual_crawl_delay,
+            state=state,
+            resume=resume,
+            cache=cache,
+            pdf_patterns=config.get("pdf_patterns"),
+            links_log=links_log,
+            budget=budget,
+            settings=settings,
+        )
+        pages = len(visited)
+        tqdm.write(f"Visited all {pages} pages on the sitemap.")
+    elif crawl_workers:
+        tqdm.write(f"Doing distributed recursive search with {crawl_workers} workers.")
+        if budget is not None:
+            tqdm.write("Distributed crawls ignore the site's max_pages and max_time")
+        pdfs, visited = crawl_distributed(
+            url,
+            queue_path or sibling_path(output_path, ".queue.sqlite"),
+            workers=crawl_workers,
+            config=config,
+            delay=manual_crawl_delay,
+            max_depth=depth,
+            per_host_concurrency=per_host_concurrency,
+            resume=resume,
+            cache_path=cache.path if cache is not None else None,
+            settings=settings,
+        )
+        for pdf_url, sources in pdfs.items():
+            for source in sources:
+                links_log.write(source["source"], [(pdf_url, source["text"])])
+        pages = len(visited)
     else:
         tqdm.write("Doing recursive search instead.")
         pdfs, visited = bfs_search_pdfs(
-            args.url,
-            allowable_domains,
-            allowable_subdomains=allowable_subdomains,
+            url,
+            scope.allowable_domains,
+            allowable_subdomains=scope.allowable_subdomains,
             delay=manual_crawl_delay,
             max_depth=depth,
             use_webdriver=use_webdriver,
+            concurrency=concurrency,
+            per_host_concurrency=per_host_concurrency,
+            state=state,
+            resume=resume,
+            cache=cache,
+            scope=scope,
+            links_log=links_log,
+            priority=priority,
+            budget=budget,
+            settings=settings,
         )
+        pages = len(visited)
+    state.close()
+    links_log.close()
 
     tqdm.write(f"PDFs found: {len(pdfs)}")
-    with open(args.output_path.replace(".csv", ".json"), "w") as f:
+    pdfs = resolve_pdf_links(
+        pdfs,
+        workers=resolve_workers,
+        delay=manual_crawl_delay,
+        per_host_concurrency=per_host_concurrency,
+        settings=settings,
+    )
+    with open(sibling_path(output_path, ".json"), "w") as f:
         json.dump(dict(pdfs), f, indent=4)
-    get_pdf_metadata(pdfs, args.output_path)
+    get_pdf_metadata(
+        pdfs,
+        output_path,
+        download_workers=download_workers,
+        analysis_workers=analysis_workers,
+        metadata_only=metadata_only,
+        cache=cache,
+        census=census,
+        database=database,
+        run_id=run_id,
+        settings=settings,
+    )
+    if parquet:
+        write_parquet(output_path, sibling_path(output_path, ".parquet"))
+    summary = {
+        "url": url,
+        "output_path": output_path,
+        "pages": pages,
+        "pdfs": len(pdfs),
+        "seconds": round(time.monotonic() - started, 1),
+    }
+    if database is not None:
+        database.finish_run(run_id, pages=pages)
+        changes = database.changes(run_id)
+        if changes is not None:
+            new, changed, removed = changes
+            database.export_csv(
+                new + changed, sibling_path(output_path, ".changes.csv")
+            )
+            tqdm.write(
+                f"Since the last crawl: {len(new)} new, {len(changed)} changed and "
+                f"{len(removed)} removed PDFs"
+            )
+            summary.update(
+                new_pdfs=len(new), changed_pdfs=len(changed), removed_pdfs=len(removed)
+            )
+    return summary
+
+
+def crawl_all(
+    output_dir, sites=None, site_workers=4, per_domain_sites=None, **crawl_options
+):
+    """
+    Crawls every site in config.json, or those whose URL matches one of the
+    `sites` glob patterns, running up to site_workers sites at once. Each site
+    is its own host and keeps its own delay; per_domain_sites optionally caps
+    the sites that share a registered domain, such as georgia.gov, which most
+    configured sites do. Each site writes to
+    <output_dir>/<host>.csv, .pdfs.jsonl and .json, and the per-site summaries
+    are returned and saved to <output_dir>/summary.json.
+    """
+    config = load_config()
+    urls = [
+        url
+        for url in config
+        if not sites or any(fnmatch.fnmatch(url, pattern) for pattern in sites)
+    ]
+    os.makedirs(output_dir, exist_ok=True)
+
+    def crawl(url):
+        host = urllib.parse.urlparse(url).netloc
+        output_path = os.path.join(output_dir, f"{host}.csv")
+        try:
+            return crawl_site(url, output_path, config=config[url], **crawl_options)
+        except Exception as e:
+            tqdm.write(f"Crawl failed: {url}: {e}")
+            return {"url": url, "output_path": output_path, "error": str(e)}
+
+    summaries, pending = [], deque(urls)
+    running_by_domain = defaultdict(int)
+    with ThreadPoolExecutor(max_workers=site_workers) as executor:
+        in_flight = {}
+        while pending or in_flight:
+            # Start the next sites whose domain has room, keeping config order
+            for url in list(pending):
+                if len(in_flight) >= site_workers:
+                    break
+                domain = tldextract.extract(url).registered_domain
+                if (
+                    per_domain_sites is None
+                    or running_by_domain[domain] < per_domain_sites
+                ):
+                    pending.remove(url)
+                    running_by_domain[domain] += 1
+                    in_flight[executor.submit(crawl, url)] = domain
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                running_by_domain[in_flight.pop(future)] -= 1
+                summaries.append(future.result())
+
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summaries, f, indent=4)
+    for summary in summaries:
+        if "error" in summary:
+            tqdm.write(f"{summary['url']}: failed ({summary['error']})")
+        else:
+            tqdm.write(
+                f"{summary['url']}: {summary['pages']} pages, "
+                f"{summary['pdfs']} PDFs in {summary['seconds']}s"
+            )
+    return summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Starts crawl from provided URL")
+    parser.add_argument(
+        "url",
+        help="Starting URL, crawl-all to crawl every site in config.json, "
+        "crawl-worker to add processes on this machine to the distributed crawl "
+        "queued at output_path, or "
+        "export to write PDFs from --database to the output_path CSV",
+    )
+    parser.add_argument("--delay", type=float, default=0, help="Delay between requests")
+    parser.add_argument(
+        "--adaptive-rate",
+        action="store_true",
+        help="Adapt the interval between requests to each host, starting from the "
+        "delay: shorter while the host answers quickly, longer after 429/503 "
+        "responses, errors or slowdowns. Never below the robots.txt crawl-delay",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Maximum concurrent page fetches. Values above 1 use the asyncio crawler",
+    )
+    parser.add_argument(
+        "--per-host-concurrency",
+        type=int,
+        default=2,
+        help="Maximum concurrent page fetches against a single host",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=1,
+        help="Threads downloading PDFs for the metadata pass",
+    )
+    parser.add_argument(
+        "--analysis-workers",
+        type=int,
+        default=1,
+        help="Processes analyzing PDFs with PyMuPDF for the metadata pass",
+    )
+    parser.add_argument(
+        "--metadata-only",
+        action="store_true",
+        help="Read PDF metadata with Range requests, skipping image and table counts",
+    )
+    parser.add_argument(
+        "--max-pdf-size",
+        type=float,
+        default=MAX_PDF_SIZE / 1024 / 1024,
+        help="Megabytes after which a PDF download is abandoned and recorded in "
+        "the .skipped.csv, 0 for no limit",
+    )
+    parser.add_argument(
+        "--max-pdf-time",
+        type=float,
+        default=MAX_PDF_SECONDS,
+        help="Seconds after which a PDF download is abandoned and recorded in "
+        "the .skipped.csv, 0 for no limit",
+    )
+    parser.add_argument(
+        "--census-max-pages",
+        type=int,
+        help="Count images and tables on a sample of at most this many pages per PDF",
+    )
+    parser.add_argument(
+        "--census-time-budget",
+        type=float,
+        help="Seconds spent counting images and tables per PDF before extrapolating",
+    )
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument(
+        "--record",
+        metavar="DIR",
+        help="Archive every HTTP response in DIR, one .warc.gz per site",
+    )
+    archive.add_argument(
+        "--replay",
+        metavar="DIR",
+        help="Answer every HTTP request from the archives in DIR, without network "
+        "access or delays",
+    )
+    parser.add_argument(
+        "--database",
+        help="SQLite crawl database every run's PDFs are added to, and that export "
+        "reads",
+    )
+    parser.add_argument(
+        "--all-pdfs",
+        action="store_true",
+        help="export only: every PDF of each site's latest run instead of the new "
+        "and changed ones",
+    )
+    parser.add_argument(
+        "--http-cache",
+        help="SQLite file of HTTP validators and results reused across crawls",
+    )
+    parser.add_argument(
+        "--webdriver-pool-size",
+        type=int,
+        default=WEBDRIVER_POOL_SIZE,
+        help="Headless browsers kept running for sites that need a webdriver",
+    )
+    parser.add_argument(
+        "--link-parser",
+        choices=sorted(LINK_PARSERS),
+        default=LINK_PARSER,
+        help="HTML parser used to extract links from fetched pages",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="Write crawl telemetry as JSON to this file, refreshed periodically",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="Seconds between telemetry snapshots",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="PATH",
+        help="Also write telemetry in the Prometheus text format to this file",
+    )
+    parser.add_argument(
+        "--seen-filter",
+        choices=sorted(URL_SEEN_SETS),
+        default=URL_SEEN_SET,
+        help="How recursive crawls remember queued URLs; bloom uses less memory "
+        "but may skip about 0.1%% of pages",
+    )
+    parser.add_argument(
+        "--priority",
+        action="store_true",
+        help="Crawl recursive sites best-first, following links that look like "
+        "they lead to documents first. Runs serially",
+    )
+    parser.add_argument(
+        "--max-pages",
+        type=int,
+        help="Stop crawling a site after fetching this many pages",
+    )
+    parser.add_argument(
+        "--max-time",
+        type=float,
+        help="Stop crawling a site after this many seconds",
+    )
+    parser.add_argument(
+        "--crawl-workers",
+        type=int,
+        default=0,
+        help="Crawl recursive sites with this many processes sharing a queue "
+        "sharded by host, on this machine. With crawl-worker, processes joining "
+        "the queue",
+    )
+    parser.add_argument(
+        "--queue",
+        metavar="PATH",
+        help="SQLite file holding the shared queue for --crawl-workers, defaults "
+        "to the output path with its extension swapped for .queue.sqlite",
+    )
+    parser.add_argument(
+        "--resolve-workers",
+        type=int,
+        default=RESOLVE_WORKERS,
+        help="Concurrent HEAD requests checking links that don't end in .pdf, "
+        "0 to download them all",
+    )
+    parser.add_argument(
+        "--parquet",
+        action="store_true",
+        help="Also save the PDF metadata as Parquet, needs pyarrow or fastparquet",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the crawl checkpointed next to the output path",
+    )
+    parser.add_argument(
+        "--sites",
+        nargs="+",
+        help="crawl-all and export only: glob patterns selecting sites",
+    )
+    parser.add_argument(
+        "--site-workers",
+        type=int,
+        default=4,
+        help="crawl-all only: sites crawled at the same time",
+    )
+    parser.add_argument(
+        "--per-domain-sites",
+        type=int,
+        help="crawl-all only: sites sharing a registered domain crawled at once, "
+        "unlimited by default",
+    )
+    parser.add_argument(
+        "output_path",
+        help="Path where a CSV with PDF information will be saved, the output "
+        "directory for crawl-all, or the shared queue for crawl-worker",
+    )
+    args = parser.parse_args()
+    if args.url == "export" and not args.database:
+        parser.error("export reads the crawl database given with --database")
+    if args.crawl_workers or args.url == "crawl-worker":
+        # Workers crawl from the shared queue's own pacing, without budgets,
+        # best-first order or a RateController
+        unsupported = [
+            flag
+            for flag, value in [
+                ("--max-pages", args.max_pages is not None),
+                ("--max-time", args.max_time is not None),
+                ("--priority", args.priority),
+                ("--adaptive-rate", args.adaptive_rate),
+            ]
+            if value
+        ]
+        if unsupported:
+            parser.error(
+                f"{', '.join(unsupported)} can't be used with distributed crawls"
+            )
+    archive_mode = None
+    if args.record or args.replay:
+        archive_mode = "record" if args.record else "replay"
+    settings = CrawlSettings(
+        link_parser=args.link_parser,
+        seen_filter=args.seen_filter,
+        adaptive_rate=args.adaptive_rate,
+        archive_dir=args.record or args.replay,
+        archive_mode=archive_mode,
+        webdriver_pool_size=args.webdriver_pool_size,
+        max_pdf_size=int(args.max_pdf_size * 1024 * 1024),
+        max_pdf_seconds=args.max_pdf_time,
+    )
+
+    census = None
+    if args.census_max_pages is not None or args.census_time_budget is not None:
+        census = {
+            "max_pages": args.census_max_pages,
+            "time_budget": args.census_time_budget,
+        }
+    crawl_options = {
+        "delay": args.delay,
+        "concurrency": args.concurrency,
+        "per_host_concurrency": args.per_host_concurrency,
+        "download_workers": args.download_workers,
+        "analysis_workers": args.analysis_workers,
+        "metadata_only": args.metadata_only,
+        "census": census,
+        "cache": ValidatorCache(args.http_cache) if args.http_cache else None,
+        "resume": args.resume,
+        "parquet": args.parquet,
+        "resolve_workers": args.resolve_workers,
+        "priority": args.priority,
+        "max_pages": args.max_pages,
+        "max_time": args.max_time,
+        "crawl_workers": args.crawl_workers,
+        "queue_path": args.queue,
+        "database": CrawlDatabase(args.database) if args.database else None,
+        "settings": settings,
+    }
+
+    reporter = None
+    if args.metrics or args.prometheus:
+        reporter = MetricsReporter(
+            get_metrics(),
+            path=args.metrics,
+            interval=args.metrics_interval,
+            prometheus_path=args.prometheus,
+        ).start()
+
+    try:
+        if args.url == "export":
+            export_pdfs(
+                crawl_options["database"],
+                args.output_path,
+                sites=args.sites,
+                changes_only=not args.all_pdfs,
+            )
+        elif args.url == "crawl-worker":
+            run_crawl_workers(
+                args.output_path,
+                max(args.crawl_workers, 1),
+                cache_path=args.http_cache,
+                settings=settings,
+            )
+        elif args.url == "crawl-all":
+            crawl_all(
+                args.output_path,
+                sites=args.sites,
+                site_workers=args.site_workers,
+                per_domain_sites=args.per_domain_sites,
+                **crawl_options,
+            )
+        else:
+            crawl_site(args.url, args.output_path, **crawl_options)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+    settings.webdriver_pool().close()
@@ -0,0 +1,205 @@
+import contextlib
+import json
+import sqlite3
+import time
+import urllib.parse
+from collections import defaultdict
+
+# Seconds a distributed worker holds a page before it is handed out again
+LEASE_SECONDS = 300
+
+
+class SharedFrontier:
+    """
+    Work queue shared by distributed crawl workers through one SQLite file.
+    Pages are sharded by host: a worker claims the queued page with the most
+    depth remaining among hosts with fewer than per_host_concurrency pages in
+    flight, and reserves the host's next request time in the same
+    transaction, so the delay holds per host across every worker. The urls
+    table doubles as the shared visited set, and the PDF links found by all
+    workers are stored with it. Pages held by a worker that died go back to
+    the queue once their lease expires. Every worker must run on the same
+    machine, with the file on a local disk: SQLite's WAL journal relies on
+    shared memory, and network filesystems don't lock it reliably.
+    """
+
+    QUEUED, LEASED, DONE = 0, 1, 2
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        # Transactions are started explicitly, see transaction()
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                host TEXT NOT NULL,
+                depth INTEGER NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                leased_until REAL
+            );
+            CREATE INDEX IF NOT EXISTS urls_status ON urls (status, depth DESC, id);
+            CREATE TABLE IF NOT EXISTS hosts (
+                host TEXT PRIMARY KEY,
+                in_flight INTEGER NOT NULL DEFAULT 0,
+                next_request REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS pdfs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                source TEXT NOT NULL,
+                text TEXT NOT NULL
+            );
+            """
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't
+        # read the same queued page before either marks it leased
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def is_empty(self):
+        return not self.connection.execute(
+            "SELECT EXISTS (SELECT 1 FROM urls)"
+        ).fetchone()[0]
+
+    def reset(self, seeds=(), settings=None):
+        # seeds are (url, depth) pairs, settings are shared with every worker
+        with self.transaction() as connection:
+            for table in ("settings", "urls", "hosts", "pdfs"):
+                connection.execute(f"DELETE FROM {table}")
+            connection.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in (settings or {}).items()],
+            )
+            self._enqueue(connection, seeds)
+
+    def settings(self):
+        return {
+            key: json.loads(value)
+            for key, value in self.connection.execute("SELECT key, value FROM settings")
+        }
+
+    @staticmethod
+    def _enqueue(connection, children):
+        hosts = {urllib.parse.urlsplit(url).netloc for url, _ in children}
+        connection.executemany(
+            "INSERT OR IGNORE INTO hosts (host) VALUES (?)", [(host,) for host in hosts]
+        )
+        connection.executemany(
+            "INSERT OR IGNORE INTO urls (url, host, depth) VALUES (?, ?, ?)",
+            [
+                (url, urllib.parse.urlsplit(url).netloc, depth)
+                for url, depth in children
+            ],
+        )
+
+    def _expire_leases(self, connection, now):
+        expired = connection.execute(
+            "SELECT id, host FROM urls WHERE status = ? AND leased_until < ?",
+            (self.LEASED, now),
+        ).fetchall()
+        for url_id, host in expired:
+            connection.execute(
+                "UPDATE urls SET status = ?, worker = NULL, leased_until = NULL "
+                "WHERE id = ?",
+                (self.QUEUED, url_id),
+            )
+            connection.execute(
+                "UPDATE hosts SET in_flight = MAX(in_flight - 1, 0) WHERE host = ?",
+                (host,),
+            )
+
+    def claim(self, worker, per_host_concurrency=2, delay=0):
+        # Returns the (url, depth) of the next page for this worker and the
+        # seconds to wait before fetching it, or None when no host has room
+        now = time.time()
+        with self.transaction() as connection:
+            self._expire_leases(connection, now)
+            row = connection.execute(
+                "SELECT urls.id, urls.url, urls.host, urls.depth, hosts.next_request "
+                "FROM urls JOIN hosts ON hosts.host = urls.host "
+                "WHERE urls.status = ? AND hosts.in_flight < ? "
+                "ORDER BY urls.depth DESC, urls.id LIMIT 1",
+                (self.QUEUED, per_host_concurrency),
+            ).fetchone()
+            if row is None:
+                return None
+            url_id, url, host, depth, next_request = row
+            start = max(now, next_request)
+            connection.execute(
+                "UPDATE urls SET status = ?, worker = ?, leased_until = ? WHERE id = ?",
+                (self.LEASED, worker, start + self.lease_seconds, url_id),
+            )
+            connection.execute(
+                "UPDATE hosts SET in_flight = in_flight + 1, next_request = ? "
+                "WHERE host = ?",
+                (start + delay, host),
+            )
+        return (url, depth), start - now
+
+    def complete(self, url, worker, children=(), pdf_links=()):
+        # Same arguments as CrawlState.mark_visited. Returns False, dropping
+        # the results, when the lease expired and the page was handed out again
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT host FROM urls WHERE url = ? AND status = ? AND worker = ?",
+                (url, self.LEASED, worker),
+            ).fetchone()
+            if row is None:
+                return False
+            connection.execute(
+                "UPDATE urls SET status = ?, leased_until = NULL WHERE url = ?",
+                (self.DONE, url),
+            )
+            connection.execute(
+                "UPDATE hosts SET in_flight = MAX(in_flight - 1, 0) WHERE host = ?",
+                row,
+            )
+            self._enqueue(connection, children)
+            connection.executemany(
+                "INSERT INTO pdfs (url, source, text) VALUES (?, ?, ?)",
+                [(pdf_url, url, text) for pdf_url, text in pdf_links],
+            )
+        return True
+
+    def pending(self):
+        # Pages queued or in flight on any worker
+        query = "SELECT COUNT(*) FROM urls WHERE status != ?"
+        return self.connection.execute(query, (self.DONE,)).fetchone()[0]
+
+    def load(self, visited=None):
+        # Returns the merged pdfs and visited pages, as bfs_search_pdfs does.
+        # Visited pages are added to `visited` when given, e.g. a URLSeenSet.
+        visited = set() if visited is None else visited
+        visited.update(
+            row[0]
+            for row in self.connection.execute(
+                "SELECT url FROM urls WHERE status = ?", (self.DONE,)
+            )
+        )
+        pdfs = defaultdict(list)
+        for pdf_url, source, text in self.connection.execute(
+            "SELECT url, source, text FROM pdfs ORDER BY id"
+        ):
+            pdfs[pdf_url].append({"source": source, "text": text})
+        return pdfs, visited
+
+    def close(self):
+        self.connection.close()
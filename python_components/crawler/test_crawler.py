@@ -1,6 +1,43 @@
+import asyncio
+import csv
 import datetime
+import functools
+import gzip
+import hashlib
+import io
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-from crawler import convert_bytes, parse_pdf_date, remove_trailing_slash
+import pandas as pd
+import pymupdf
+import pytest
+import requests
+import tldextract
+import urllib3
+from pytest_httpserver import HTTPServer
+from selenium.common.exceptions import WebDriverException
+from werkzeug import Request, Response
+
+import benchmark_crawl
+import crawler
+from crawl_archive import ArchiveMiss, CrawlArchive
+from crawl_database import CrawlDatabase, export_pdfs
+from crawler import (
+    census_images_and_tables,
+    convert_bytes,
+    get_images_and_tables,
+    parse_pdf_date,
+    remove_trailing_slash,
+)
+from shared_frontier import SharedFrontier
 
 
 def test_convert_bytes():
@@ -22,3 +59,1316 @@ def test_parse_pdf_date():
     assert parse_pdf_date("D:20000102030405-06'00'") == datetime.datetime(
         2000, 1, 2, 3, 4, 5
     )
+
+
+SITE = {
+    "https://example.com": ["https://example.com/a", "https://example.com/b"],
+    "https://example.com/a": [
+        "https://example.com/b",
+        "https://example.com/c",
+        "https://example.com/files/a.pdf",
+    ],
+    "https://example.com/b": ["https://other.com/d", "https://example.com/a"],
+    "https://example.com/c": ["https://example.com/e", "https://example.com/c.pdf"],
+    "https://example.com/e": ["https://example.com/deep.pdf"],
+}
+
+
+def fake_get_links(url, **kwargs):
+    links = SITE.get(url, [])
+    return links, [link.split("/")[-1] for link in links]
+
+
+def test_bfs_search_pdfs_async_matches_serial(monkeypatch):
+    monkeypatch.setattr(crawler, "get_links", fake_get_links)
+    serial = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=3
+    )
+    concurrent = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=3, concurrency=4
+    )
+    assert serial == concurrent
+    assert set(concurrent[0].keys()) == {
+        "https://example.com/files/a.pdf",
+        "https://example.com/c.pdf",
+    }
+    assert "https://other.com/d" not in concurrent[1]
+
+
+def test_distributed_crawl_matches_serial(monkeypatch, tmp_path):
+    monkeypatch.setattr(crawler, "get_links", fake_get_links)
+    serial = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=3
+    )
+
+    queue_path = str(tmp_path / "crawl.queue.sqlite")
+    frontier = SharedFrontier(queue_path)
+    settings = {"url": "https://example.com", "delay": 0, "per_host_concurrency": 2}
+    frontier.reset([("https://example.com", 3)], settings=settings)
+    config = {"allow_list": ["https://example.com"]}
+    workers = [
+        threading.Thread(target=crawler.crawl_worker, args=(queue_path, config))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert frontier.pending() == 0
+    assert frontier.load() == serial
+    frontier.close()
+
+
+def test_shared_frontier_leases(tmp_path):
+    frontier = SharedFrontier(str(tmp_path / "queue.sqlite"))
+    pages = [("https://example.com/a", 2), ("https://example.com/b", 2)]
+    frontier.reset(pages + [("https://other.com", 1)])
+
+    # Only one page per host is in flight, and the delay is reserved per host
+    assert frontier.claim("w1", per_host_concurrency=1, delay=10) == (pages[0], 0)
+    assert frontier.claim("w2", per_host_concurrency=1) == (("https://other.com", 1), 0)
+    assert frontier.claim("w3", per_host_concurrency=1) is None
+    assert frontier.complete("https://example.com/a", "w1", children=pages)
+    (url, _), wait = frontier.claim("w3", per_host_concurrency=1)
+    assert url == "https://example.com/b" and 9 < wait <= 10
+
+    # Pages of a worker whose lease expired are handed out again
+    frontier.lease_seconds = -20
+    frontier.complete("https://other.com", "w2")
+    frontier.reset(pages)
+    assert frontier.claim("w1")[0] == pages[0]
+    assert frontier.claim("w2")[0] == pages[0]
+    assert not frontier.complete("https://example.com/a", "w1")
+    assert frontier.complete("https://example.com/a", "w2")
+    frontier.close()
+
+
+def test_scope_matcher(monkeypatch):
+    scope = crawler.ScopeMatcher(["example.com"], allowable_subdomains=["", "www"])
+    assert scope.classify("https://example.com/a.PDF") == scope.PAGE
+    assert scope.classify("https://example.com/report.pdf") == scope.PDF
+    assert scope.classify("https://other.com/files/download") == scope.PDF
+    assert scope.classify("https://www.example.com/page") == scope.PAGE
+    assert scope.classify("https://docs.example.com/page") == scope.OUT_OF_SCOPE
+    assert scope.classify("https://example.co.uk/page") == scope.OUT_OF_SCOPE
+
+    # Hosts are only looked up in the public suffix list once
+    calls = []
+    extract = tldextract.extract
+    monkeypatch.setattr(
+        crawler.tldextract, "extract", lambda host: calls.append(host) or extract(host)
+    )
+    for page in range(3):
+        scope.classify(f"https://example.org/{page}")
+    assert calls == ["example.org"]
+
+    custom = crawler.ScopeMatcher.from_config(
+        {"allow_list": ["https://example.com"], "pdf_patterns": [r"/getfile\?"]}
+    )
+    assert custom.classify("https://example.com/getfile?id=1") == custom.PDF
+    assert custom.classify("https://example.com/report.pdf") == custom.PAGE
+
+
+def test_url_canonicalizer():
+    canonicalizer = crawler.URLCanonicalizer()
+    canonicalize = canonicalizer.canonicalize
+    assert (
+        canonicalize("HTTPS://Example.COM/a?utm_source=x&b=2&a=1&fbclid=y#top")
+        == "https://example.com/a?a=1&b=2"
+    )
+    assert canonicalize("https://example.com/a;jsessionid=ABC?x=1") == (
+        "https://example.com/a?x=1"
+    )
+    # Values aren't re-encoded
+    assert canonicalize("https://example.com/f?path=a/b%20c") == (
+        "https://example.com/f?path=a/b%20c"
+    )
+    custom = crawler.URLCanonicalizer(strip_params=["page"], sort_query=False)
+    assert custom.canonicalize("https://example.com/?z=1&page=2&utm_id=3") == (
+        "https://example.com/?z=1&utm_id=3"
+    )
+
+
+def test_trap_detector():
+    traps = crawler.TrapDetector(max_urls_per_pattern=3)
+    assert traps.is_trap("https://example.com/a/b/a/b/a/b")
+    assert not traps.is_trap("https://example.com/2024/01/01")
+    months = [f"https://example.com/events?month=2024-{m:02}" for m in range(1, 6)]
+    assert [traps.is_trap(month) for month in months] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+    # Other patterns have their own count
+    assert not traps.is_trap("https://example.com/events?month=5&view=list")
+
+    # Links are classified before being canonicalized, then pages are deduped
+    # and filtered by the site's trap detector
+    scope = crawler.ScopeMatcher.from_config(
+        {"allow_list": ["https://example.com"], "traps": {"max_urls_per_pattern": 2}}
+    )
+    links = [
+        "https://example.com/page.cfm?id=1&utm_source=mail",
+        "https://example.com/list?b=1&a=2#results",
+        "https://example.com/list?a=2&b=1&utm_medium=web",
+        "https://example.com/list?a=3&b=1",
+        "https://example.com/list?a=4&b=1",
+    ]
+    children, pdf_links, _ = scope.split_links(links, [""] * len(links), set(), 2)
+    assert pdf_links == [("https://example.com/page.cfm?id=1", "")]
+    queued = set()
+    assert crawler.dedup_children(children, queued, scope.traps) == [
+        ("https://example.com/list?a=2&b=1", 2),
+        ("https://example.com/list?a=3&b=1", 2),
+    ]
+    assert len(queued) == 3
+
+
+def test_rate_controller(monkeypatch):
+    monkeypatch.setattr(crawler, "RATE_STEP", 0.5)
+    controller = crawler.RateController()
+    url = "https://example.com/page"
+    assert controller.reserve(url, delay=2) == 0
+    assert 1.9 < controller.reserve(url) <= 2
+
+    # Fast responses shorten the interval down to the crawl-delay floor
+    controller.set_floor(url, 1)
+    for _ in range(3):
+        controller.observe(url, 200, 0.1)
+    assert controller.intervals() == {"example.com": 1}
+
+    # Errors, 429/503 and slow responses double it
+    controller.observe(url, 503, 0.1)
+    controller.observe(url, "error", 10)
+    controller.observe(url, 200, 2)
+    assert controller.intervals() == {"example.com": 8}
+    controller.observe("https://other.com", 200, 2)
+    assert controller.intervals()["other.com"] == 0
+
+
+def test_rate_controller_retry_after(httpserver: HTTPServer, monkeypatch):
+    httpserver.expect_ordered_request("/busy").respond_with_data(
+        "", status=429, headers={"Retry-After": "1"}
+    )
+    httpserver.expect_ordered_request("/busy").respond_with_data("ok")
+    controller = crawler.RateController()
+    monkeypatch.setattr(crawler, "get_rate_controller", lambda: controller)
+
+    # The shared session leaves the 429 to the controller, which backs off and
+    # waits out the Retry-After before the request is retried
+    settings = crawler.CrawlSettings(adaptive_rate=True)
+    started = time.monotonic()
+    assert crawler.http_get(httpserver.url_for("/busy"), settings=settings).ok
+    assert time.monotonic() - started >= 0.9
+    assert len(httpserver.log) == 2
+    host = urllib.parse.urlsplit(httpserver.url_for("/")).netloc
+    assert controller.intervals()[host] == pytest.approx(
+        crawler.RATE_MIN_BACKOFF_INTERVAL - crawler.RATE_STEP
+    )
+    assert crawler.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert crawler.parse_retry_after("soon") is None
+
+
+@pytest.mark.parametrize("adaptive_rate", [False, True])
+def test_host_limiter_spaces_request_starts(monkeypatch, adaptive_rate):
+    controller = crawler.RateController()
+    monkeypatch.setattr(crawler, "get_rate_controller", lambda: controller)
+    limiter = crawler.HostLimiter(
+        per_host_concurrency=2, delay=0.2, adaptive_rate=adaptive_rate
+    )
+    starts = defaultdict(list)
+
+    async def fetch(url, global_limit):
+        async with limiter.limit(url, global_limit):
+            starts[url].append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def hold(global_limit):
+        async with global_limit:
+            await asyncio.sleep(0.5)
+
+    async def crawl():
+        # Another host holds the only global slot while example.com's
+        # requests queue up behind it
+        global_limit = asyncio.Semaphore(1)
+        await asyncio.gather(
+            hold(global_limit),
+            *[fetch("https://example.com/page", global_limit) for _ in range(3)],
+        )
+
+    asyncio.run(crawl())
+    page_starts = starts["https://example.com/page"]
+    assert len(page_starts) == 3
+    gaps = [later - earlier for earlier, later in zip(page_starts, page_starts[1:])]
+    assert min(gaps) >= 0.19
+
+
+def test_get_session_is_shared():
+    assert crawler.get_session() is crawler.get_session()
+    assert "gzip" in crawler.get_session().headers["Accept-Encoding"]
+
+
+def test_session_caches_dns_per_adapter(httpserver: HTTPServer, monkeypatch):
+    httpserver.expect_request("/page").respond_with_data("ok")
+    lookups = []
+    getaddrinfo = socket.getaddrinfo
+
+    def counted_getaddrinfo(host, *args, **kwargs):
+        lookups.append(host)
+        return getaddrinfo(host, *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", counted_getaddrinfo)
+    monkeypatch.setattr(crawler, "_dns_cache", {})
+    crawler.get_session.cache_clear()
+    for _ in range(3):
+        # New connections each time, resolved once
+        crawler.DEFAULT_SETTINGS.session().close()
+        assert crawler.http_get(httpserver.url_for("/page")).text == "ok"
+    # Connecting to the cached addresses doesn't need DNS
+    assert lookups.count("localhost") == 1
+    # The socket module itself isn't patched
+    assert socket.getaddrinfo is counted_getaddrinfo
+    crawler.get_session.cache_clear()
+
+
+def test_retry_after_is_bounded():
+    response = urllib3.HTTPResponse(status=503, headers={"Retry-After": "3600"})
+    assert crawler.HTTP_RETRIES.get_retry_after(response) == crawler.MAX_RETRY_AFTER
+    response = urllib3.HTTPResponse(status=503, headers={"Retry-After": "2"})
+    assert crawler.HTTP_RETRIES.new(total=2).get_retry_after(response) == 2
+
+
+def test_parse_robots_txt(httpserver: HTTPServer):
+    httpserver.expect_request("/robots.txt").respond_with_data(
+        "User-agent: *\nCrawl-delay: 2\nSitemap: https://example.com/map.xml\n"
+    )
+    sitemap, delay = crawler.parse_robots_txt(httpserver.url_for("/"), 1)
+    assert sitemap == "https://example.com/map.xml"
+    assert delay == 3
+
+
+def test_iter_sitemap(httpserver: HTTPServer):
+    def urlset(*pages):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+            + "".join(f"<url><loc> {page} </loc></url>" for page in pages)
+            + "</urlset>"
+        )
+
+    def index(*sitemaps):
+        return (
+            "<sitemapindex>"
+            + "".join(
+                f"<sitemap><loc>{httpserver.url_for(path)}</loc></sitemap>"
+                for path in sitemaps
+            )
+            + "</sitemapindex>"
+        )
+
+    httpserver.expect_request("/sitemap.xml").respond_with_data(
+        index("/pages.xml", "/nested.xml", "/missing.xml")
+    )
+    # Sitemap indexes can nest, and loop back to themselves
+    httpserver.expect_request("/nested.xml").respond_with_data(
+        index("/sitemap.xml", "/more.xml.gz")
+    )
+    httpserver.expect_request("/pages.xml").respond_with_data(
+        urlset("https://example.com/a", "https://example.com/b")
+    )
+    httpserver.expect_request("/more.xml.gz").respond_with_data(
+        gzip.compress(
+            urlset("https://example.com/b", "https://example.com/c").encode()
+        ),
+        content_type="application/gzip",
+    )
+    httpserver.expect_request("/missing.xml").respond_with_data("", status=404)
+
+    pages = list(crawler.iter_sitemap([httpserver.url_for("/sitemap.xml")]))
+    assert sorted(pages) == [
+        "https://example.com/a",
+        "https://example.com/b",
+        "https://example.com/c",
+    ]
+
+    # Stopping early doesn't leave readers blocked
+    pages = crawler.iter_sitemap([httpserver.url_for("/sitemap.xml")])
+    assert next(pages).startswith("https://example.com/")
+    pages.close()
+
+
+def test_get_links(httpserver: HTTPServer):
+    httpserver.expect_request("/page").respond_with_data(
+        '<a href="/docs/">Docs</a><a href="https://example.com/a.pdf"> A </a>',
+        content_type="text/html",
+    )
+    links, link_texts = crawler.get_links(httpserver.url_for("/page"))
+    assert links == [httpserver.url_for("/docs"), "https://example.com/a.pdf"]
+    assert link_texts == ["Docs", "A"]
+
+
+def test_crawl_metrics(httpserver: HTTPServer, tmp_path):
+    crawler.get_metrics.cache_clear()
+    page = '<a href="/report.pdf">Report</a>' * 100
+    httpserver.expect_request("/page").respond_with_data(page, content_type="text/html")
+    httpserver.expect_request("/missing").respond_with_data("", status=404)
+
+    crawler.get_links(httpserver.url_for("/page"))
+    crawler.get_links(httpserver.url_for("/missing"))
+    crawler.wait_for_delay(0.01)
+
+    metrics = crawler.get_metrics()
+    snapshot = metrics.snapshot()
+    host = snapshot["hosts"][f"{httpserver.host}:{httpserver.port}"]
+    assert snapshot["pages"] == 2
+    assert host["requests"] == 2
+    assert host["statuses"] == {"200": 1, "404": 1}
+    assert host["bytes"] == len(page)
+    assert host["latency_buckets"]["+Inf"] == 2
+    assert snapshot["stages"]["parse"]["count"] == 1
+    assert snapshot["stages"]["delay"]["seconds"] >= 0.01
+
+    reporter = crawler.MetricsReporter(
+        metrics,
+        path=str(tmp_path / "metrics.json"),
+        interval=0.01,
+        prometheus_path=str(tmp_path / "metrics.prom"),
+    ).start()
+    time.sleep(0.05)
+    reporter.stop()
+    assert json.loads((tmp_path / "metrics.json").read_text())["pages"] == 2
+    prometheus = (tmp_path / "metrics.prom").read_text()
+    assert "crawler_pages_total 2" in prometheus
+    assert f'host="{httpserver.host}:{httpserver.port}",status="404"}} 1' in prometheus
+    crawler.get_metrics.cache_clear()
+
+
+def test_crawl_worker_metrics_are_merged(monkeypatch, tmp_path):
+    def measured_links(url, **kwargs):
+        crawler.get_metrics().observe_request(url, 200, 0.01, size=100)
+        crawler.get_metrics().count("pages")
+        return fake_get_links(url)
+
+    # Requests made before the workers are forked aren't counted twice
+    crawler.get_metrics.cache_clear()
+    crawler.get_metrics().observe_request("https://example.com/robots.txt", 200, 0.01)
+    monkeypatch.setattr(crawler, "get_links", measured_links)
+    queue_path = str(tmp_path / "crawl.queue.sqlite")
+    settings = {"url": "https://example.com", "delay": 0, "per_host_concurrency": 2}
+    # Closed before forking, SQLite connections mustn't be shared with children
+    frontier = SharedFrontier(queue_path)
+    frontier.reset([("https://example.com", 3)], settings=settings)
+    frontier.close()
+    config = {"allow_list": ["https://example.com"]}
+    assert crawler.run_crawl_workers(queue_path, 2, config=config) == 4
+
+    snapshot = crawler.get_metrics().snapshot()
+    host = snapshot["hosts"]["example.com"]
+    assert snapshot["pages"] == 4
+    assert (host["requests"], host["bytes"]) == (5, 400)
+    assert host["latency_buckets"]["0.05"] == 5
+    crawler.get_metrics.cache_clear()
+
+
+@pytest.mark.parametrize(
+    "fixture",
+    ["agency_home.html", "document_library.html", "legacy_windows_1252.html"],
+)
+def test_link_parsers_agree(fixture):
+    content = (Path(__file__).parent / "fixtures" / fixture).read_bytes()
+    url = "https://example.gov/records/"
+    links = {
+        parser: crawler.get_links_from_anchors(
+            url, crawler.parse_anchors(content, parser)
+        )
+        for parser in crawler.LINK_PARSERS
+    }
+    assert links["lxml"] == links["html.parser"]
+    assert links["lxml"][0]
+
+
+def test_bfs_search_pdfs_resume(monkeypatch, tmp_path):
+    monkeypatch.setattr(crawler, "get_links", fake_get_links)
+    expected = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=4
+    )
+
+    def failing_get_links(url, **kwargs):
+        if url == "https://example.com/c":
+            raise KeyboardInterrupt
+        return fake_get_links(url)
+
+    state = crawler.CrawlState(str(tmp_path / "crawl.state.sqlite"))
+    monkeypatch.setattr(crawler, "get_links", failing_get_links)
+    with pytest.raises(KeyboardInterrupt):
+        crawler.bfs_search_pdfs(
+            "https://example.com", ["example.com"], max_depth=4, state=state
+        )
+
+    monkeypatch.setattr(crawler, "get_links", fake_get_links)
+    resumed = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=4, state=state, resume=True
+    )
+    assert resumed == expected
+
+
+def test_bfs_search_pdfs_async_resume_skips_traps(monkeypatch, tmp_path):
+    home = "https://example.com/"
+    months = [f"https://example.com/events?month={month}" for month in range(5)]
+    fetched = []
+
+    def linked_pages(url, **kwargs):
+        fetched.append(url)
+        if url == months[0]:
+            raise RuntimeError("Crawl interrupted")
+        links = months if url == home else []
+        return links, ["" for _ in links]
+
+    scope = crawler.ScopeMatcher.from_config(
+        {"allow_list": ["https://example.com"], "traps": {"max_urls_per_pattern": 2}}
+    )
+    state = crawler.CrawlState(str(tmp_path / "crawl.state.sqlite"))
+    monkeypatch.setattr(crawler, "get_links", linked_pages)
+    crawl = functools.partial(
+        crawler.bfs_search_pdfs,
+        home,
+        ["example.com"],
+        max_depth=3,
+        concurrency=4,
+        state=state,
+        scope=scope,
+    )
+    with pytest.raises(RuntimeError):
+        crawl()
+    frontier, visited, _ = state.load()
+    assert sorted(url for url, _ in frontier) == months[:2]
+    assert visited == {home}
+
+    # Only the pages that passed the trap detector are fetched on resume
+    resumed = []
+    monkeypatch.setattr(
+        crawler, "get_links", lambda url, **kwargs: resumed.append(url) or ([], [])
+    )
+    crawl(resume=True)
+    assert sorted(resumed) == months[:2]
+
+
+def test_url_seen_sets():
+    urls = [f"https://example.com/page/{page}" for page in range(5000)]
+    seen = crawler.URLSeenSet(urls[:2500], capacity=8)
+    seen.update(urls)
+    seen.add(urls[0])
+    assert len(seen) == 5000
+    assert all(url in seen for url in urls)
+    assert "https://example.com/page/5000" not in seen
+    assert seen == set(urls) == crawler.URLSeenSet(reversed(urls))
+
+    # Chained filters never forget a URL and rarely report unseen ones
+    bloom = crawler.BloomFilter(urls, capacity=1000, error_rate=0.01)
+    assert len(bloom.filters) > 1
+    assert all(url in bloom for url in urls)
+    false_positives = sum(
+        f"https://example.com/other/{page}" in bloom for page in range(5000)
+    )
+    assert false_positives < 100
+
+
+@pytest.mark.parametrize("seen_set", ["fingerprint", "bloom"])
+def test_bfs_search_pdfs_queues_pages_once(monkeypatch, tmp_path, seen_set):
+    # Every page links to every other page
+    pages = [f"https://example.com/{page}" for page in "abcdef"]
+    fetched = []
+
+    def linked_pages(url, **kwargs):
+        fetched.append(url)
+        if url == pages[-1]:
+            raise KeyboardInterrupt
+        return pages, pages
+
+    monkeypatch.setattr(crawler, "get_links", linked_pages)
+    state = crawler.CrawlState(str(tmp_path / "crawl.state.sqlite"))
+    with pytest.raises(KeyboardInterrupt):
+        crawler.bfs_search_pdfs(
+            pages[0],
+            ["example.com"],
+            max_depth=4,
+            state=state,
+            settings=crawler.CrawlSettings(seen_filter=seen_set),
+        )
+    assert fetched == pages
+    frontier, visited, _ = state.load()
+    assert [url for url, _ in frontier] == pages[-1:]
+    assert visited == set(pages[:-1])
+
+
+def test_bfs_search_pdfs_priority(monkeypatch):
+    # The home page links to four calendar pages before a documents page,
+    # and only the documents page links to PDFs
+    home = "https://example.com/"
+    calendars = [f"https://example.com/calendar/{day}" for day in range(4)]
+    documents = "https://example.com/documents"
+    site = {
+        home: calendars + [documents],
+        documents: [f"https://example.com/files/{n}.pdf" for n in range(3)],
+    }
+
+    def linked_pages(url, **kwargs):
+        links = site.get(url, [])
+        return links, ["" for _ in links]
+
+    monkeypatch.setattr(crawler, "get_links", linked_pages)
+    for priority, found in [(False, 0), (True, 3)]:
+        budget = crawler.CrawlBudget(max_pages=3)
+        pdfs, visited = crawler.bfs_search_pdfs(
+            home, ["example.com"], max_depth=3, priority=priority, budget=budget
+        )
+        assert len(visited) == 3
+        assert len(pdfs) == found
+    assert crawler.CrawlBudget(max_seconds=0).exhausted()
+
+
+def test_bfs_search_pdfs_priority_canonical_anchor_text(monkeypatch):
+    # The documents link is only recognizable by its text, and its URL
+    # changes when tracking parameters are stripped
+    home = "https://example.com/"
+    pages = [f"https://example.com/p{n}" for n in range(4)]
+    documents = "https://example.com/p9?utm_source=mail"
+    site = {
+        home: (pages + [documents], ["", "", "", "", "Documents library"]),
+        "https://example.com/p9": (["https://example.com/files/1.pdf"], [""]),
+    }
+    monkeypatch.setattr(
+        crawler, "get_links", lambda url, **kwargs: site.get(url, ([], []))
+    )
+    scope = crawler.ScopeMatcher.from_config({"allow_list": [home]})
+    pdfs, visited = crawler.bfs_search_pdfs(
+        home,
+        scope.allowable_domains,
+        max_depth=3,
+        scope=scope,
+        priority=True,
+        budget=crawler.CrawlBudget(max_pages=2),
+    )
+    assert "https://example.com/p9" in visited
+    assert len(pdfs) == 1
+
+
+def make_pdf(title="", pages=1):
+    document = pymupdf.open()
+    for page_number in range(pages):
+        document.new_page().insert_text((72, 72), f"Page {page_number + 1}")
+    document.set_metadata({"title": title, "author": "ASAP"})
+    return document.tobytes()
+
+
+def read_rows(path):
+    with open(path, newline="") as csv_file:
+        return sorted(csv.DictReader(csv_file), key=lambda row: row["url"])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_get_pdf_metadata(httpserver: HTTPServer, tmp_path, workers):
+    httpserver.expect_request("/first.pdf").respond_with_data(make_pdf("First"))
+    httpserver.expect_request("/files/second.pdf").respond_with_data(make_pdf(pages=3))
+    httpserver.expect_request("/download").respond_with_data("<html></html>")
+    httpserver.expect_request("/missing.pdf").respond_with_data("", status=404)
+    links = [{"source": "https://example.com", "text": "Report"}]
+    pdfs = {
+        httpserver.url_for(path): links
+        for path in ["/first.pdf", "/files/second.pdf", "/download", "/missing.pdf"]
+    }
+
+    output_path = tmp_path / "pdfs.csv"
+    crawler.get_pdf_metadata(
+        pdfs, output_path, download_workers=workers, analysis_workers=workers
+    )
+    rows = read_rows(output_path)
+    assert [row["file_name"] for row in rows] == ["second.pdf", "First"]
+    assert [row["number_of_pages"] for row in rows] == ["3", "1"]
+    assert rows[1]["author"] == "ASAP"
+    assert rows[1]["source"] == "['https://example.com']"
+    assert rows[1]["text_around_link"] == "['Report']"
+
+
+def test_streaming_outputs(monkeypatch, tmp_path):
+    monkeypatch.setattr(crawler, "get_links", fake_get_links)
+    links_log = crawler.PDFLinkLog(str(tmp_path / "site.pdfs.jsonl"))
+    pdfs, _ = crawler.bfs_search_pdfs(
+        "https://example.com", ["example.com"], max_depth=3, links_log=links_log
+    )
+    links_log.close()
+    with open(tmp_path / "site.pdfs.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert sorted((r["url"], r["source"], r["text"]) for r in records) == sorted(
+        (pdf_url, link["source"], link["text"])
+        for pdf_url, links in pdfs.items()
+        for link in links
+    )
+
+    # Each row is on disk before the next PDF is fetched
+    csv_path = tmp_path / "site.csv"
+    rows_on_disk = []
+
+    def fake_fetch_pdf(pdf_url, **kwargs):
+        rows_on_disk.append(len(read_rows(csv_path)))
+        return crawler.PDFContent.from_bytes(make_pdf(pdf_url)), None
+
+    monkeypatch.setattr(crawler, "fetch_pdf", fake_fetch_pdf)
+    crawler.get_pdf_metadata(pdfs, csv_path)
+    assert rows_on_disk == list(range(len(pdfs)))
+
+
+def test_download_pdf_limits(httpserver: HTTPServer, tmp_path, monkeypatch):
+    small, large = make_pdf("Small"), make_pdf("Large", pages=50)
+    httpserver.expect_request("/small.pdf").respond_with_data(small)
+    httpserver.expect_request("/large.pdf").respond_with_data(large)
+    # Chunked, so the size is only known once the body goes over the limit
+    httpserver.expect_request("/streamed.pdf").respond_with_response(
+        Response(iter([large[:4096], large[4096:]]), content_type="application/pdf")
+    )
+    monkeypatch.setattr(crawler, "PDF_SPOOL_SIZE", len(small))
+
+    content, _ = crawler.download_pdf(httpserver.url_for("/small.pdf"))
+    assert (content.data, content.path) == (small, None)
+    content, _ = crawler.download_pdf(httpserver.url_for("/large.pdf"))
+    with content:
+        assert content.data is None
+        assert Path(content.path).read_bytes() == large
+        assert content.digest == hashlib.sha256(large).hexdigest()
+        assert crawler.analyze_pdf(content)["number_of_pages"] == 50
+    assert not Path(content.path).exists()
+
+    pdfs = {
+        httpserver.url_for(path): [{"source": "https://example.com", "text": ""}]
+        for path in ["/small.pdf", "/large.pdf", "/streamed.pdf"]
+    }
+    settings = crawler.CrawlSettings(max_pdf_size=len(large) - 1)
+    crawler.get_pdf_metadata(pdfs, tmp_path / "pdfs.csv", settings=settings)
+    rows = {row["url"].split("/")[-1]: row for row in read_rows(tmp_path / "pdfs.csv")}
+    assert list(rows) == ["small.pdf"]
+    assert rows["small.pdf"]["download_status"] == ""
+    assert rows["small.pdf"]["file_name"] == "Small"
+    # Loads the way classifier.get_features does
+    pdfs_frame = pd.read_csv(tmp_path / "pdfs.csv")
+    assert list(pdfs_frame["number_of_pages"].astype(int)) == [1]
+
+    skipped = read_rows(tmp_path / "pdfs.skipped.csv")
+    rows = {row["url"].split("/")[-1]: row for row in skipped}
+    assert rows["large.pdf"]["download_status"] == "skipped_too_large"
+    assert rows["large.pdf"]["file_size_kilobytes"] == str(len(large) / 1024)
+    assert rows["streamed.pdf"]["download_status"] == "truncated_too_large"
+    assert rows["streamed.pdf"]["number_of_pages"] == ""
+
+
+def test_streamed_downloads_count_bytes_read(httpserver: HTTPServer, monkeypatch):
+    crawler.get_metrics.cache_clear()
+    monkeypatch.setattr(crawler, "PDF_CHUNK_SIZE", 1000)
+    pdf = make_pdf("Chunked", pages=20)
+    httpserver.expect_request("/large.pdf").respond_with_data(pdf)
+    # A generator body is sent chunked, without a Content-Length
+    httpserver.expect_request("/chunked.pdf").respond_with_response(
+        Response(iter([pdf[:1000], pdf[1000:]]), content_type="application/pdf")
+    )
+    httpserver.expect_request("/cut.pdf").respond_with_response(
+        Response(iter([pdf[:1000], pdf[1000:]]), content_type="application/pdf")
+    )
+    host = f"{httpserver.host}:{httpserver.port}"
+
+    settings = crawler.CrawlSettings(max_pdf_size=len(pdf) - 1)
+    _, skipped = crawler.download_pdf(
+        httpserver.url_for("/large.pdf"), settings=settings
+    )
+    assert skipped["download_status"] == "skipped_too_large"
+    assert crawler.get_metrics().snapshot()["hosts"][host]["bytes"] == 0
+
+    content, _ = crawler.download_pdf(httpserver.url_for("/chunked.pdf"))
+    assert content.size == len(pdf)
+    assert crawler.get_metrics().snapshot()["hosts"][host]["bytes"] == len(pdf)
+
+    settings = crawler.CrawlSettings(max_pdf_size=1500)
+    _, skipped = crawler.download_pdf(httpserver.url_for("/cut.pdf"), settings=settings)
+    assert skipped["download_status"] == "truncated_too_large"
+    # Reading stopped at the chunk that went past the limit
+    host_bytes = crawler.get_metrics().snapshot()["hosts"][host]["bytes"]
+    assert host_bytes == len(pdf) + 2000
+    crawler.get_metrics.cache_clear()
+
+
+@pytest.mark.parametrize("stall", [False, True])
+def test_slow_pdf_download_is_cut_short(httpserver: HTTPServer, stall):
+    chunk = b"%PDF-1.7\n".ljust(crawler.PDF_CHUNK_SIZE, b"0")
+
+    def slow_body():
+        # A slow server trickles chunks, a stalled one pauses after the first.
+        # The test server handles one request at a time, so pauses are short.
+        yield chunk
+        if stall:
+            time.sleep(1.5)
+        for _ in range(20):
+            time.sleep(0 if stall else 0.1)
+            yield chunk
+
+    httpserver.expect_request("/slow.pdf").respond_with_handler(
+        lambda request: Response(slow_body(), content_type="application/pdf")
+    )
+    settings = crawler.CrawlSettings(max_pdf_seconds=0.3)
+    start = time.monotonic()
+    content, skipped = crawler.download_pdf(
+        httpserver.url_for("/slow.pdf"), settings=settings
+    )
+    assert content is None and skipped["download_status"] == "truncated_timeout"
+    assert time.monotonic() - start < 1
+
+
+def test_output_path_without_extension(httpserver: HTTPServer, tmp_path):
+    small, large = make_pdf("Small"), make_pdf("Large", pages=50)
+    httpserver.expect_request("/small.pdf").respond_with_data(small)
+    httpserver.expect_request("/large.pdf").respond_with_data(large)
+    pdfs = {
+        httpserver.url_for(path): [{"source": "https://example.com", "text": ""}]
+        for path in ["/small.pdf", "/large.pdf"]
+    }
+    settings = crawler.CrawlSettings(max_pdf_size=len(large) - 1)
+    crawler.get_pdf_metadata(pdfs, tmp_path / "pdfs", settings=settings)
+    assert [row["file_name"] for row in read_rows(tmp_path / "pdfs")] == ["Small"]
+    skipped = read_rows(tmp_path / "pdfs.skipped.csv")
+    assert [row["download_status"] for row in skipped] == ["skipped_too_large"]
+    assert crawler.sibling_path("out.dir/pdfs", ".json") == "out.dir/pdfs.json"
+
+
+@pytest.fixture
+def archive_mode():
+    # Returns settings recording or replaying an archive, with fresh sessions
+    def use_archive(mode, directory, **options):
+        crawler.get_archive.cache_clear()
+        crawler.get_session.cache_clear()
+        return crawler.CrawlSettings(
+            archive_dir=str(directory), archive_mode=mode, **options
+        )
+
+    yield use_archive
+    crawler.get_archive.cache_clear()
+    crawler.get_session.cache_clear()
+
+
+def test_record_and_replay(httpserver: HTTPServer, tmp_path, archive_mode):
+    home, old_home = httpserver.url_for("/"), httpserver.url_for("/old")
+    httpserver.expect_request("/").respond_with_data(
+        '<a href="/report.pdf">Report</a><a href="/download">Form</a>'
+        '<a href="/old">Old</a>',
+        content_type="text/html",
+    )
+    httpserver.expect_request("/old").respond_with_data(
+        "", status=301, headers={"Location": home}
+    )
+    httpserver.expect_request("/report.pdf").respond_with_data(make_pdf("Report"))
+    httpserver.expect_request("/download").respond_with_data(
+        make_pdf("Form", pages=2), content_type="application/pdf"
+    )
+
+    def crawl(output_path, settings):
+        pdfs, visited = crawler.bfs_search_pdfs(
+            home, ["localhost"], max_depth=2, settings=settings
+        )
+        pdfs = crawler.resolve_pdf_links(pdfs, settings=settings)
+        crawler.get_pdf_metadata(pdfs, output_path, settings=settings)
+        # Redirects are recorded hop by hop
+        redirected = crawler.get_links(old_home, settings=settings)
+        return pdfs, visited, read_rows(output_path), redirected
+
+    settings = archive_mode("record", tmp_path / "archive")
+    recorded = crawl(tmp_path / "recorded.csv", settings)
+    assert len(recorded[2]) == 2
+    assert recorded[3] == crawler.get_links(home, settings=settings)
+    responses = len(httpserver.log)
+    httpserver.clear()
+
+    settings = archive_mode("replay", tmp_path / "archive")
+    assert crawl(tmp_path / "replayed.csv", settings) == recorded
+    with pytest.raises(ArchiveMiss):
+        crawler.http_get(httpserver.url_for("/missing"), settings=settings)
+
+    # Records are standard gzip members holding WARC response records
+    with gzip.open(tmp_path / "archive" / "localhost.warc.gz") as f:
+        assert f.read().count(b"WARC-Type: response") == responses
+
+
+def test_replay_never_starts_a_webdriver(tmp_path, archive_mode, monkeypatch):
+    monkeypatch.setattr(crawler, "get_webdriver_pool", None)
+    settings = archive_mode("replay", tmp_path / "archive")
+    with pytest.raises(ArchiveMiss):
+        crawler.get_url("https://example.com", use_webdriver=True, settings=settings)
+    assert crawler.get_links(
+        "https://example.com", use_webdriver=True, settings=settings
+    ) == ([], [])
+
+
+def test_record_respects_pdf_limits(
+    httpserver: HTTPServer, tmp_path, archive_mode, monkeypatch
+):
+    large = make_pdf("Large", pages=50)
+    httpserver.expect_request("/large.pdf").respond_with_data(large)
+    httpserver.expect_request("/streamed.pdf").respond_with_response(
+        Response(iter([large[:4096], large[4096:]]), content_type="application/pdf")
+    )
+    monkeypatch.setattr(crawler, "PDF_CHUNK_SIZE", 4096)
+    pdfs = {
+        httpserver.url_for(path): [{"source": "https://example.com", "text": ""}]
+        for path in ["/large.pdf", "/streamed.pdf"]
+    }
+
+    def statuses(output_path, settings):
+        crawler.get_pdf_metadata(pdfs, output_path, settings=settings)
+        skipped = read_rows(str(output_path).replace(".csv", ".skipped.csv"))
+        return {row["url"]: row["download_status"] for row in skipped}
+
+    settings = archive_mode("record", tmp_path / "archive", max_pdf_size=4096)
+    recorded = statuses(tmp_path / "recorded.csv", settings)
+    assert sorted(recorded.values()) == ["skipped_too_large", "truncated_too_large"]
+
+    # Only the bytes read before the downloads were abandoned are archived
+    archive = crawler.get_archive(settings.archive_dir)
+    for url in pdfs:
+        *_, body, truncated = archive.lookup("GET", url)
+        assert truncated and len(body) < len(large)
+
+    httpserver.clear()
+    settings = archive_mode("replay", tmp_path / "archive", max_pdf_size=4096)
+    assert statuses(tmp_path / "replayed.csv", settings) == recorded
+    settings = archive_mode("replay", tmp_path / "archive", max_pdf_size=0)
+    unlimited = tmp_path / "unlimited.csv"
+    assert crawler.get_pdf_metadata(pdfs, unlimited, settings=settings) is None
+    assert read_rows(unlimited) == []
+
+
+def record_responses(directory, worker, count):
+    archive = CrawlArchive(directory)
+    for number in range(count):
+        url = f"https://example.com/{worker}/{number}"
+        response = requests.Response()
+        response.status_code, response.reason = 200, "OK"
+        # Incompressible, so each record takes several writes
+        body = io.BytesIO(random.Random(url).randbytes(200 * 1024))
+        body.seek(0, io.SEEK_END)
+        archive.record(requests.Request("GET", url).prepare(), response, body)
+
+
+def test_archive_shared_between_processes(tmp_path):
+    directory = str(tmp_path / "archive")
+    with ProcessPoolExecutor(4) as executor:
+        writers = [
+            executor.submit(record_responses, directory, worker, 20)
+            for worker in range(4)
+        ]
+        for writer in writers:
+            writer.result()
+
+    archive = CrawlArchive(directory)
+    for worker in range(4):
+        for number in range(20):
+            url = f"https://example.com/{worker}/{number}"
+            *_, body, truncated = archive.lookup("GET", url)
+            assert body == random.Random(url).randbytes(200 * 1024)
+            assert not truncated
+
+
+def test_crawl_database(httpserver: HTTPServer, tmp_path):
+    database = CrawlDatabase(str(tmp_path / "crawls.sqlite"))
+    links = [{"source": "https://example.com/library", "text": "Annual report"}]
+
+    def crawl(files, run_number):
+        for name, content in files.items():
+            httpserver.expect_request(f"/{name}").respond_with_data(content)
+        run_id = database.start_run("https://example.com")
+        pdfs = {httpserver.url_for(f"/{name}"): links for name in files}
+        output_path = tmp_path / f"run{run_number}.csv"
+        crawler.get_pdf_metadata(pdfs, output_path, database=database, run_id=run_id)
+        database.finish_run(run_id, pages=1)
+        httpserver.clear()
+        return run_id, output_path
+
+    unchanged = make_pdf("A")
+    first, first_csv = crawl(
+        {"a.pdf": unchanged, "b.pdf": make_pdf("B"), "c.pdf": make_pdf("C")}, 1
+    )
+    assert database.changes(first) is None
+    second, second_csv = crawl(
+        {"a.pdf": unchanged, "b.pdf": make_pdf("B", pages=2), "d.pdf": make_pdf()},
+        2,
+    )
+    assert database.previous_run(second) == first
+    assert database.latest_run("https://example.com") == second
+
+    def names(pdfs):
+        return sorted(pdf["url"].split("/")[-1] for pdf in pdfs)
+
+    new, changed, removed = database.changes(second)
+    assert (names(new), names(changed), names(removed)) == (
+        ["d.pdf"],
+        ["b.pdf"],
+        ["c.pdf"],
+    )
+
+    # Exported rows match the CSV written during the crawl
+    database.export_csv(database.pdfs(second), tmp_path / "export.csv")
+    assert read_rows(tmp_path / "export.csv") == read_rows(second_csv)
+    deltas = export_pdfs(database, tmp_path / "deltas.csv", sites=["*example*"])
+    assert names(deltas) == ["b.pdf", "d.pdf"]
+    exported = pd.read_csv(tmp_path / "deltas.csv")
+    assert exported["source"].apply(eval).tolist() == [[links[0]["source"]]] * 2
+    database.close()
+
+
+def test_write_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    with open(tmp_path / "site.csv", "w") as f:
+        f.write("url,number_of_pages\nhttps://example.com/a.pdf,3\n")
+    crawler.write_parquet(str(tmp_path / "site.csv"), str(tmp_path / "site.parquet"))
+    table = pd.read_parquet(tmp_path / "site.parquet")
+    assert table.to_dict("records") == [
+        {"url": "https://example.com/a.pdf", "number_of_pages": 3}
+    ]
+
+
+def test_resolve_pdf_links(httpserver: HTTPServer):
+    def expect_head(path, status=200, **headers):
+        httpserver.expect_request(path, method="HEAD").respond_with_data(
+            "", status=status, headers=headers
+        )
+
+    expect_head("/download/1", **{"Content-Type": "application/pdf"})
+    expect_head("/download/2", **{"Content-Type": "text/html; charset=utf-8"})
+    expect_head("/download/3", **{"Content-Type": "application/octet-stream"})
+    expect_head("/report/download", status=302, Location="/files/report.pdf")
+    expect_head("/files/report.pdf", **{"Content-Type": "binary/octet-stream"})
+    # Servers refusing HEAD are asked for the first byte instead
+    expect_head("/file.cfm", status=405)
+    httpserver.expect_request(
+        "/file.cfm", method="GET", headers={"Range": "bytes=0-0"}
+    ).respond_with_data(
+        b"%",
+        status=206,
+        content_type="application/octet-stream",
+        headers={"Content-Disposition": 'attachment; filename="minutes.PDF"'},
+    )
+    links = [
+        httpserver.url_for("/download/1"),
+        httpserver.url_for("/download/2"),
+        httpserver.url_for("/download/3"),
+        httpserver.url_for("/report/download"),
+        httpserver.url_for("/file.cfm?id=12"),
+        httpserver.url_for("/a.pdf"),
+    ]
+    pdfs = {link: [{"source": "https://example.com", "text": ""}] for link in links}
+
+    resolved = crawler.resolve_pdf_links(pdfs, workers=4)
+    assert list(resolved) == links[:1] + links[2:]
+    requests_made = len(httpserver.log)
+    assert requests_made == 7
+    assert crawler.resolve_pdf_links(pdfs, workers=4) == resolved
+    assert len(httpserver.log) == requests_made
+
+
+def test_sitemap_and_page_fetches_share_the_delay(httpserver: HTTPServer):
+    started = []
+
+    def handler(request):
+        started.append(time.monotonic())
+        if request.path == "/sitemap.xml":
+            sitemaps = "".join(
+                f"<sitemap><loc>{httpserver.url_for(f'/pages-{n}.xml')}</loc></sitemap>"
+                for n in range(2)
+            )
+            return Response(f"<sitemapindex>{sitemaps}</sitemapindex>")
+        if request.path.startswith("/pages-"):
+            n = request.path[len("/pages-")]
+            pages = "".join(
+                f"<url><loc>{httpserver.url_for(f'/page/{n}{page}')}</loc></url>"
+                for page in range(2)
+            )
+            return Response(f"<urlset>{pages}</urlset>")
+        return Response("<html></html>", content_type="text/html")
+
+    httpserver.expect_request(re.compile(".*")).respond_with_handler(handler)
+    sitemap = httpserver.url_for("/sitemap.xml")
+    _, visited = crawler.get_all_pages(
+        crawler.iter_sitemap([sitemap], delay=0.1), delay=0.1
+    )
+    assert len(visited) == 4 and len(started) == 7
+    started.sort()
+    assert all(later - earlier >= 0.09 for earlier, later in zip(started, started[1:]))
+
+
+def test_resolve_pdf_links_is_polite(httpserver: HTTPServer):
+    started, in_flight, most_in_flight = [], [0], [0]
+    lock = threading.Lock()
+
+    def head(request):
+        with lock:
+            started.append(time.monotonic())
+            in_flight[0] += 1
+            most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return Response("", content_type="application/pdf")
+
+    httpserver.expect_request("/check", method="HEAD").respond_with_handler(head)
+    pdfs = {
+        httpserver.url_for(f"/check?id={n}"): [{"source": "", "text": ""}]
+        for n in range(4)
+    }
+    crawler.resolve_pdf_links(pdfs, workers=4, delay=0.1, per_host_concurrency=1)
+    assert len(started) == 4 and most_in_flight[0] == 1
+    started.sort()
+    # Request starts are spaced by the delay, give or take the server's jitter
+    assert all(later - earlier >= 0.09 for earlier, later in zip(started, started[1:]))
+
+
+def test_inspect_pdf_with_range_requests(httpserver: HTTPServer):
+    content = make_pdf("Ranged", pages=400)
+    served = []
+
+    def handler(request: Request):
+        response = Response(content, mimetype="application/pdf")
+        response.make_conditional(
+            request, accept_ranges=True, complete_length=len(content)
+        )
+        served.append(response.calculate_content_length())
+        return response
+
+    httpserver.expect_request("/ranged.pdf").respond_with_handler(handler)
+    httpserver.expect_request("/plain.pdf").respond_with_data(content)
+
+    ranged = crawler.inspect_pdf(httpserver.url_for("/ranged.pdf"), block_size=4096)
+    assert ranged["title"] == "Ranged"
+    assert ranged["number_of_pages"] == 400
+    assert ranged["number_of_tables"] is None
+    assert ranged["file_size_kilobytes"] == len(content) / 1024
+    assert sum(served) < len(content) / 2
+
+    plain = crawler.inspect_pdf(httpserver.url_for("/plain.pdf"))
+    assert plain == ranged
+
+
+def test_validator_cache(httpserver: HTTPServer, tmp_path, monkeypatch):
+    page = '<a href="/report.pdf">Report</a>'
+
+    def handler(request: Request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return Response(status=304)
+        body = make_pdf("Cached") if request.path.endswith(".pdf") else page
+        return Response(body, headers={"ETag": '"v1"'})
+
+    httpserver.expect_request("/page").respond_with_handler(handler)
+    httpserver.expect_request("/report.pdf").respond_with_handler(handler)
+    cache = crawler.ValidatorCache(str(tmp_path / "cache.sqlite"))
+    page_url, pdf_url = httpserver.url_for("/page"), httpserver.url_for("/report.pdf")
+    pdfs = {pdf_url: [{"source": page_url, "text": "Report"}]}
+
+    first_links = crawler.get_links(page_url, cache=cache)
+    crawler.get_pdf_metadata(pdfs, tmp_path / "first.csv", cache=cache)
+
+    # Unchanged content is never parsed or analyzed again
+    monkeypatch.setattr(crawler, "parse_anchors", None)
+    monkeypatch.setattr(crawler, "analyze_pdf", None)
+    assert (
+        crawler.get_links(page_url, cache=cache)
+        == first_links
+        == ([pdf_url], ["Report"])
+    )
+    crawler.get_pdf_metadata(pdfs, tmp_path / "second.csv", cache=cache)
+    assert read_rows(tmp_path / "second.csv") == read_rows(tmp_path / "first.csv")
+    assert read_rows(tmp_path / "second.csv")[0]["file_name"] == "Cached"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_get_pdf_metadata_deduplicates_content(
+    httpserver: HTTPServer, tmp_path, monkeypatch, workers
+):
+    content = make_pdf("Shared")
+    for path in ["/a.pdf", "/download", "/b.cfm"]:
+        httpserver.expect_request(path).respond_with_data(content)
+    httpserver.expect_request("/other.pdf").respond_with_data(make_pdf("Other"))
+    links = [{"source": "https://example.com", "text": "Report"}]
+    urls = [httpserver.url_for(path) for path in ["/a.pdf", "/download", "/b.cfm"]]
+    pdfs = {url: links for url in urls + [httpserver.url_for("/other.pdf")]}
+
+    # Analysis runs in worker processes with more than one worker, so calls are
+    # only counted in the serial path
+    analyzed, analyze_pdf = [], crawler.analyze_pdf
+
+    def counting_analyze_pdf(content, **kwargs):
+        analyzed.append(content)
+        return analyze_pdf(content, **kwargs)
+
+    if workers == 1:
+        monkeypatch.setattr(crawler, "analyze_pdf", counting_analyze_pdf)
+    crawler.get_pdf_metadata(
+        pdfs, tmp_path / "pdfs.csv", download_workers=workers, analysis_workers=workers
+    )
+
+    rows = {row["url"]: row for row in read_rows(tmp_path / "pdfs.csv")}
+    assert len(rows) == 4
+    assert {rows[url]["file_name"] for url in urls} == {"Shared"}
+    canonical = [url for url in urls if rows[url]["duplicate_of"] == ""]
+    assert len(canonical) == 1
+    assert all(
+        rows[url]["duplicate_of"] in canonical for url in urls if url not in canonical
+    )
+    assert rows[httpserver.url_for("/other.pdf")]["duplicate_of"] == ""
+    if workers == 1:
+        assert len(analyzed) == 2
+
+
+def make_table_pdf(table_pages=1, plain_pages=1):
+    document = pymupdf.open()
+    pixmap = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 200, 200), False)
+    for _ in range(table_pages):
+        page = document.new_page()
+        for row in range(4):
+            page.draw_line((50, 50 + row * 20), (350, 50 + row * 20))
+        for column in range(4):
+            page.draw_line((50 + column * 100, 50), (50 + column * 100, 110))
+        for row in range(3):
+            for column in range(3):
+                point = (55 + column * 100, 65 + row * 20)
+                page.insert_text(point, f"{row}{column}", fontsize=8)
+    for _ in range(plain_pages):
+        page = document.new_page()
+        page.insert_image(pymupdf.Rect(100, 100, 300, 300), pixmap=pixmap)
+    return pymupdf.open(stream=document.tobytes())
+
+
+def test_census_images_and_tables():
+    pdf_file = make_table_pdf(table_pages=2, plain_pages=2)
+    assert get_images_and_tables(pdf_file.pages()) == (2, 2)
+    # The image shared by both pages is counted on each, like the full count
+    assert census_images_and_tables(pdf_file) == (2, 2, False)
+    assert census_images_and_tables(pdf_file, max_pages=4) == (2, 2, False)
+
+    # Images are always counted on every page, only tables are estimated
+    n_images, n_tables, estimated = census_images_and_tables(pdf_file, max_pages=2)
+    assert (n_images, estimated) == (2, True)
+    assert n_tables in (0, 2, 4)
+
+
+class FakeDriver:
+    def __init__(self):
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_webdriver_pool():
+    pool = crawler.WebDriverPool(size=1, max_pages=2, factory=FakeDriver)
+    with pool.driver() as first:
+        pass
+    with pool.driver() as second:
+        pass
+    assert first is second and first.quit_called
+
+    with pytest.raises(WebDriverException):
+        with pool.driver() as crashed:
+            raise WebDriverException("browser crashed")
+    assert crashed.quit_called
+
+    # Errors from a dead geckodriver come from urllib3
+    with pytest.raises(urllib3.exceptions.MaxRetryError):
+        with pool.driver() as crashed:
+            raise urllib3.exceptions.MaxRetryError(None, "http://localhost:4444")
+    assert crashed.quit_called
+
+    with pytest.raises(KeyboardInterrupt):
+        with pool.driver() as interrupted:
+            raise KeyboardInterrupt
+    assert not interrupted.quit_called
+
+    with pool.driver() as driver:
+        assert driver is interrupted
+    pool.close()
+    assert driver.quit_called
+
+
+def test_crawl_worker_closes_webdrivers(monkeypatch, tmp_path):
+    drivers = []
+
+    def new_driver():
+        drivers.append(FakeDriver())
+        return drivers[-1]
+
+    def browsed_links(url, settings, **kwargs):
+        with settings.webdriver_pool().driver():
+            return fake_get_links(url)
+
+    pool = functools.lru_cache(maxsize=None)(
+        lambda size: crawler.WebDriverPool(size=size, factory=new_driver)
+    )
+    monkeypatch.setattr(crawler, "get_webdriver_pool", pool)
+    monkeypatch.setattr(crawler, "get_links", browsed_links)
+    queue_path = str(tmp_path / "crawl.queue.sqlite")
+    settings = {"url": "https://example.com", "delay": 0, "per_host_concurrency": 2}
+    SharedFrontier(queue_path).reset([("https://example.com", 3)], settings=settings)
+    config = {"allow_list": ["https://example.com"], "use_webdriver": True}
+    assert crawler.crawl_worker(queue_path, config) == 4
+    assert drivers and all(driver.quit_called for driver in drivers)
+
+
+def test_crawl_all(monkeypatch, tmp_path):
+    config = {
+        "https://a.georgia.gov": {},
+        "https://b.georgia.gov": {},
+        "https://c.georgia.gov": {},
+        "https://www.audits2.ga.gov": {},
+    }
+    running, peak = defaultdict(int), defaultdict(int)
+    lock = threading.Lock()
+
+    def fake_crawl_site(url, output_path, config=None, **kwargs):
+        domain = tldextract.extract(url).registered_domain
+        with lock:
+            running[domain] += 1
+            peak[domain] = max(peak[domain], running[domain])
+        time.sleep(0.05)
+        with lock:
+            running[domain] -= 1
+        if "audits2" in url:
+            raise ValueError("robots.txt unavailable")
+        return {"url": url, "pages": 1, "pdfs": 2, "seconds": 0.1}
+
+    monkeypatch.setattr(crawler, "load_config", lambda: config)
+    monkeypatch.setattr(crawler, "crawl_site", fake_crawl_site)
+    summaries = crawler.crawl_all(
+        str(tmp_path), sites=["*.gov"], site_workers=4, per_domain_sites=2
+    )
+
+    assert peak["georgia.gov"] == 2
+    assert {summary["url"] for summary in summaries} == set(config)
+    failed = [summary for summary in summaries if "error" in summary]
+    assert failed[0]["output_path"] == str(tmp_path / "www.audits2.ga.gov.csv")
+    with open(tmp_path / "summary.json") as f:
+        assert len(json.load(f)) == 4
+
+    # Without a cap, sites on one domain only share the site workers
+    peak.clear()
+    crawler.crawl_all(str(tmp_path), sites=["*.gov"], site_workers=4)
+    assert peak["georgia.gov"] == 3
+
+    summaries = crawler.crawl_all(str(tmp_path), sites=["https://a.*"])
+    assert [summary["url"] for summary in summaries] == ["https://a.georgia.gov"]
+
+
+def test_benchmark_crawl():
+    site = benchmark_crawl.SyntheticSite(pages=30, fanout=3, pdfs=6, pdf_pages=(1, 3))
+    with site:
+        results = benchmark_crawl.benchmark(site, concurrency=4)
+    assert [(result["pages"], result["pdfs"]) for result in results] == [
+        (30, 6),
+        (30, 6),
+        (0, 6),
+    ]
+    # Traced per stage rather than the process' lifetime peak
+    assert all(result["peak_heap_mb"] > 0 for result in results)